@@ -1,3 +1,44 @@
+import os
+import sys
+import types
+import importlib.util
+
+# the gateway sources in tmp/ import each other as tggateway.tgX
+GATEWAY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'tmp')
+GATEWAY_MODULES = {'tgEvent': 'tnetevent', 'tgEventLog': 'tnetevlog', 'tgStreamer': 'tnetstreamer',
+	'tgModel': 'tnetmodel', 'tgUtils': 'tnetutils', 'tgEmail': 'tnetemail', 'tgSms': 'tnetsms',
+	'tgNotify': 'tnetnotify', 'tgSystem': 'tnetsystem', 'tgModem': 'tnetofono', 'tgConnman': 'tnetconnman',
+	'tgNetwork': 'tnetnetwork', 'tgTemperature': 'tnettemperature', 'tgSimBus': 'tnetsimbus'}
+
+
+class GatewayFinder(object):
+	''' finds tggateway.tgX in tmp/ '''
+
+	def find_spec(self, name, path, target=None):
+		package, _, module = name.partition('.')
+		if package != 'tggateway' or module not in GATEWAY_MODULES:
+			return None
+		return importlib.util.spec_from_file_location(name, os.path.join(GATEWAY_DIR, GATEWAY_MODULES[module] + '.py'))
+
+
+class DataLogger(object):
+	''' the gateway data logger is not in tmp/, Temperature is always handed a logger in the tests '''
+
+	def __init__(self):
+		raise NotImplementedError('tgDataLogger is not in tmp/')
+
+
+if 'tggateway' not in sys.modules:
+	gateway = types.ModuleType('tggateway')
+	gateway.__path__ = []
+	sys.modules['tggateway'] = gateway
+	sys.meta_path.insert(0, GatewayFinder())
+
+	dataLogger = types.ModuleType('tggateway.tgDataLogger')
+	dataLogger.TnetDataLogger = DataLogger
+	sys.modules['tggateway.tgDataLogger'] = dataLogger
+
+
 def pytest_addoption(parser):
 	parser.addoption("--env", action="store")
 
@@ -0,0 +1,247 @@
+"""Unit tests for the gateway smtp session and outbox against a local smtp stand-in."""
+import time
+import socket
+import threading
+import socketserver
+import pytest
+import tggateway.tgEmail as tgEmail
+
+FROM = 'gateway@tempnetz.test'
+
+
+class SmtpHandler(socketserver.StreamRequestHandler):
+	''' plain smtp without auth, replies to RCPT by the local part of the address '''
+
+	def reply(self, line):
+		self.wfile.write(line.encode() + b'\r\n')
+
+	def handle(self):
+		server = self.server
+		server.connections += 1
+		self.reply('220 stand-in ready')
+		while True:
+			line = self.rfile.readline()
+			if not line:
+				return
+			command = line.decode().strip()
+			verb = command[:4].upper()
+
+			if verb in ('EHLO', 'HELO'):
+				self.reply('250 stand-in')
+			elif verb == 'MAIL':
+				if getattr(self, 'transaction', False):
+					self.reply('503 nested MAIL command')
+					continue
+				self.transaction = True
+				self.recipients = []
+				self.reply('250 ok')
+			elif verb == 'RCPT':
+				address = command.split(':', 1)[1].strip('<> ')
+				if address.startswith('defer'):
+					self.reply('451 try later')
+				elif address.startswith('reject'):
+					self.reply('550 no such user')
+				else:
+					self.recipients.append(address)
+					self.reply('250 ok')
+			elif verb == 'DATA':
+				if server.reject_data:
+					server.reject_data = False
+					self.reply('451 local error')
+					continue
+				self.transaction = False
+				self.reply('354 go ahead')
+				data = []
+				while True:
+					line = self.rfile.readline()
+					if not line:
+						# closed part way through, nothing is delivered
+						return
+					if line == b'.\r\n':
+						break
+					data.append(line)
+				server.messages.append((self.recipients, b''.join(data)))
+				self.reply('250 queued')
+				if server.drop:
+					server.drop = False
+					return
+			elif verb == 'RSET':
+				self.transaction = False
+				self.reply('250 ok')
+			elif verb == 'NOOP':
+				self.reply('250 ok')
+			elif verb == 'QUIT':
+				self.reply('221 bye')
+				return
+			else:
+				self.reply('502 not implemented')
+
+
+@pytest.fixture
+def smtp_server():
+	server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), SmtpHandler)
+	server.daemon_threads = True
+	server.connections = 0
+	server.messages = []
+	server.drop = False
+	server.reject_data = False
+	thread = threading.Thread(target=server.serve_forever, daemon=True)
+	thread.start()
+	yield server
+	server.shutdown()
+	server.server_close()
+
+
+def make_session(server, **kwargs):
+	session = tgEmail.SmtpSession(**kwargs)
+	session.configure({'Url': '127.0.0.1', 'Port': server.server_address[1], 'User': '', 'Tls': False})
+	return session
+
+
+def test_connection_reused(smtp_server):
+	session = make_session(smtp_server)
+	assert session.send(FROM, ['one@tempnetz.test'], 'Subject: one\n\nfirst') == tgEmail.SEND_OK
+	assert session.send(FROM, ['two@tempnetz.test'], 'Subject: two\n\nsecond') == tgEmail.SEND_OK
+
+	assert smtp_server.connections == 1
+	assert len(smtp_server.messages) == 2
+	stats = session.getStats()
+	assert stats['Connects'] == 1 and stats['Reused'] == 1 and stats['Sent'] == 2
+	session.close()
+
+
+def test_idle_connection_replaced(smtp_server):
+	session = make_session(smtp_server, idleTimeout=60)
+	assert session.send(FROM, ['one@tempnetz.test'], 'first') == tgEmail.SEND_OK
+
+	# idle past the timeout, a new connection is made rather than probing the old one
+	session.lastUsed -= 61
+	assert not session.connected()
+	assert session.send(FROM, ['one@tempnetz.test'], 'second') == tgEmail.SEND_OK
+
+	assert smtp_server.connections == 2
+	stats = session.getStats()
+	assert stats['IdleCloses'] == 1 and stats['Connects'] == 2
+	session.close()
+
+
+def test_dropped_connection_reconnects(smtp_server):
+	session = make_session(smtp_server)
+	smtp_server.drop = True
+	assert session.send(FROM, ['one@tempnetz.test'], 'first') == tgEmail.SEND_OK
+	assert session.send(FROM, ['one@tempnetz.test'], 'second') == tgEmail.SEND_OK
+
+	assert smtp_server.connections == 2
+	assert len(smtp_server.messages) == 2
+	session.close()
+
+
+def test_deferred_and_refused(smtp_server):
+	session = make_session(smtp_server)
+
+	# 4xx is retried later, 5xx is final, the connection stays usable after either
+	assert session.send(FROM, ['defer@tempnetz.test'], 'deferred') == tgEmail.SEND_RETRY
+	assert session.send(FROM, ['reject@tempnetz.test'], 'refused') == tgEmail.SEND_FAILED
+	assert session.send(FROM, ['defer@tempnetz.test', 'reject@tempnetz.test'], 'mixed') == tgEmail.SEND_FAILED
+	assert session.send(FROM, ['one@tempnetz.test'], 'delivered') == tgEmail.SEND_OK
+
+	assert smtp_server.connections == 1
+	assert session.getStats()['Failed'] == 3
+	session.close()
+
+
+def test_data_rejected_then_next_sent(smtp_server, tmp_path):
+	outbox = tgEmail.Outbox(path=str(tmp_path / 'outbox'), sync=False)
+	outbox.add(FROM, ['one@tempnetz.test'], 'Subject: first\n\nrejected')
+	outbox.add(FROM, ['one@tempnetz.test'], 'Subject: second\n\ndelivered')
+	session = make_session(smtp_server)
+
+	smtp_server.reject_data = True
+	results = []
+	for entry in outbox.due(float('inf')):
+		fromAddr, toAddrs, msgFile, length = outbox.open(entry)
+		try:
+			results.append(session.send(fromAddr, toAddrs, msgFile, length))
+		finally:
+			msgFile.close()
+
+	# the transaction of the rejected message is reset, the next one goes on the same connection
+	assert results == [tgEmail.SEND_RETRY, tgEmail.SEND_OK]
+	assert smtp_server.connections == 1
+	assert smtp_server.messages[0][1].endswith(b'delivered\r\n')
+	session.close()
+	outbox.close()
+
+
+def test_corrupt_outbox_entry_failed(smtp_server, tmp_path):
+	outbox = tgEmail.Outbox(path=str(tmp_path / 'outbox'), sync=False)
+	bad = outbox.add(FROM, ['one@tempnetz.test'], 'Subject: first\n\ncut short')
+	outbox.add(FROM, ['one@tempnetz.test'], 'Subject: second\n\ndelivered')
+	# a length running past the end of the journal
+	outbox.entries[bad].length += 1000
+
+	email = tgEmail.Email('Gateway', None, outbox=outbox)
+	email.session = make_session(smtp_server)
+	email.sendDue()
+
+	# the bad message is given up on, not retried, and doesn't hold up the next one
+	assert outbox.nextDue() is None
+	assert outbox.getStats()['Failed'] == 1 and outbox.getStats()['Sent'] == 1
+	assert len(smtp_server.messages) == 1
+	assert smtp_server.messages[0][1].endswith(b'delivered\r\n')
+	assert email.unreachable == 0
+	email.session.close()
+	outbox.close()
+
+
+def test_unreachable():
+	sock = socket.socket()
+	sock.bind(('127.0.0.1', 0))
+	port = sock.getsockname()[1]
+	sock.close()
+
+	session = tgEmail.SmtpSession(timeout=5)
+	session.configure({'Url': '127.0.0.1', 'Port': port, 'User': '', 'Tls': False})
+	assert session.send(FROM, ['one@tempnetz.test'], 'nobody home') == tgEmail.SEND_UNREACHABLE
+	assert session.getStats()['ConnectFails'] == 1
+
+
+def test_outbox_message_streamed(smtp_server, tmp_path):
+	outbox = tgEmail.Outbox(path=str(tmp_path / 'outbox'), sync=False)
+	outbox.add(FROM, ['one@tempnetz.test'], 'Subject: dots\n\n.leading dot\nlast line')
+
+	session = make_session(smtp_server)
+	entry = outbox.due(float('inf'))[0]
+	fromAddr, toAddrs, msgFile, length = outbox.open(entry)
+	try:
+		assert session.send(fromAddr, toAddrs, msgFile, length) == tgEmail.SEND_OK
+	finally:
+		msgFile.close()
+	outbox.mark(entry, tgEmail.OUTBOX_SENT)
+
+	recipients, data = smtp_server.messages[0]
+	assert recipients == ['one@tempnetz.test']
+	# crlf line endings and the leading dot doubled on the wire
+	assert data == b'Subject: dots\r\n\r\n..leading dot\r\nlast line\r\n'
+	assert outbox.nextDue() is None
+	session.close()
+	outbox.close()
+
+
+def test_backoff_woken(tmp_path):
+	email = tgEmail.Email('Gateway', None, outbox=tgEmail.Outbox(path=str(tmp_path / 'outbox'), sync=False))
+	email.unreachable = 10
+
+	for wake in (email.networkUp, lambda: email.queueMessage(FROM, ['one@tempnetz.test'], 'queued')):
+		waiter = threading.Thread(target=email.connectionStatus)
+		waiter.start()
+		time.sleep(0.1)
+		assert waiter.is_alive()
+
+		# a route coming back or a new message ends the backoff early
+		wake()
+		waiter.join(2)
+		assert not waiter.is_alive()
+
+	assert email.unreachable == 1
+	email.outbox.close()
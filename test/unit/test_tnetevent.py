@@ -0,0 +1,196 @@
+"""Unit tests for the gateway event records and event manager."""
+import time
+import queue
+import threading
+
+import pytest
+import tggateway.tgEvent as tgEvent
+
+ALARM_DATA = 'Current A2 alarms,3,Freezer,41,30,40,A2 alarm,A2 rising,7,Cool room,-1.5,-4,2.5,A1 alarm,A1 falling'
+
+
+def record(data='', seq=12, evTopic=tgEvent.EVTOPIC_TEMP_ALRM_A2, timestamp=None):
+	return tgEvent.EventRecord(seq, tgEvent.EVCLASS_TEMP, evTopic, tgEvent.EVENT_PRIORITY_HIGH, data,
+		[tgEvent.EVACTION_STREAM], timestamp)
+
+
+def test_serialize():
+	event = record('1,2,3')
+	assert event.serialize() == b'<TMP:003:2:1,2,3>'
+	# built once and kept
+	assert event.serialize() is event.serialize()
+	assert record().serialize() == b'<TMP:003:2:>'
+
+
+def test_time_and_fields():
+	now = time.time()
+	event = record('a,b,,c', timestamp=now)
+	assert event.time == time.strftime(tgEvent.EVENT_TIME_FORMAT, time.localtime(now))
+	assert event.fields() == ('a', 'b', '', 'c')
+	assert record().fields() == ()
+
+
+def test_alarm_entries_typed():
+	globalState, entries = record(ALARM_DATA).alarmEntries()
+	assert globalState == 'Current A2 alarms'
+	assert entries[0] == tgEvent.AlarmEntry(3, 'Freezer', 41.0, 30.0, 40.0, 'A2 alarm', 'A2 rising')
+	assert entries[1].pos == 7 and entries[1].temp == -1.5 and entries[1].a2 == 2.5
+
+
+def test_alarm_entry_serialize():
+	entry = tgEvent.AlarmEntry(3, 'Freezer', 41, 30, 40.5, 'A2 alarm', 'A2 rising')
+	assert entry.serialize() == '3,Freezer,41,30,40.5,A2 alarm,A2 rising'
+
+	# the entries of an event serialize back to its data
+	globalState, entries = record(ALARM_DATA).alarmEntries()
+	assert ','.join([globalState] + [entry.serialize() for entry in entries]) == ALARM_DATA
+
+
+@pytest.mark.parametrize('data', ['', 'Current A2 alarms', 'Current A2 alarms,3,Freezer,41,30,40,A2 alarm',
+	'Current A2 alarms,three,Freezer,41,30,40,A2 alarm,A2 rising', 'Current A2 alarms,3,Freezer,hot,30,40,A2 alarm,A2 rising'])
+def test_malformed_alarm_data(data):
+	with pytest.raises(ValueError):
+		record(data).alarmEntries()
+
+
+@pytest.fixture
+def manager(tmp_path):
+	eventLog = tgEvent.EventLog(path=':memory:')
+	journal = tgEvent.StreamJournal(path=str(tmp_path / 'stream'))
+	manager = tgEvent.Event(eventLog=eventLog, streamJournal=journal, suppressWindows={})
+	yield manager
+	eventLog.close()
+	journal.close()
+
+
+# runs the event thread loop in the test until count events were processed
+def drain(manager, count):
+	processed = []
+	def processEvent(event):
+		processed.append(event)
+		if len(processed) == count:
+			manager.stopThread = True
+	manager.processEvent = processEvent
+	manager.run()
+	return processed
+
+
+def test_highest_priority_first(manager):
+	for data, priority in (('low 1', tgEvent.EVENT_PRIORITY_LOW), ('medium', tgEvent.EVENT_PRIORITY_MEDIUM),
+			('high 1', tgEvent.EVENT_PRIORITY_HIGH), ('low 2', tgEvent.EVENT_PRIORITY_LOW), ('high 2', tgEvent.EVENT_PRIORITY_HIGH)):
+		assert manager.raiseEvent(tgEvent.EVCLASS_TEMP, tgEvent.EVTOPIC_TEMP_NEW_DATA, data, priority, []) is not None
+
+	# everything queued is drained in one wakeup, in raise order within a priority
+	assert [event.data for event in drain(manager, 5)] == ['high 1', 'high 2', 'medium', 'low 1', 'low 2']
+	assert manager.queue.qsize() == 0
+
+	stats = manager.getStats()
+	assert stats[tgEvent.EVENT_PRIORITY_HIGH]['Enqueued'] == 2
+	assert stats[tgEvent.EVENT_PRIORITY_HIGH]['Processed'] == 2
+	assert stats[tgEvent.EVENT_PRIORITY_LOW]['Processed'] == 2
+	assert stats[tgEvent.EVENT_PRIORITY_LOW]['WaitMax'] >= stats[tgEvent.EVENT_PRIORITY_LOW]['WaitAvg'] >= 0
+
+
+def test_sequence_in_raise_order(manager):
+	events = [manager.raiseEvent(tgEvent.EVCLASS_TEMP, tgEvent.EVTOPIC_TEMP_NEW_DATA, '', priority, [])
+		for priority in (tgEvent.EVENT_PRIORITY_LOW, tgEvent.EVENT_PRIORITY_HIGH)]
+	assert events[1].seq == events[0].seq + 1
+
+
+def test_full_queue_drops(tmp_path, monkeypatch):
+	monkeypatch.setattr(tgEvent, 'EVENT_QUEUE_SIZE', 2)
+	eventLog = tgEvent.EventLog(path=':memory:')
+	manager = tgEvent.Event(eventLog=eventLog, streamJournal=tgEvent.StreamJournal(path=str(tmp_path / 'stream')))
+	for i in range(2):
+		assert manager.raiseEvent(tgEvent.EVCLASS_TEMP, tgEvent.EVTOPIC_TEMP_NEW_DATA, '', tgEvent.EVENT_PRIORITY_LOW, []) is not None
+	assert manager.raiseEvent(tgEvent.EVCLASS_TEMP, tgEvent.EVTOPIC_TEMP_ALRM_A2, '', tgEvent.EVENT_PRIORITY_HIGH, []) is None
+
+	stats = manager.getStats()
+	assert stats[tgEvent.EVENT_PRIORITY_LOW]['Enqueued'] == 2
+	assert stats[tgEvent.EVENT_PRIORITY_HIGH]['Dropped'] == 1
+	assert stats['Queued'] == 2
+	eventLog.close()
+
+
+def test_event_thread_wakes_on_raise(manager):
+	processed = queue.Queue()
+	manager.processEvent = processed.put
+	# only the event thread, not the action workers and streamer
+	tgEvent.Model.start(manager)
+	event = manager.raiseEvent(tgEvent.EVCLASS_TEMP, tgEvent.EVTOPIC_TEMP_NEW_DATA, '', tgEvent.EVENT_PRIORITY_LOW, [])
+	assert processed.get(timeout=tgEvent.EVENT_SUPPRESS_CHECK / 2) is event
+
+	# the stop marker wakes it without waiting for the check period
+	start = time.time()
+	manager.stopThread = True
+	manager.queue.put((-(tgEvent.EVENT_PRIORITY_HIGH+1), next(manager.sequence), time.time(), None))
+	manager.thread.join(5)
+	assert not manager.thread.is_alive()
+	assert time.time() - start < tgEvent.EVENT_SUPPRESS_CHECK
+
+
+@pytest.fixture
+def workers():
+	started = []
+	def make(name, handler, maxsize=tgEvent.ACTION_QUEUE_SIZE):
+		worker = tgEvent.ActionWorker(name, handler, maxsize)
+		started.append(worker)
+		return worker
+	yield make
+	for worker in started:
+		if worker.thread is not None:
+			worker.stop()
+
+
+def test_failing_action_isolated(workers):
+	done = []
+	def handler(event):
+		if event.data == 'bad':
+			raise RuntimeError('database locked')
+		done.append(event.data)
+
+	worker = workers('DatabaseAction', handler)
+	worker.start()
+	for data in ('good 1', 'bad', 'good 2'):
+		worker.dispatch(record(data))
+	worker.stop()
+
+	# queued actions are done before the worker stops, a failure doesn't stop the rest
+	assert done == ['good 1', 'good 2']
+	stats = worker.getStats()
+	assert (stats['Dispatched'], stats['Done'], stats['Failed'], stats['Queued']) == (3, 2, 1, 0)
+
+
+def test_slow_action_does_not_delay_others(workers):
+	release = threading.Event()
+	buzzed = threading.Event()
+	slow = workers('DatabaseAction', lambda event: release.wait(5))
+	fast = workers('AudiovisualAction', lambda event: buzzed.set())
+	slow.start()
+	fast.start()
+
+	slow.dispatch(record())
+	fast.dispatch(record())
+	assert buzzed.wait(1)
+	assert slow.getStats()['Done'] == 0
+	release.set()
+
+
+def test_backed_up_action_drops(workers):
+	worker = workers('NotificationsAction', lambda event: None, maxsize=2)
+	for i in range(3):
+		worker.dispatch(record())
+	stats = worker.getStats()
+	assert (stats['Dispatched'], stats['Dropped'], stats['Queued']) == (2, 1, 2)
+
+
+def test_event_fanned_out_to_action_workers(manager):
+	event = manager.raiseEvent(tgEvent.EVCLASS_TEMP, tgEvent.EVTOPIC_TEMP_ALRM_A2, '', tgEvent.EVENT_PRIORITY_HIGH,
+		[tgEvent.EVACTION_AUDIOVISUAL, tgEvent.EVACTION_DATABASE, 'unknown'])
+	manager.processEvent(event)
+
+	stats = manager.getStats()['Actions']
+	assert stats['AudiovisualAction']['Queued'] == 1
+	assert stats['DatabaseAction']['Queued'] == 1
+	assert stats['StreamAction']['Queued'] == 0
+	assert stats['NotificationsAction']['Queued'] == 0
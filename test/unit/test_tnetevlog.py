@@ -0,0 +1,81 @@
+"""Unit tests for the gateway event log."""
+import sqlite3
+import pytest
+import tggateway.tgEventLog as tgEventLog
+
+
+def log_events(eventLog, count, start=1000.0, evClass='TMP', evTopic='010'):
+	for i in range(count):
+		seq = eventLog.nextSequence()
+		eventLog.log(seq, start + i, evClass, evTopic, 1, 'data {}'.format(seq))
+
+
+def test_batch_committed_on_flush():
+	eventLog = tgEventLog.EventLog(path=':memory:', batchSize=10)
+	log_events(eventLog, 5)
+	assert eventLog.getStats()['Pending'] == 5
+	assert not eventLog.wakeup.is_set()
+
+	# a full batch wakes the writer
+	log_events(eventLog, 5, start=2000.0)
+	assert eventLog.wakeup.is_set()
+
+	eventLog.flush()
+	stats = eventLog.getStats()
+	assert stats['Committed'] == 10 and stats['Batches'] == 1 and stats['Pending'] == 0
+	eventLog.close()
+
+
+def test_sequence_continues_after_reopen(tmp_path):
+	path = str(tmp_path / 'events.db')
+	eventLog = tgEventLog.EventLog(path=path)
+	log_events(eventLog, 3)
+	eventLog.flush()
+	eventLog.close()
+
+	eventLog = tgEventLog.EventLog(path=path)
+	assert eventLog.nextSequence() == 4
+	eventLog.close()
+
+
+def test_query_filters():
+	eventLog = tgEventLog.EventLog(path=':memory:')
+	log_events(eventLog, 3, start=1000.0, evClass='TMP', evTopic='010')
+	log_events(eventLog, 2, start=1500.0, evClass='SYS', evTopic='106')
+
+	# pending events are part of the result
+	events = eventLog.query()
+	assert [event['Seq'] for event in events] == [5, 4, 3, 2, 1]
+
+	assert [event['Seq'] for event in eventLog.query(evClass='SYS')] == [5, 4]
+	assert [event['Seq'] for event in eventLog.query(evClass='TMP', evTopic='010', since=1001.0)] == [3, 2]
+	assert [event['Seq'] for event in eventLog.query(until=1001.0)] == [2, 1]
+	assert [event['Seq'] for event in eventLog.query(limit=2)] == [5, 4]
+	assert eventLog.query(evTopic='999') == []
+
+	event = eventLog.query(limit=1)[0]
+	assert event == {'Seq': 5, 'Time': 1501.0, 'Class': 'SYS', 'Topic': '106', 'Priority': 1, 'Data': 'data 5'}
+	eventLog.close()
+
+
+def test_failed_commit_kept_and_bounded():
+	eventLog = tgEventLog.EventLog(path=':memory:', batchSize=10, maxPending=25)
+	database = eventLog.db
+	broken = sqlite3.connect(':memory:')
+	broken.close()
+	eventLog.db = broken
+
+	log_events(eventLog, 10)
+	eventLog.flush()
+	assert eventLog.getStats()['Pending'] == 10
+
+	log_events(eventLog, 20, start=2000.0)
+	eventLog.flush()
+	stats = eventLog.getStats()
+	# the oldest go once the retained events pass the limit
+	assert stats['Pending'] == 25 and stats['Dropped'] == 5 and stats['Failed'] == 2
+
+	eventLog.db = database
+	eventLog.flush()
+	assert [event['Seq'] for event in eventLog.query(limit=100)] == list(range(30, 5, -1))
+	eventLog.close()
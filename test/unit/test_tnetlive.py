@@ -0,0 +1,106 @@
+"""Unit tests for the live temperature frame decoder."""
+import pytest
+from tnetserver import tnetlive
+
+KEYFRAME = '21.5,30,40,0,0,4.5,8.5,10,1,1,-18.0,-15.5,-12,0,0'
+
+
+def test_parse_sensor_decimal_thresholds():
+	sensor = tnetlive.parse_sensor(['3.1', '4.5', '8.5', '2', '0'])
+	assert sensor == {'temp': 3.1, 'a1': 4.5, 'a2': 8.5, 'alarm': 2, 'stale': False}
+
+
+def test_keyframe():
+	decoder = tnetlive.LiveDecoder()
+	assert not decoder.synced()
+	assert decoder.decode(tnetlive.KEYFRAME_TOPIC, KEYFRAME) == [1, 2, 3]
+	assert decoder.synced()
+
+	sensors = decoder.get_sensors()
+	assert len(sensors) == 3
+	assert sensors[1] == {'temp': 4.5, 'a1': 8.5, 'a2': 10.0, 'alarm': 1, 'stale': True}
+	assert sensors[2]['a1'] == -15.5
+
+
+def test_delta_updates_changed_sensors():
+	decoder = tnetlive.LiveDecoder()
+	decoder.decode(tnetlive.KEYFRAME_TOPIC, KEYFRAME)
+
+	assert decoder.decode(tnetlive.DELTA_TOPIC, '3,-11.0,-15.5,-12,2,0') == [3]
+	assert decoder.decode(tnetlive.DELTA_TOPIC, '1,22.0,30,40,0,0,2,5.0,8.5,10,0,0') == [1, 2]
+
+	sensors = decoder.get_sensors()
+	assert [sensor['temp'] for sensor in sensors] == [22.0, 5.0, -11.0]
+	assert sensors[2]['alarm'] == 2
+	# sensor 2 read again
+	assert not sensors[1]['stale']
+	assert decoder.get_stats()['deltas'] == 2
+
+	# the caller gets a copy
+	sensors[0]['temp'] = 99.0
+	assert decoder.get_sensors()[0]['temp'] == 22.0
+
+
+def test_delta_before_keyframe_dropped():
+	decoder = tnetlive.LiveDecoder()
+	assert decoder.decode(tnetlive.DELTA_TOPIC, '1,22.0,30,40,0,0') is None
+	assert decoder.get_sensors() == []
+	assert decoder.get_stats()['unsynced'] == 1
+
+
+def test_reset_waits_for_keyframe():
+	decoder = tnetlive.LiveDecoder()
+	decoder.decode(tnetlive.KEYFRAME_TOPIC, KEYFRAME)
+
+	# a gap in the stream, deltas can't be applied to what was missed
+	decoder.reset()
+	assert not decoder.synced()
+	assert decoder.decode(tnetlive.DELTA_TOPIC, '1,22.0,30,40,0,0') is None
+
+	assert decoder.decode(tnetlive.KEYFRAME_TOPIC, KEYFRAME) == [1, 2, 3]
+	assert decoder.decode(tnetlive.DELTA_TOPIC, '1,22.0,30,40,0,0') == [1]
+	stats = decoder.get_stats()
+	assert stats['resets'] == 1 and stats['keyframes'] == 2
+
+
+def test_sensor_outside_keyframe_resyncs():
+	decoder = tnetlive.LiveDecoder()
+	decoder.decode(tnetlive.KEYFRAME_TOPIC, KEYFRAME)
+
+	# the network grew since the keyframe
+	assert decoder.decode(tnetlive.DELTA_TOPIC, '4,20.0,30,40,0,0') is None
+	assert not decoder.synced()
+	assert decoder.decode(tnetlive.DELTA_TOPIC, '1,22.0,30,40,0,0') is None
+
+	assert decoder.decode(tnetlive.KEYFRAME_TOPIC, KEYFRAME + ',20.0,30,40,0,0') == [1, 2, 3, 4]
+
+
+@pytest.mark.parametrize('topic, data', [
+	(tnetlive.KEYFRAME_TOPIC, '21.5,30,40,0'),
+	(tnetlive.KEYFRAME_TOPIC, '21.5,thirty,40,0,0'),
+	(tnetlive.DELTA_TOPIC, '1,22.0,30,40,0'),
+	('010', '1,2,3'),
+])
+def test_malformed_frames(topic, data):
+	decoder = tnetlive.LiveDecoder()
+	decoder.decode(tnetlive.KEYFRAME_TOPIC, KEYFRAME)
+	with pytest.raises(ValueError):
+		decoder.decode(topic, data)
+
+
+def test_temperature_stats(monkeypatch):
+	monkeypatch.setattr(tnetlive, 'temperature_stats', tnetlive.TemperatureStats())
+	reply = tnetlive.get_stats({})
+	assert not reply['success']
+
+	stats = tnetlive.parse_stats('{"Scheduler": {"Sweeps": 3, "Jitter": 0.01}}')
+	tnetlive.record_stats(stats, 1700000000.0)
+	reply = tnetlive.get_stats({})
+	assert reply['success']
+	assert reply['data'] == {'time': 1700000000.0, 'stats': {'Scheduler': {'Sweeps': 3, 'Jitter': 0.01}}}
+
+
+@pytest.mark.parametrize('data', ['', '[1, 2]', '{"Scheduler"'])
+def test_malformed_stats(data):
+	with pytest.raises(ValueError):
+		tnetlive.parse_stats(data)
@@ -0,0 +1,104 @@
+"""Unit tests for the system metrics history."""
+import pytest
+from tnetserver import tnetmetrics
+
+# a day boundary so every tier starts a step on it
+START = 1700006400.0
+
+
+def sample(cpu, power=1, memory=50.0):
+	return {'cpu': cpu, 'memory': memory, 'disk': 20, 'battery': 100, 'power': power}
+
+
+@pytest.fixture
+def history(monkeypatch):
+	history = tnetmetrics.MetricsHistory()
+	monkeypatch.setattr(tnetmetrics, 'metrics_history', history)
+	return history
+
+
+def test_minute_tier_mean_and_power_last(history):
+	history.record(sample(10.0, power=1), START)
+	history.record(sample(30.0, power=2), START + 20)
+	history.record(sample(50.0, power=1, memory=None), START + 40)
+	history.record(sample(70.0, power=2), START + 60)
+
+	reply = history.query(START, START + 120)
+	assert reply['step'] == 60
+	assert reply['fields'] == ['time', 'cpu', 'memory', 'disk', 'battery', 'power']
+	first, second = reply['samples']
+	assert first[0] == START
+	assert first[1] == 30.0
+	# a missing value is left out of the mean
+	assert first[2] == 50.0
+	# the power source is the last one reported in the step
+	assert first[5] == 1
+	assert second == [START + 60, 70.0, 50.0, 20, 100, 2]
+
+
+def test_tier_by_range(history):
+	now = START + 10 * 86400
+	history.record(sample(10.0), now)
+
+	assert history.query(now - 3600, now)['step'] == 60
+	assert history.query(now - 86400, now)['step'] == 60
+	assert history.query(now - 86400 - 60, now)['step'] == 900
+	assert history.query(now - 7 * 86400, now)['step'] == 900
+	assert history.query(now - 8 * 86400, now)['step'] == 3600
+	# further back than any tier, the coarsest is used
+	assert history.query(now - 60 * 86400, now)['step'] == 3600
+
+
+def test_tier_by_step(history):
+	history.record(sample(10.0), START)
+	assert history.query(START - 3600, START + 60, step=300)['step'] == 900
+	assert history.query(START - 3600, START + 60, step=7200)['step'] == 3600
+
+
+def test_wrap_around(history):
+	history = tnetmetrics.MetricsHistory(tiers=((60, 5),))
+	for minute in range(8):
+		history.record(sample(float(minute)), START + minute * 60)
+
+	rows = history.query(START, START + 7 * 60)['samples']
+	# the ring keeps the last five minutes, the first three were overwritten
+	assert [row[0] for row in rows] == [START + minute * 60 for minute in range(3, 8)]
+	assert [row[1] for row in rows] == [3.0, 4.0, 5.0, 6.0, 7.0]
+
+	# a slot left from an earlier lap is not returned for its new step
+	assert history.query(START, START + 2 * 60)['samples'] == []
+
+
+def test_range_errors(history):
+	with pytest.raises(ValueError):
+		history.query(START, START)
+	with pytest.raises(ValueError):
+		history.query(START, START + 60, step=0)
+
+
+def test_get_metrics(history):
+	tnetmetrics.record(sample(10.0), START)
+	tnetmetrics.record(sample(20.0), START + 60)
+
+	reply = tnetmetrics.get_metrics({'start': START, 'end': START + 120})
+	assert reply['success'] and reply['error'] == ''
+	assert [row[1] for row in reply['data']['samples']] == [10.0, 20.0]
+	assert reply['data']['latest']['cpu'] == 20.0
+	assert reply['data']['latest']['time'] == START + 60
+
+	for payload in ({'start': START, 'end': START}, {'start': 'yesterday'}, {'start': START, 'end': START + 60, 'step': -1},
+		{'start': 0, 'end': 'inf'}, {'start': '-inf'}, {'start': 'nan', 'end': START}, {'start': START, 'end': START + 60, 'step': 'inf'},
+		[1], None):
+		reply = tnetmetrics.get_metrics(payload)
+		assert not reply['success'] and reply['error'] != ''
+
+
+def test_parse_metrics():
+	now, metrics = tnetmetrics.parse_metrics('1700006400,12.5,40.2,19,87,2')
+	assert now == START
+	assert metrics == {'cpu': 12.5, 'memory': 40.2, 'disk': 19.0, 'battery': 87.0, 'power': 2.0}
+
+	with pytest.raises(ValueError):
+		tnetmetrics.parse_metrics('1700006400,12.5,40.2')
+	with pytest.raises(ValueError):
+		tnetmetrics.parse_metrics('1700006400,busy,40.2,19,87,2')
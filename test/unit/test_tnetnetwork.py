@@ -0,0 +1,274 @@
+"""Unit tests for the gateway route lookups and the network state kept from a fake bus."""
+import sys
+import types
+import threading
+
+import pytest
+
+dbus = pytest.importorskip('dbus')
+pytest.importorskip('gi')
+
+# the hamachi client is only logged in and out on a route change, it isn't imported here
+hamachi = types.ModuleType('tggateway.tgHamachi')
+hamachi.login = hamachi.logout = lambda: None
+sys.modules.setdefault('tggateway.tgHamachi', hamachi)
+
+import tggateway.tgNetwork as tgNetwork
+
+HEADER = 'Iface\tDestination\tGateway \tFlags\tRefCnt\tUse\tMetric\tMask\t\tMTU\tWindow\tIRTT\n'
+LOCAL = 'eth0\t0000A8C0\t00000000\t0001\t0\t0\t0\t00FFFFFF\t0\t0\t0\n'
+DEFAULT = '{}\t00000000\t0100A8C0\t{}\t0\t0\t0\t00000000\t0\t0\t0\n'
+
+
+@pytest.fixture(autouse=True)
+def fresh_cache():
+	tgNetwork.clearLookupCache()
+	yield
+	tgNetwork.clearLookupCache()
+
+
+@pytest.fixture
+def route_file(tmp_path):
+	def write(*rows):
+		path = tmp_path / 'route'
+		path.write_text(HEADER + ''.join(rows))
+		return str(path)
+	return write
+
+
+def test_default_route(route_file):
+	path = route_file(LOCAL, DEFAULT.format('wlan0', '0003'))
+	assert tgNetwork.readDefaultRoute(path) == 'wlan0'
+
+
+def test_default_route_not_up(route_file):
+	# a default route that is down or has no gateway isn't the route out
+	path = route_file(LOCAL, DEFAULT.format('wlan0', '0002'), DEFAULT.format('wwan0', '0001'))
+	assert tgNetwork.readDefaultRoute(path) == ''
+
+
+def test_no_default_route(route_file):
+	assert tgNetwork.readDefaultRoute(route_file(LOCAL)) == ''
+	assert tgNetwork.readDefaultRoute(route_file()) == ''
+
+
+def test_first_default_route(route_file):
+	path = route_file(DEFAULT.format('eth0', '0003'), DEFAULT.format('wwan0', '0003'))
+	assert tgNetwork.readDefaultRoute(path) == 'eth0'
+
+
+def test_cached_lookup():
+	calls = []
+	lookup = lambda: calls.append(1) or 'value'
+
+	assert tgNetwork.cachedLookup('key', lookup) == 'value'
+	assert tgNetwork.cachedLookup('key', lookup) == 'value'
+	assert len(calls) == 1
+
+	tgNetwork.clearLookupCache()
+	assert tgNetwork.cachedLookup('key', lookup) == 'value'
+	assert len(calls) == 2
+
+
+def test_cache_cleared_while_looking_up():
+	# a lookup running while the signal thread clears the cache doesn't hold the lock
+	started = threading.Event()
+	release = threading.Event()
+
+	def lookup():
+		started.set()
+		release.wait(5)
+		return 'value'
+
+	worker = threading.Thread(target=tgNetwork.cachedLookup, args=('key', lookup))
+	worker.start()
+	assert started.wait(5)
+	clearer = threading.Thread(target=tgNetwork.clearLookupCache)
+	clearer.start()
+	clearer.join(5)
+	assert not clearer.is_alive()
+	release.set()
+	worker.join(5)
+	assert tgNetwork.lookupCache['key'][1] == 'value'
+
+
+def test_resolve_connman_route(monkeypatch):
+	monkeypatch.setattr(tgNetwork, 'interfaceAddress', lambda ifname: pytest.fail('looked up ' + ifname))
+	assert tgNetwork.resolveRoute(('wlan', '192.168.1.20')) == ('wlan', '192.168.1.20')
+
+
+def test_resolve_address_from_interface(monkeypatch):
+	addresses = {'eth1': '10.0.0.5'}
+	monkeypatch.setattr(tgNetwork, 'interfaceAddress', addresses.get)
+	assert tgNetwork.resolveRoute(('eth', None)) == ('eth', '10.0.0.5')
+
+
+def test_resolve_kernel_route(monkeypatch, route_file):
+	monkeypatch.setattr(tgNetwork.readDefaultRoute, '__defaults__', (route_file(LOCAL, DEFAULT.format('wwan0', '0003')),))
+	monkeypatch.setattr(tgNetwork, 'interfaceAddress', {'wwan0': '10.64.1.2'}.get)
+	assert tgNetwork.resolveRoute((None, None)) == ('wwan', '10.64.1.2')
+
+
+def test_resolve_unknown_kernel_route(monkeypatch, route_file):
+	monkeypatch.setattr(tgNetwork.readDefaultRoute, '__defaults__', (route_file(DEFAULT.format('tun0', '0003')),))
+	assert tgNetwork.resolveRoute((None, None)) == (None, None)
+
+	tgNetwork.clearLookupCache()
+	monkeypatch.setattr(tgNetwork.readDefaultRoute, '__defaults__', (route_file(LOCAL),))
+	assert tgNetwork.resolveRoute((None, None)) == (None, None)
+
+
+class FakeReceiver(object):
+
+	def __init__(self, bus, key):
+		self.bus = bus
+		self.key = key
+
+	def remove(self):
+		del self.bus.handlers[self.key]
+
+
+class FakeObject(object):
+
+	def __init__(self, bus, service):
+		self.bus = bus
+		self.service = service
+
+	def get_dbus_method(self, member, dbus_interface=None):
+		def method(*args, **kwargs):
+			if self.service not in self.bus.running:
+				raise dbus.exceptions.DBusException('not running', name='org.freedesktop.DBus.Error.ServiceUnknown')
+			return self.bus.replies[member]
+		return method
+
+
+class FakeBus(object):
+	''' connman and oFono answering from fixed replies, signals are sent by calling the handlers '''
+
+	def __init__(self):
+		self.handlers = {}
+		self.running = set([tgNetwork.CONNMAN_SERVICE, tgNetwork.OFONO_SERVICE])
+		self.replies = {'GetServices': [('/wifi_1', {'Type': 'wifi', 'State': 'online', 'IPv4': {'Address': '192.168.1.20'}}),
+										('/ethernet_1', {'Type': 'ethernet', 'State': 'ready', 'IPv4': {'Address': '10.0.0.5'}})],
+						'GetProperties': {'State': 'online'},
+						'GetModems': [('/ril_0', {'Powered': True, 'Online': True})]}
+
+	def add_signal_receiver(self, handler, signal_name=None, dbus_interface=None, arg0=None, **kwargs):
+		key = (dbus_interface, signal_name, arg0)
+		self.handlers[key] = handler
+		return FakeReceiver(self, key)
+
+	def get_object(self, service, path):
+		return FakeObject(self, service)
+
+	def signal(self, interface, name, *args, **kwargs):
+		self.handlers[(interface, name, None)](*args, **kwargs)
+
+
+@pytest.fixture
+def state(monkeypatch):
+	bus = FakeBus()
+	monkeypatch.setattr(tgNetwork.tgutils, 'dbus_cache', tgNetwork.tgutils.DBusCache(lambda: bus))
+	state = tgNetwork.NetworkState(bus=bus)
+	state.start()
+	state.changed.clear()
+	yield state
+	state.stop()
+
+
+def test_state_loaded(state):
+	assert len(state.receivers) == 8
+	assert state.getRoute() == ('wlan', '192.168.1.20')
+	assert state.isOnline()
+	assert state.getOnlineTypes() == set(['wifi'])
+	assert state.wifiOrEthernetOnline()
+	assert list(state.getModems()) == ['/ril_0']
+	stats = state.getStats()
+	assert (stats['Loads'], stats['Services'], stats['Modems']) == (2, 2, 1)
+
+
+def test_state_unsubscribed_on_stop(state):
+	state.stop()
+	# only the proxy cache is still listening for owner changes
+	assert list(state.bus.handlers) == [('org.freedesktop.DBus', 'NameOwnerChanged', None)]
+	assert state.loop is None
+
+
+def test_services_reordered(state):
+	tgNetwork.cachedLookup('eth0', lambda: 'stale')
+	state.bus.signal('net.connman.Manager', 'ServicesChanged',
+		[('/ethernet_1', {'State': 'online'}), ('/wifi_1', {})], [])
+	assert state.getRoute() == ('eth', '10.0.0.5')
+	assert state.changed.is_set()
+	# properties not in the signal are kept
+	assert state.getServices()['/wifi_1']['Type'] == 'wifi'
+	# a route change drops the cached interface lookups
+	assert 'eth0' not in tgNetwork.lookupCache
+
+
+def test_service_removed(state):
+	state.bus.signal('net.connman.Manager', 'ServicesChanged', [('/ethernet_1', {})], ['/wifi_1'])
+	assert list(state.getServices()) == ['/ethernet_1']
+	assert state.getRoute() == (None, None)
+
+
+def test_service_property_moves_route(state):
+	state.bus.signal('net.connman.Service', 'PropertyChanged', 'State', 'online', path='/ethernet_1')
+	assert state.getRoute() == ('wlan', '192.168.1.20')
+	assert not state.changed.is_set()
+
+	state.bus.signal('net.connman.Service', 'PropertyChanged', 'State', 'idle', path='/wifi_1')
+	assert state.getRoute() == ('eth', '10.0.0.5')
+	assert state.changed.is_set()
+
+
+def test_unrelated_property_does_not_wake(state):
+	state.bus.signal('net.connman.Service', 'PropertyChanged', 'Strength', 60, path='/wifi_1')
+	state.bus.signal('net.connman.Service', 'PropertyChanged', 'State', 'idle', path='/unknown')
+	assert not state.changed.is_set()
+	stats = state.getStats()
+	assert (stats['Updates'], stats['Changes']) == (3, 1)
+
+
+def test_manager_state(state):
+	state.bus.signal('net.connman.Manager', 'PropertyChanged', 'State', 'ready')
+	assert not state.isOnline()
+	# the connman state wakes the network thread even without a route change
+	assert state.changed.is_set()
+
+	state.changed.clear()
+	state.bus.signal('net.connman.Manager', 'PropertyChanged', 'OfflineMode', False)
+	assert not state.changed.is_set()
+
+
+def test_modem_signals(state):
+	state.bus.signal('org.ofono.Modem', 'PropertyChanged', 'Manufacturer', 'quectel', path='/ril_0')
+	assert not state.changed.is_set()
+	assert state.getModems()['/ril_0']['Manufacturer'] == 'quectel'
+
+	state.bus.signal('org.ofono.Modem', 'PropertyChanged', 'Online', False, path='/ril_0')
+	assert state.changed.is_set()
+	assert state.getModems()['/ril_0']['Online'] is False
+
+	state.changed.clear()
+	state.bus.signal('org.ofono.Manager', 'ModemRemoved', '/ril_0')
+	assert state.getModems() == {}
+	assert state.changed.is_set()
+
+	state.bus.signal('org.ofono.Manager', 'ModemAdded', '/ril_1', {'Powered': False})
+	assert list(state.getModems()) == ['/ril_1']
+
+
+def test_daemon_restart_reloads(state):
+	# connman stopped, nothing is known until it is back
+	state.bus.running.discard(tgNetwork.CONNMAN_SERVICE)
+	state.bus.handlers[('org.freedesktop.DBus', 'NameOwnerChanged', tgNetwork.CONNMAN_SERVICE)](tgNetwork.CONNMAN_SERVICE, ':1.4', '')
+	assert state.getServices() == {}
+	assert state.getRoute() == (None, None)
+	assert not state.isOnline()
+	assert list(state.getModems()) == ['/ril_0']
+
+	state.bus.running.add(tgNetwork.CONNMAN_SERVICE)
+	state.bus.handlers[('org.freedesktop.DBus', 'NameOwnerChanged', tgNetwork.CONNMAN_SERVICE)](tgNetwork.CONNMAN_SERVICE, '', ':1.9')
+	assert state.getRoute() == ('wlan', '192.168.1.20')
+	assert state.getStats()['Loads'] == 4
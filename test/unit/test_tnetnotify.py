@@ -0,0 +1,182 @@
+"""Unit tests for the gateway notification digests and email templates."""
+import pytest
+
+dbus = pytest.importorskip('dbus')
+import tggateway.tgEvent as tgEvent
+import tggateway.tgNotify as tgNotify
+
+ALARM_DATA = 'Current A2 alarms,3,Freezer,41,30,40,A2 alarm,A2 rising,7,Cool room,-1.5,-4,2.5,A1 alarm,A1 falling'
+NOW = 1000.0
+
+
+class FakeEmail(object):
+
+	def __init__(self):
+		self.sent = []
+
+	def mailRequest(self, addresses, template):
+		self.sent.append((sorted(addresses), template))
+
+
+class FakeSms(object):
+
+	def __init__(self):
+		self.sent = []
+
+	def smsRequest(self, numbers, text):
+		self.sent.append((numbers, text))
+
+
+def record(evTopic, data='', seq=1, evClass=tgEvent.EVCLASS_SYSTEM):
+	return tgEvent.EventRecord(seq, evClass, evTopic, tgEvent.EVENT_PRIORITY_HIGH, data, [], NOW)
+
+
+def user(email, mobile='', *alerts):
+	return {'Email': email, 'Mobile': mobile, 'Alerts': dict((alert, True) for alert in alerts)}
+
+
+@pytest.fixture
+def notification():
+	notification = tgNotify.Notification(email=FakeEmail(), sms=FakeSms())
+	config = {'Email': True, 'Sms': True, 'Users': {
+		'ann': user('ann@test', '0400000001', tgNotify.ALERT_TYPE_POWERON, tgNotify.ALERT_TYPE_ALARM_2),
+		'bob': user('bob@test', '', tgNotify.ALERT_TYPE_POWERON, tgNotify.ALERT_TYPE_ALARM_2),
+		'cat': user('cat@test', '', tgNotify.ALERT_TYPE_POWERON),
+		'dan': user('', '0400000004', tgNotify.ALERT_TYPE_ALARM_2, tgNotify.ALERT_TYPE_DISK_FULL)}}
+	notification.recipients = notification.buildRecipients(config, 'Email', 'Email')
+	notification.smsRecipients = notification.buildRecipients(config, 'Sms', 'Mobile')
+	return notification
+
+
+def test_recipients(notification):
+	assert sorted(notification.recipients[tgNotify.ALERT_TYPE_POWERON]) == ['ann@test', 'bob@test', 'cat@test']
+	assert sorted(notification.smsRecipients[tgNotify.ALERT_TYPE_ALARM_2]) == ['0400000001', '0400000004']
+	assert tgNotify.ALERT_TYPE_DISK_FULL not in notification.recipients
+	assert notification.buildRecipients({'Email': False, 'Users': {}}, 'Email', 'Email') == {}
+
+
+def test_single_alert_sent_now(notification):
+	notification.collect(record(tgEvent.EVTOPIC_SYS_POWERON), NOW)
+	assert notification.nextDue() == NOW
+	notification.flush(NOW)
+
+	# every recipient of the same alert shares one email
+	[(addresses, template)] = notification.email.sent
+	assert addresses == ['ann@test', 'bob@test', 'cat@test']
+	assert template['subject'] == 'POWER ON notification'
+	assert template['body'].startswith('<html><body><h4>Date/time of event: ')
+	assert notification.pending == {}
+
+
+def test_alerts_within_window_digested(notification):
+	notification.collect(record(tgEvent.EVTOPIC_SYS_POWERON, seq=1), NOW)
+	notification.flush(NOW)
+	notification.email.sent = []
+
+	# within the window of the last email the alerts wait for the end of it
+	later = NOW + 2
+	notification.collect(record(tgEvent.EVTOPIC_TEMP_ALRM_A2, ALARM_DATA, seq=2, evClass=tgEvent.EVCLASS_TEMP), later)
+	notification.collect(record(tgEvent.EVTOPIC_SYS_POWERON, seq=3), later)
+	assert notification.nextDue() == NOW + notification.digestWindow
+	notification.flush(later)
+	assert notification.email.sent == []
+
+	notification.flush(NOW + notification.digestWindow)
+	sent = dict((tuple(addresses), template) for addresses, template in notification.email.sent)
+	assert sorted(sent) == [('ann@test', 'bob@test'), ('cat@test',)]
+
+	digest = sent[('ann@test', 'bob@test')]
+	assert digest['subject'] == '2 notifications: ALARM A2 notification, POWER ON notification'
+	assert digest['body'].count(tgNotify.EMAIL_SECTION_SEPARATOR) == 1
+	assert digest['body'].index('Device alarm status') < digest['body'].index(tgNotify.EMAIL_SECTION_SEPARATOR)
+	assert sent[('cat@test',)]['subject'] == 'POWER ON notification'
+
+	stats = notification.getStats()
+	assert (stats['Events'], stats['Emails'], stats['Digests'], stats['Pending']) == (3, 3, 1, 0)
+
+
+def test_force_flush(notification):
+	notification.lastSent['cat@test'] = NOW
+	notification.collect(record(tgEvent.EVTOPIC_SYS_POWERON), NOW + 1)
+	notification.flush(NOW + 1)
+	assert [addresses for addresses, template in notification.email.sent] == [['ann@test', 'bob@test']]
+
+	notification.flush(NOW + 1, force=True)
+	assert notification.email.sent[1][0] == ['cat@test']
+
+
+def test_sms_not_digested(notification):
+	notification.collect(record(tgEvent.EVTOPIC_SYS_DISKFULL), NOW)
+	[(numbers, text)] = notification.sms.sent
+	assert numbers == ['0400000004']
+	assert text.startswith('DISK FULL notification ')
+	# no email subscribers
+	assert notification.pending == {}
+
+
+def test_sms_alarm_text(notification):
+	notification.collect(record(tgEvent.EVTOPIC_TEMP_ALRM_A2, ALARM_DATA, evClass=tgEvent.EVCLASS_TEMP), NOW)
+	text = notification.sms.sent[0][1]
+	assert text.endswith('Current A2 alarms\n3 Freezer 41C A2 rising\n7 Cool room -1.5C A1 falling')
+
+
+def test_unsupported_topic(notification):
+	notification.collect(record(tgEvent.EVTOPIC_SYS_METRICS), NOW)
+	assert notification.pending == {} and notification.sms.sent == []
+
+
+def test_compiled_template():
+	template = tgNotify.CompiledTemplate('Subject', tgNotify.TEMPLATE_CHANGE)
+	assert template.render('now', 'eth0', 'wlan0') == '<h4>Date/time of event: now</h4><h4>Change from eth0 to wlan0</h4>'
+
+
+def test_table_rows():
+	row = tgNotify.CompiledTemplate(None, tgNotify.TEMPLATE_SENSOR_CHANGE_ROW)
+	table = row.table(['1', 'Freezer', '30', '40', '2', 'Fridge', '5', '8'], 4)
+	assert table.count('<tr>') == 2
+	assert table.index('Freezer') < table.index('Fridge')
+	# the table format is kept by row count
+	assert list(row.tables) == [2]
+	assert row.table(['3', 'Cellar', '15', '20', '4', 'Cool room', '2', '4'], 4).count('<tr>') == 2
+	assert list(row.tables) == [2]
+
+
+def test_render_alarm():
+	content = tgNotify.EmailTemplate().render(tgNotify.ALERT_TYPE_ALARM_2, record(tgEvent.EVTOPIC_TEMP_ALRM_A2, ALARM_DATA))
+	assert content.subject == 'ALARM A2 notification'
+	assert '<h4>Device alarm status: Current A2 alarms</h4>' in content.body
+	# columns in header order, trigger before the temperatures
+	assert ('<tr><td align="left">3</td><td align="left">Freezer</td><td align="left">A2 rising</td>'
+		'<td align="left">41C</td><td align="left">30C</td><td align="left">40C</td><td align="left">A2 alarm</td></tr>') in content.body
+	assert content.body.count('<tr><td') == 2
+
+
+def test_render_session_resume():
+	emailTemplate = tgNotify.EmailTemplate()
+	content = emailTemplate.render(tgNotify.ALERT_TYPE_SESSION_RESUME, record(tgEvent.EVTOPIC_TEMP_RESUME_SESH, '3,Cellar,A1,10,1,Freezer,30,40'))
+	assert '<h4>Session alias: Cellar</h4><h4>Trigger rate: 10</h4><h4>Sensor changes:</h4>' in content.body
+	assert '<td align="left">Freezer</td>' in content.body
+
+	# no sensor changes, no table
+	content = emailTemplate.render(tgNotify.ALERT_TYPE_SESSION_RESUME, record(tgEvent.EVTOPIC_TEMP_RESUME_SESH, '3,Cellar,A1,10'))
+	assert content.body.endswith('<h4>Trigger rate: 10</h4>')
+
+
+@pytest.mark.parametrize('alertType, data', [(tgNotify.ALERT_TYPE_ALARM_1, 'Current A1 alarms,3,Freezer'),
+	(tgNotify.ALERT_TYPE_ALARM_1, 'Current A1 alarms'), (tgNotify.ALERT_TYPE_POWERCHANGE, 'mains'),
+	(tgNotify.ALERT_TYPE_SESSION_RESUME, '3,Cellar,A1,10,1,Freezer')])
+def test_render_malformed(alertType, data):
+	assert tgNotify.EmailTemplate().render(alertType, record('', data)) is None
+
+
+def test_malformed_alert_left_out_of_digest(notification):
+	notification.collect(record(tgEvent.EVTOPIC_TEMP_ALRM_A2, 'Current A2 alarms,3', seq=1, evClass=tgEvent.EVCLASS_TEMP), NOW)
+	notification.collect(record(tgEvent.EVTOPIC_SYS_POWERON, seq=2), NOW)
+	notification.flush(NOW)
+	subjects = [template['subject'] for addresses, template in notification.email.sent]
+	assert subjects == ['POWER ON notification', 'POWER ON notification']
+
+
+def test_benchmark_templates():
+	results = tgNotify.benchmarkTemplates(rows=5, count=10)
+	assert set(results) == set(tgNotify.EmailTemplate().templates)
@@ -0,0 +1,171 @@
+"""Unit tests for the simulated 1-wire bus driving the temperature manager."""
+import time
+
+import pytest
+import tggateway.tgEvent as tgEvent
+import tggateway.tgTemperature as tgTemperature
+import tggateway.tgSimBus as tgSimBus
+
+
+@pytest.fixture
+def simulations():
+	sims = []
+	def make(controllers, **kwargs):
+		sim = tgSimBus.Simulation(controllers, config=tgSimBus.simConfig(controllers, **kwargs))
+		sims.append(sim)
+		return sim
+	yield make
+	for sim in sims:
+		sim.close()
+
+
+def test_controller_reads():
+	controller = tgSimBus.SimController(3, temperature=21.4)
+	assert controller.state() < 0
+	controller.acquire()
+	assert controller.serial(2) == 'SIM000002'
+	assert controller.temperature('SIM000002') == 21
+	assert controller.temperature('OTHER') == tgTemperature.CONTROLLER_READ_FAIL
+
+	controller.setFault('SIM000001')
+	assert controller.temperature('SIM000001') == tgTemperature.CONTROLLER_READ_FAIL
+	controller.setFault('SIM000001', False)
+	assert controller.temperature('SIM000001') == 21
+	assert (controller.reads, controller.failedReads) == (4, 2)
+
+
+def test_noise_and_faults_repeatable():
+	def readings(seed):
+		controller = tgSimBus.SimController(1, noise=2.0, faultRate=0.3, seed=seed)
+		return [controller.temperature('SIM000001') for i in range(50)]
+
+	assert readings(1) == readings(1)
+	values = readings(1)
+	assert tgTemperature.CONTROLLER_READ_FAIL in values
+	assert len(set(values)) > 2
+
+
+def test_ramp_and_crossing():
+	controller = tgSimBus.SimController(1)
+	serial = controller.serial(1)
+	start = controller.addRamp(serial, 40, 10, delay=100)
+	sensor = controller.sensors[serial]
+	assert sensor.value(start - 1) == tgSimBus.SIM_BASE_TEMPERATURE
+	assert sensor.value(start + 5) == 30
+	assert sensor.value(start + 20) == 40
+	assert controller.crossingTime(serial, 35) == pytest.approx(start + 7.5)
+	assert controller.crossingTime(serial, 50) is None
+
+
+def test_sweep_reads_every_sensor(simulations):
+	controller = tgSimBus.SimController(5)
+	sim = simulations(controller)
+	sim.sweep()
+	assert controller.reads == 5
+	assert [sensor.getTemperature() for sensor in sim.temperature.sensors] == [20] * 5
+	assert sim.eventMgr.first(tgEvent.EVTOPIC_TEMP_NEW_DATA) is not None
+
+
+def test_ramp_through_alarms(simulations):
+	controller = tgSimBus.SimController(4)
+	sim = simulations(controller)
+	serial = controller.serial(4)
+	# already above A1, A2 reached within the ramp
+	controller.addRamp(serial, tgSimBus.SIM_A2 + 4, 0.2, fromTemp=tgSimBus.SIM_A1 + 2)
+
+	sim.sweep()
+	a1 = sim.eventMgr.first(tgEvent.EVTOPIC_TEMP_ALRM_A1)
+	assert a1 is not None
+	assert sim.temperature.getGlobalAlarmState() == tgTemperature.ALARM_STATE_CURRENT_A1
+
+	# near the thresholds the sensor is sampled at the fast period, a quarter of the session
+	# period, so one reading of debounce at the session period is four readings
+	time.sleep(0.25)
+	for sweep in range(3):
+		sim.sweep()
+	assert sim.eventMgr.first(tgEvent.EVTOPIC_TEMP_ALRM_A2) is None
+	sim.sweep()
+	a2 = sim.eventMgr.first(tgEvent.EVTOPIC_TEMP_ALRM_A2)
+	assert a2 is not None
+	assert a2[3].startswith('Current A2 alarms,4,Sim 4,44,')
+	assert sim.temperature.getGlobalAlarmState() == tgTemperature.ALARM_STATE_CURRENT_A2
+	# the buzzer follows the global state
+	assert sim.eventMgr.first(tgEvent.EVTOPIC_AUV_STATE_A2) is not None
+
+
+def test_fault_injection_raises_fault_events(simulations):
+	controller = tgSimBus.SimController(2, faultRate=1.0, seed=1)
+	sim = simulations(controller)
+	for sweep in range(tgTemperature.SENSOR_FAULT_READS):
+		sim.sweep()
+	assert sim.eventMgr.first(tgEvent.EVTOPIC_TEMP_SENSOR_FAULT) is not None
+	assert sim.eventMgr.first(tgEvent.EVTOPIC_TEMP_NO_SENSORS) is not None
+	assert sim.eventMgr.first(tgEvent.EVTOPIC_TEMP_ALRM_A1) is None
+
+
+def test_benchmark_sweep():
+	assert tgSimBus.benchmarkSweep(20, sweeps=2) > 0
+
+
+def buses(count, sensorsPerBus=3, latency=0.0):
+	return [tgSimBus.SimController(sensorsPerBus, latency=latency, seed=bus, first=bus*sensorsPerBus+1) for bus in range(count)]
+
+
+def test_buses_merged_into_one_session(simulations):
+	controllers = buses(3)
+	sim = simulations(controllers)
+	assert len(sim.temperature.workers) == 3
+	assert [sensor.getBus() for sensor in sim.temperature.sensors] == [0, 0, 0, 1, 1, 1, 2, 2, 2]
+	assert sim.temperature.sensors[4].getSerial() == 'SIM000005'
+
+	controllers[2].sensors['SIM000008'].temperature = tgSimBus.SIM_A1 + 2
+	sim.sweep()
+	assert [controller.reads for controller in controllers] == [3, 3, 3]
+	assert sim.temperature.getGlobalAlarmState() == tgTemperature.ALARM_STATE_CURRENT_A1
+	assert sim.eventMgr.first(tgEvent.EVTOPIC_TEMP_ALRM_A1)[3].startswith('Current A1 alarms,8,Sim 8,')
+	# one keyframe of the whole network in position order
+	data = sim.eventMgr.first(tgEvent.EVTOPIC_TEMP_NEW_DATA)[3].split(',')
+	assert len(data) == 9 * 5
+	assert data[7*5] == '32.0'
+
+
+def test_buses_read_concurrently():
+	single = tgSimBus.benchmarkBuses(5, 1, sweeps=2, latency=0.01)
+	several = tgSimBus.benchmarkBuses(5, 4, sweeps=2, latency=0.01)
+	assert several < 2 * single
+
+
+class DeadController(tgSimBus.SimController):
+
+	def __init__(self, *args, **kwargs):
+		super(DeadController, self).__init__(*args, **kwargs)
+		self.resets = 0
+
+	def acquire(self):
+		self.ctlHandle = -1
+
+	def temperature(self, sensorSerial):
+		return tgTemperature.CONTROLLER_READ_FAIL
+
+	def reset(self):
+		self.resets += 1
+		super(DeadController, self).reset()
+
+
+def test_dead_bus_isolated(simulations):
+	controllers = buses(2)
+	controllers[1] = DeadController(3, first=4)
+	sim = simulations(controllers)
+
+	assert sim.temperature.checkControllers(100)
+	assert controllers[1].resets == 1
+	# retried once per retry period
+	assert sim.temperature.checkControllers(101)
+	assert controllers[1].resets == 1
+	sim.temperature.checkControllers(100 + tgTemperature.CONTROLLER_RETRY_PERIOD)
+	assert controllers[1].resets == 2
+
+	for sweep in range(tgTemperature.SENSOR_FAULT_READS):
+		sim.sweep()
+	assert [sensor.isFaulty() for sensor in sim.temperature.sensors] == [False] * 3 + [True] * 3
+	assert sim.eventMgr.first(tgEvent.EVTOPIC_TEMP_NO_SENSORS) is None
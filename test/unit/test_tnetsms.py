@@ -0,0 +1,126 @@
+"""Unit tests for the gateway sms module against a fake oFono bus."""
+import pytest
+
+dbus = pytest.importorskip('dbus')
+import tggateway.tgSms as tgSms
+
+MODEM_PATH = '/ril_0'
+
+
+class FakeEvents(object):
+
+	def __init__(self):
+		self.events = []
+
+	def raiseEvent(self, *args, **kwargs):
+		self.events.append(args)
+
+
+class FakeObject(object):
+
+	def __init__(self, bus, path):
+		self.bus = bus
+		self.path = path
+
+	def GetModems(self, dbus_interface=None):
+		self.bus.lookups += 1
+		return [('/hfp_0', {'Interfaces': []}), (MODEM_PATH, {'Interfaces': [tgSms.OFONO_MESSAGE_MANAGER]})]
+
+	def SendMessage(self, number, message, dbus_interface=None):
+		if self.bus.failures:
+			self.bus.failures -= 1
+			raise dbus.exceptions.DBusException('org.freedesktop.DBus.Error.UnknownObject')
+		self.bus.sent.append((number, message))
+
+
+class FakeBus(object):
+
+	def __init__(self, failures=0):
+		self.failures = failures
+		self.lookups = 0
+		self.sent = []
+
+	def get_object(self, service, path):
+		assert service == tgSms.OFONO_SERVICE
+		return FakeObject(self, path)
+
+
+def make_sms(failures=0):
+	bus = FakeBus(failures)
+	return tgSms.Sms(FakeEvents(), bus=bus), bus
+
+
+def test_segments():
+	assert tgSms.smsSegments('a' * 160) == 1
+	assert tgSms.smsSegments('a' * 161) == 2
+	assert tgSms.smsSegments('a' * 306) == 2
+	# an extension character takes two septets
+	assert tgSms.smsSegments('€' * 80) == 1
+	assert tgSms.smsSegments('€' * 81) == 2
+	# anything outside the GSM alphabet needs UCS-2
+	assert tgSms.smsSegments('°' * 70) == 1
+	assert tgSms.smsSegments('°' * 71) == 2
+
+
+def test_fit():
+	text = 'a' * 1000
+	fitted = tgSms.smsFit(text)
+	assert fitted.endswith(tgSms.SMS_TRUNCATED)
+	assert tgSms.smsSegments(fitted) == tgSms.SMS_MAX_SEGMENTS
+	assert len(fitted) == tgSms.SMS_GSM_CONCAT_SEGMENT * tgSms.SMS_MAX_SEGMENTS
+	assert tgSms.smsFit('short') == 'short'
+
+
+def test_rate_limit_holds_and_combines():
+	sms, bus = make_sms()
+	now = 1000.0
+
+	for i in range(tgSms.SMS_RATE_COUNT):
+		sms.deliver('0400', ['alarm {}'.format(i)], now + i)
+	assert len(bus.sent) == tgSms.SMS_RATE_COUNT
+
+	sms.deliver('0400', ['held 1'], now + 10)
+	sms.deliver('0400', ['held 2'], now + 11)
+	assert len(bus.sent) == tgSms.SMS_RATE_COUNT
+	assert sms.getStats()['Held'] == 2
+
+	# another recipient is not limited
+	sms.deliver('0500', ['other'], now + 12)
+	assert bus.sent[-1] == ('0500', 'other')
+
+	# once the period has passed the held texts go out in one message, newest first
+	later = now + tgSms.SMS_RATE_PERIOD + 1
+	assert sms.allowed('0400', later)
+	sms.deliver('0400', sms.held.pop('0400') + ['new'], later)
+	assert bus.sent[-1] == ('0400', 'new\nheld 2\nheld 1')
+	assert sms.getStats()['Combined'] == 2
+
+
+def test_truncation_drops_oldest():
+	sms, bus = make_sms()
+	old = 'old ' * 100
+	sms.deliver('0400', [old, old, 'newest alarm'], 1000.0)
+
+	number, message = bus.sent[-1]
+	assert message.startswith('newest alarm\n')
+	assert message.endswith(tgSms.SMS_TRUNCATED)
+	assert sms.getStats()['Truncated'] == 1
+
+
+def test_proxy_cached_and_looked_up_again():
+	sms, bus = make_sms()
+	assert sms.send('0400', 'one')
+	assert sms.send('0400', 'two')
+	assert bus.lookups == 1
+
+	# a stale proxy is dropped and looked up once more
+	bus.failures = 1
+	assert sms.send('0400', 'three')
+	assert bus.lookups == 2
+	assert bus.sent[-1] == ('0400', 'three')
+
+	# failing again after the new lookup gives up and raises an event
+	bus.failures = 2
+	assert not sms.send('0400', 'four')
+	assert sms.getStats()['Failed'] == 1
+	assert sms.eventMgr.events[-1][1] == tgSms.tgEvent.EVTOPIC_SMS_SEND_FAIL
@@ -0,0 +1,105 @@
+"""Unit tests for the gateway stream client against the gateway streamer."""
+import time
+import queue
+import pytest
+from tnetserver import tnetstream
+import tggateway.tgStreamer as tgStreamer
+
+
+def test_parse_frames():
+	frames, rest = tnetstream.parse_frames(b'<TMP:009:2:21.5,30,40,0>12<SYS:106:2:1,2>13<TMP:01')
+	assert frames == [(None, 'TMP', '009', '2', '21.5,30,40,0'), (12, 'SYS', '106', '2', '1,2')]
+	assert rest == b'13<TMP:01'
+
+	# the rest of a frame split across reads
+	frames, rest = tnetstream.parse_frames(rest + b'2:2:1,22.0,30,40,0>')
+	assert frames == [(13, 'TMP', '012', '2', '1,22.0,30,40,0')]
+	assert rest == b''
+
+
+def test_parse_frames_data_with_colon():
+	frames, rest = tnetstream.parse_frames(b'7<EVT:800:1:TMP,010,3,60,12:30>')
+	assert frames == [(7, 'EVT', '800', '1', 'TMP,010,3,60,12:30')]
+
+
+def test_parse_gap_frame():
+	frames, rest = tnetstream.parse_frames(tgStreamer.STREAMER_GAP_FRAME.format(40).encode() + b'40<TMP:009:2:1.0,2,3,0>')
+	assert frames[0] == (None, tnetstream.GAP_CLASS, tnetstream.GAP_TOPIC, '2', '40')
+	assert frames[1][0] == 40
+
+
+def test_parse_drops_garbage():
+	frames, rest = tnetstream.parse_frames(b'x' * (tnetstream.STREAM_MAX_FRAME + 1))
+	assert frames == [] and rest == b''
+
+
+@pytest.fixture
+def streamer(tmp_path):
+	journal = tgStreamer.StreamJournal(path=str(tmp_path / 'stream.journal'))
+	streamer = tgStreamer.Streamer(host='127.0.0.1', port=0, journal=journal)
+	streamer.start()
+	yield streamer
+	streamer.stop()
+	journal.close()
+
+
+def subscribed(streamer):
+	return any(client.topics and client.sequenced for client in streamer.clients)
+
+
+def wait_for(condition, timeout=5):
+	end = time.time() + timeout
+	while time.time() < end:
+		if condition():
+			return True
+		time.sleep(0.01)
+	return False
+
+
+def test_subscribe_and_resume(streamer):
+	received = queue.Queue()
+	stream = tnetstream.GatewayStream(lambda *frame: received.put(frame), ['TMP:009'],
+		host='127.0.0.1', port=streamer.port, retry=0.1)
+	stream.start()
+	try:
+		# connecting without a sequence to resume from starts with a gap
+		assert received.get(timeout=5) == (tnetstream.GAP_CLASS, tnetstream.GAP_TOPIC, '')
+		assert wait_for(lambda: subscribed(streamer))
+
+		streamer.publish('TMP', '012', b'<TMP:012:2:1,22.0,30,40,0>')
+		streamer.publish('TMP', '009', b'<TMP:009:2:21.5,4.5,8.5,0>')
+		assert received.get(timeout=5) == ('TMP', '009', '21.5,4.5,8.5,0')
+		assert stream.get_stats()['last_seq'] == 2
+
+		# frames published while disconnected are replayed after the reconnect
+		for client in list(streamer.clients):
+			streamer.loop.call_soon_threadsafe(streamer.evict, client, 'test')
+		assert wait_for(lambda: streamer.getStats()['Clients'] == 0)
+		streamer.publish('TMP', '009', b'<TMP:009:2:22.0,4.5,8.5,0>')
+
+		assert received.get(timeout=5) == ('TMP', '009', '22.0,4.5,8.5,0')
+		stats = stream.get_stats()
+		assert stats['connects'] == 2 and stats['gaps'] == 1 and stats['last_seq'] == 3
+		assert streamer.getStats()['Resumed'] == 1
+	finally:
+		stream.stop()
+
+
+def test_handler_error_keeps_stream(streamer):
+	received = queue.Queue()
+
+	def handler(ev_class, ev_topic, data):
+		if data == 'bad':
+			raise ValueError(data)
+		received.put(data)
+
+	stream = tnetstream.GatewayStream(handler, ['SYS'], host='127.0.0.1', port=streamer.port)
+	stream.start()
+	try:
+		assert wait_for(lambda: subscribed(streamer))
+		streamer.publish('SYS', '106', b'<SYS:106:2:bad>')
+		streamer.publish('SYS', '106', b'<SYS:106:2:good>')
+		assert received.get(timeout=5) == ''
+		assert received.get(timeout=5) == 'good'
+	finally:
+		stream.stop()
@@ -0,0 +1,151 @@
+"""Unit tests for the gateway streamer subscriptions and resume over a local socket."""
+import time
+import socket
+
+import pytest
+import tggateway.tgStreamer as tgStreamer
+
+
+@pytest.fixture
+def streamers(tmp_path):
+	started = []
+	def make(**kwargs):
+		journal = tgStreamer.StreamJournal(path=str(tmp_path / 'stream.journal'), **kwargs)
+		streamer = tgStreamer.Streamer(host='127.0.0.1', port=0, journal=journal)
+		streamer.start()
+		started.append(streamer)
+		return streamer
+	yield make
+	for streamer in started:
+		streamer.stop()
+		streamer.journal.close()
+
+
+@pytest.fixture
+def connect(streamers):
+	sockets = []
+	def make(streamer, commands):
+		sock = socket.create_connection(('127.0.0.1', streamer.port), timeout=5)
+		sockets.append(sock)
+		sock.sendall(commands.encode())
+		return sock
+	yield make
+	for sock in sockets:
+		sock.close()
+
+
+def wait_for(condition, timeout=5):
+	end = time.time() + timeout
+	while time.time() < end:
+		if condition():
+			return True
+		time.sleep(0.01)
+	return False
+
+
+# the only client of the streamer once it has its subscriptions and resume
+def client(streamer, *topics):
+	def ready():
+		clients = list(streamer.clients)
+		return len(clients) == 1 and clients[0].sequenced and clients[0].topics is not None \
+			and all(topic in clients[0].topics for topic in topics)
+	assert wait_for(ready)
+	return list(streamer.clients)[0]
+
+
+def receive(sock, frames):
+	data = b''
+	while data.count(b'>') < frames:
+		chunk = sock.recv(4096)
+		assert chunk, 'connection closed after {!r}'.format(data)
+		data += chunk
+	return data
+
+
+def test_subscribed_topics_only(streamers, connect):
+	streamer = streamers()
+	sock = connect(streamer, 'SUB TMP:009\nSUB SYS\nRESUME\n')
+	client(streamer, 'TMP:009', 'SYS')
+
+	streamer.publish('TMP', '012', b'<TMP:012:2:1,22.0,30,40,0,0>')
+	streamer.publish('TMP', '009', b'<TMP:009:2:21.5,4.5,8.5,0>')
+	streamer.publish('SYS', '108', b'<SYS:108:3:{}>')
+	# sequenced by the journal, so the unsubscribed event still takes a number
+	assert receive(sock, 2) == b'2<TMP:009:2:21.5,4.5,8.5,0>3<SYS:108:3:{}>'
+
+
+def test_unsubscribe(streamers, connect):
+	streamer = streamers()
+	sock = connect(streamer, 'SUB TMP:009\nSUB SYS\nUNSUB TMP:009\nRESUME\n')
+	assert client(streamer, 'SYS').topics == {'SYS'}
+
+	streamer.publish('TMP', '009', b'<TMP:009:2:21.5,4.5,8.5,0>')
+	streamer.publish('SYS', '106', b'<SYS:106:2:1,2>')
+	assert receive(sock, 1) == b'2<SYS:106:2:1,2>'
+
+
+def test_unsequenced_without_resume(streamers, connect):
+	streamer = streamers()
+	sock = connect(streamer, 'SUB TMP\n')
+	assert wait_for(lambda: any(client.topics for client in streamer.clients))
+
+	streamer.publish('TMP', '009', b'<TMP:009:2:21.5,4.5,8.5,0>')
+	assert receive(sock, 1) == b'<TMP:009:2:21.5,4.5,8.5,0>'
+
+
+def test_resume_replays_missed(streamers, connect):
+	streamer = streamers()
+	for value in range(1, 5):
+		streamer.publish('TMP', '009', '<TMP:009:2:{}>'.format(value).encode())
+	streamer.publish('SYS', '106', b'<SYS:106:2:1,2>')
+
+	sock = connect(streamer, 'SUB TMP:009\nRESUME 2\n')
+	# replayed from the journal, then live after it
+	assert receive(sock, 2) == b'3<TMP:009:2:3>4<TMP:009:2:4>'
+	client(streamer, 'TMP:009')
+	streamer.publish('TMP', '009', b'<TMP:009:2:6>')
+	assert receive(sock, 1) == b'6<TMP:009:2:6>'
+
+	stats = streamer.getStats()
+	assert (stats['Resumed'], stats['Replayed'], stats['Gaps']) == (1, 2, 0)
+
+
+def test_resume_up_to_date(streamers, connect):
+	streamer = streamers()
+	streamer.publish('TMP', '009', b'<TMP:009:2:1>')
+	sock = connect(streamer, 'SUB TMP\nRESUME 1\n')
+	assert client(streamer, 'TMP').lastSeq == 1
+
+	streamer.publish('TMP', '009', b'<TMP:009:2:2>')
+	assert receive(sock, 1) == b'2<TMP:009:2:2>'
+	assert streamer.getStats()['Gaps'] == 0
+
+
+def test_resume_past_journal_sends_gap(streamers, connect):
+	# every record rotates the file, so only the last event is kept on disk and two in the ring
+	streamer = streamers(ringSize=2, segmentSize=1)
+	for value in range(1, 6):
+		streamer.publish('TMP', '009', '<TMP:009:2:{}>'.format(value).encode())
+
+	sock = connect(streamer, 'SUB TMP\nRESUME 1\n')
+	# the gap carries the oldest sequence replayed, events 2 to 4 are lost
+	assert receive(sock, 2) == tgStreamer.STREAMER_GAP_FRAME.format(5).encode() + b'5<TMP:009:2:5>'
+	assert streamer.getStats()['Gaps'] == 1
+
+
+def test_journal_reloaded(tmp_path):
+	path = str(tmp_path / 'stream.journal')
+	journal = tgStreamer.StreamJournal(path=path)
+	for value in range(1, 4):
+		journal.append('TMP', '009', '<TMP:009:2:{}>'.format(value).encode())
+	journal.close()
+
+	# a record cut short by a crash is dropped and numbering continues after the last whole one
+	with open(path, 'ab') as f:
+		f.write(b'4 TMP 009 13\n<TMP:0')
+	journal = tgStreamer.StreamJournal(path=path)
+	assert journal.lastSeq == 3
+	assert journal.append('TMP', '009', b'<TMP:009:2:4>') == 4
+	entries, complete = journal.since(2)
+	assert complete and [entry[0] for entry in entries] == [3, 4]
+	journal.close()
@@ -0,0 +1,151 @@
+"""Unit tests for the gateway metrics collector on fixture procfs files."""
+import os
+import collections
+
+import pytest
+import tggateway.tgEvent as tgEvent
+import tggateway.tgSystem as tgSystem
+
+STAT = '''\
+cpu  {} 0 {} {} {} 0 0 0 {} 0
+cpu0 {} 0 {} {} {} 0 0 0 0 0
+cpu1 {} 0 {} {} {} 0 0 0 0 0
+intr 114930548 113199788 3 0 5 263
+ctxt 1990473
+'''
+
+MEMINFO = '''\
+MemTotal:        1000000 kB
+MemFree:          200000 kB
+MemAvailable:     600000 kB
+Buffers:           50000 kB
+Cached:           150000 kB
+HugePages_Total:       0
+'''
+
+StatVfs = collections.namedtuple('StatVfs', 'f_blocks f_bfree f_bavail')
+
+
+def stat(cpu0, cpu1, guest=0):
+	''' user, system, idle and iowait of two cores, the cpu line is their sum '''
+	total = [a + b for a, b in zip(cpu0, cpu1)]
+	return STAT.format(*(total + [guest] + list(cpu0) + list(cpu1)))
+
+
+@pytest.fixture
+def proc(tmp_path, monkeypatch):
+	files = {}
+	for name, content in (('PROC_STAT', stat((100, 50, 400, 0), (100, 50, 400, 0))), ('PROC_MEMINFO', MEMINFO),
+			('PROC_UPTIME', '12345.67 40000.00\n')):
+		files[name] = tmp_path / name.lower()
+		files[name].write_text(content)
+		monkeypatch.setattr(tgSystem, name, str(files[name]))
+	monkeypatch.setattr(tgSystem.os, 'statvfs', lambda path: StatVfs(1000, 300, 250))
+	return files
+
+
+@pytest.fixture
+def collector(proc):
+	collector = tgSystem.MetricsCollector(interval=60, size=3)
+	yield collector
+	collector.close()
+
+
+def test_first_sample_primes(collector):
+	assert collector.collect(100) is None
+	assert collector.latest() is None
+	assert collector.getStats()['Samples'] == 0
+
+
+def test_cpu_since_last_sample(collector, proc):
+	collector.collect(100)
+	proc['PROC_STAT'].write_text(stat((150, 50, 450, 0), (110, 70, 450, 20), guest=30))
+	sample = collector.collect(160)
+	# 80 of 200 ticks busy, 50 of 100 on core 0 and 30 of 100 on core 1, guest is already in user
+	assert sample.cpu == pytest.approx(40.0)
+	assert sample.cores == pytest.approx([50.0, 30.0])
+
+	# no time passed
+	assert collector.collect(220).cpu == 0.0
+
+
+def test_cores_in_number_order(collector, proc):
+	lines = ['cpu  0 0 0 0 0 0 0 0 0 0'] + ['cpu{} 0 0 0 {} 0 0 0 0 0 0'.format(core, core) for core in (0, 10, 2, 1)]
+	proc['PROC_STAT'].write_text('\n'.join(lines) + '\n')
+	collector.collect(100)
+	lines[2] = 'cpu10 100 0 0 10 0 0 0 0 0 0'
+	proc['PROC_STAT'].write_text('\n'.join(lines) + '\n')
+	assert collector.collect(160).cores == [0.0, 0.0, 0.0, 100.0]
+
+
+def test_memory_disk_uptime(collector, proc):
+	collector.collect(100)
+	sample = collector.collect(160)
+	# buffers and cache count as free
+	assert sample.memory == pytest.approx(40.0)
+	# 700 of 950 blocks usable by users, rounded up
+	assert sample.disk == 74
+	assert sample.uptime == pytest.approx(12345.67)
+
+
+def test_memory_without_available(collector, proc):
+	proc['PROC_MEMINFO'].write_text(''.join(line + '\n' for line in MEMINFO.splitlines() if not line.startswith('MemAvailable')))
+	assert collector.readMemory() == pytest.approx(60.0)
+	proc['PROC_MEMINFO'].write_text('MemTotal: 0 kB\n')
+	assert collector.readMemory() == 0.0
+
+
+def test_files_kept_open(collector, proc):
+	for now in range(100, 400, 60):
+		proc['PROC_UPTIME'].write_text('{}.00 0.00\n'.format(now))
+		collector.collect(now)
+	assert collector.latest().uptime == 340.0
+	assert collector.getStats()['Opens'] == 3
+
+
+def test_unreadable_sample(collector, proc):
+	collector.collect(100)
+	proc['PROC_UPTIME'].write_text('')
+	assert collector.collect(160) is None
+	os.remove(str(proc['PROC_MEMINFO']))
+	collector.meminfo.close()
+	assert collector.collect(220) is None
+	stats = collector.getStats()
+	assert (stats['Samples'], stats['Errors']) == (0, 2)
+
+
+def test_ring_and_history(collector):
+	# the first sample is due at once
+	assert collector.due(1700000000)
+	for now in (100, 160, 220, 280, 340):
+		collector.collect(now)
+	assert not collector.due(399) and collector.due(400)
+	# the ring keeps the last three, the first call only primed the counters
+	assert [sample.time for sample in collector.history()] == [220, 280, 340]
+	assert [sample.time for sample in collector.history(since=220)] == [280, 340]
+	assert collector.getStats()['Ring'] == 3
+
+
+class FakeEvents(object):
+
+	def __init__(self):
+		self.events = []
+
+	def raiseEvent(self, *args, **kwargs):
+		self.events.append(args)
+
+
+def test_system_streams_samples(collector, proc):
+	eventMgr = FakeEvents()
+	system = tgSystem.System(eventMgr=eventMgr, metrics=collector)
+	system.metricsCheck(100)
+	assert eventMgr.events == []
+
+	proc['PROC_STAT'].write_text(stat((150, 50, 450, 0), (110, 70, 450, 20)))
+	system.metricsCheck(130)
+	assert eventMgr.events == []
+	system.metricsCheck(160)
+	[(evClass, evTopic, data, priority, actions)] = eventMgr.events
+	assert (evClass, evTopic) == (tgEvent.EVCLASS_SYSTEM, tgEvent.EVTOPIC_SYS_METRICS)
+	assert data == '160,40.0,40.0,74,100,0'
+	assert (system.cpu, system.memory, system.disk, system.uptime) == (40, 40, 74, 12345)
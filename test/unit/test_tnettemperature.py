@@ -0,0 +1,340 @@
+"""Unit tests for the temperature sample scheduler, sensor health and trigger journal."""
+import json
+
+import pytest
+import tggateway.tgEvent as tgEvent
+import tggateway.tgTemperature as tgTemperature
+import tggateway.tgSimBus as tgSimBus
+
+NOW = 1000.0
+
+
+def session(totalSensors=20, **kwargs):
+	session = {'TotalSensors': totalSensors}
+	session.update(kwargs)
+	return session
+
+
+def make_sensor(temperature=20, a1=30, a2=40):
+	sensor = tgTemperature.Sensor()
+	sensor.setConfig(1, {'Serial': 'S1', 'Alias': 'S1', 'Bus': 0, 'A1': a1, 'A2': a2,
+						'Diffmode': 0, 'A1trig': False, 'A2trig': False})
+	sensor.setTemperature(temperature)
+	sensor.setTemperature(temperature)
+	sensor.processAlarm(tgTemperature.ALARM_TYPE_HIGH_HIGH, 1)
+	return sensor
+
+
+@pytest.fixture
+def scheduler():
+	scheduler = tgTemperature.SampleScheduler()
+	scheduler.configure(session(SamplePeriod=4))
+	return scheduler
+
+
+def test_periods_from_session():
+	scheduler = tgTemperature.SampleScheduler()
+	scheduler.configure(session(totalSensors=5))
+	assert scheduler.period == tgTemperature.SAMPLE_PERIOD_SMALL_NETWORK
+
+	scheduler.configure(session(SamplePeriod=100))
+	assert scheduler.period == tgTemperature.SAMPLE_PERIOD_MAX
+	assert scheduler.slowPeriod == tgTemperature.SAMPLE_PERIOD_MAX
+
+	scheduler.configure(session(SamplePeriod=4))
+	assert (scheduler.fastPeriod, scheduler.period, scheduler.slowPeriod) == (1, 4, 16)
+
+
+def test_deadlines(scheduler):
+	sensors = [make_sensor(), make_sensor()]
+	assert scheduler.dueSensors(sensors, NOW) == sensors
+	scheduler.reschedule(sensors, sensors, NOW)
+	assert [sensor.nextSample for sensor in sensors] == [NOW + 4, NOW + 4]
+	assert scheduler.logDue(NOW)
+	assert scheduler.delay(NOW + 1) == 3
+
+	# within the slack of the deadline is due, earlier is not
+	assert scheduler.dueSensors(sensors, NOW + 3) == []
+	assert scheduler.dueSensors(sensors, NOW + 4 - tgTemperature.SAMPLE_SLACK / 2) == sensors
+
+	# a late sweep stays on the grid, one that overran a whole period starts a new one
+	scheduler.reschedule(sensors, sensors[:1], NOW + 5)
+	assert sensors[0].nextSample == NOW + 8
+	scheduler.reschedule(sensors, sensors[:1], NOW + 20)
+	assert sensors[0].nextSample == NOW + 24
+	assert scheduler.deadline == NOW + 4
+
+
+def test_fast_near_threshold(scheduler):
+	quiet = make_sensor(20)
+	near = make_sensor(29)
+	scheduler.reschedule([quiet, near], [quiet, near], NOW)
+	assert quiet.nextSample == NOW + scheduler.period
+	assert near.nextSample == NOW + scheduler.fastPeriod
+	assert near.period == scheduler.fastPeriod
+	assert scheduler.deadline == NOW + scheduler.fastPeriod
+
+
+def test_slow_when_stable_and_back(scheduler):
+	sensor = make_sensor()
+	now = NOW
+	for sweep in range(tgTemperature.SAMPLE_STABLE_SWEEPS):
+		assert sensor.period in (0, scheduler.period)
+		scheduler.reschedule([sensor], [sensor], now)
+		now = sensor.nextSample
+	assert sensor.period == scheduler.slowPeriod
+
+	# movement anywhere in the network brings it back to the session period
+	sensor.setTemperature(25)
+	scheduler.reschedule([sensor], [sensor], now)
+	assert sensor.period == scheduler.period
+	assert scheduler.stableSweeps == 0
+
+
+def test_faulty_backs_off(scheduler):
+	sensor = make_sensor()
+	for read in range(tgTemperature.SENSOR_FAULT_READS):
+		sensor.readFailed()
+	scheduler.reschedule([sensor], [sensor], NOW)
+	assert sensor.nextSample == NOW + tgTemperature.SENSOR_BACKOFF_MIN
+
+
+def test_log_due(scheduler):
+	assert scheduler.logDue(NOW)
+	assert not scheduler.logDue(NOW + 1)
+	assert not scheduler.logDue(NOW + 3.9)
+	# on the grid even when a little late
+	assert scheduler.logDue(NOW + 4.5)
+	assert scheduler.nextLog == NOW + 8
+	# overran by more than a period, the grid restarts
+	assert scheduler.logDue(NOW + 20)
+	assert scheduler.nextLog == NOW + 24
+
+
+def test_trigger_rate_scaled_by_period(scheduler):
+	sensor = make_sensor()
+	assert scheduler.triggerRate(sensor, 3) == 3
+	sensor.period = scheduler.fastPeriod
+	assert scheduler.triggerRate(sensor, 3) == 12
+	sensor.period = scheduler.slowPeriod
+	assert scheduler.triggerRate(sensor, 3) == 1
+	assert scheduler.triggerRate(sensor, 8) == 2
+
+
+def test_trigger_rate_lowered_while_debouncing():
+	sensor = make_sensor()
+	sensor.setTemperature(35)
+	sensor.processAlarm(tgTemperature.ALARM_TYPE_HIGH_HIGH, 4)
+	sensor.processAlarm(tgTemperature.ALARM_TYPE_HIGH_HIGH, 4)
+	assert sensor.getTriggerState() == tgTemperature.ALARM_CHANGE_NONE
+
+	# the sensor dropped to a slower period, the readings so far count
+	sensor.processAlarm(tgTemperature.ALARM_TYPE_HIGH_HIGH, 1)
+	assert sensor.getTriggerState() == tgTemperature.ALARM_CHANGE_RISING_A1
+	assert sensor.getAlarmState() == tgTemperature.ALARM_STATE_CURRENT_A1
+
+
+@pytest.fixture
+def sim():
+	controller = tgSimBus.SimController(3, seed=1)
+	sim = tgSimBus.Simulation(controller, config=tgSimBus.simConfig(controller, triggerRate=2, samplePeriod=4))
+	yield sim
+	sim.close()
+
+
+def test_debounce_time_kept_at_fast_period(sim):
+	controller = sim.controllers[0]
+	serial = controller.serial(1)
+	controller.sensors[serial].temperature = tgSimBus.SIM_A1 - 1
+	sim.sweep()
+	sensor = sim.temperature.sensors[0]
+	assert sensor.period == sim.temperature.scheduler.fastPeriod
+
+	# 2 readings at 4 seconds are 8 readings at 1 second
+	controller.sensors[serial].temperature = tgSimBus.SIM_A1 + 1
+	for sweep in range(7):
+		sim.sweep()
+	assert sim.eventMgr.first(tgEvent.EVTOPIC_TEMP_ALRM_A1) is None
+	sim.sweep()
+	assert sim.eventMgr.first(tgEvent.EVTOPIC_TEMP_ALRM_A1) is not None
+
+
+def test_stats_streamed(sim):
+	sim.sweep()
+	sim.temperature.streamStats(NOW)
+	sim.temperature.streamStats(NOW + 1)
+	events = [event for event in sim.eventMgr.events if event[2] == tgEvent.EVTOPIC_TEMP_STATS]
+	assert len(events) == 1
+	stats = json.loads(events[0][3])
+	assert stats['Scheduler']['Sweeps'] == 1
+	assert [sensor['Pos'] for sensor in stats['Sensors']] == [1, 2, 3]
+
+	sim.temperature.streamStats(NOW + tgTemperature.TEMPERATURE_STATS_INTERVAL)
+	assert len([event for event in sim.eventMgr.events if event[2] == tgEvent.EVTOPIC_TEMP_STATS]) == 2
+
+
+class RowLogger(object):
+
+	def __init__(self):
+		self.rows = []
+
+	def log(self, now, data):
+		self.rows.append(data)
+
+
+def last_frame(sim):
+	for event in reversed(sim.eventMgr.events):
+		if event[2] in (tgEvent.EVTOPIC_TEMP_NEW_DATA, tgEvent.EVTOPIC_TEMP_DELTA_DATA):
+			return event[2], event[3]
+
+
+def test_sensor_fail_backoff_recover(sim):
+	controller = sim.controllers[0]
+	sensor = sim.temperature.sensors[0]
+	sim.temperature.tempLogger = RowLogger()
+	assert sensor.isStale()
+	sim.sweep()
+	assert last_frame(sim) == (tgEvent.EVTOPIC_TEMP_NEW_DATA, '20.0,30,40,0,0,20.0,30,40,0,0,20.0,30,40,0,0')
+
+	# the last good value is kept and flagged stale in the live data and the log
+	controller.setFault(controller.serial(1))
+	sim.sweep()
+	assert sensor.isStale() and not sensor.isFaulty()
+	assert sensor.getTemperature() == 20
+	assert last_frame(sim) == (tgEvent.EVTOPIC_TEMP_DELTA_DATA, '1,20.0,30,40,0,1')
+	sim.temperature.logData()
+	assert sim.temperature.tempLogger.rows[-1] == '20.0,30,40,0,1,20.0,30,40,0,0,20.0,30,40,0,0'
+
+	for read in range(tgTemperature.SENSOR_FAULT_READS - 1):
+		sim.sweep()
+	assert sensor.isFaulty()
+	assert sim.eventMgr.first(tgEvent.EVTOPIC_TEMP_SENSOR_FAULT)[3] == '1,Sim 1,SIM000001'
+	assert sensor.getBackoff() == tgTemperature.SENSOR_BACKOFF_MIN
+	assert sensor.period == tgTemperature.SENSOR_BACKOFF_MIN
+	sim.sweep()
+	assert sensor.getBackoff() == 2 * tgTemperature.SENSOR_BACKOFF_MIN
+
+	health = sim.temperature.getStats()['Sensors']
+	assert health[0]['Faulty'] and health[0]['FailedReads'] == tgTemperature.SENSOR_FAULT_READS + 1
+	assert health[0]['Backoff'] == 2 * tgTemperature.SENSOR_BACKOFF_MIN
+	assert health[0]['Staleness'] >= 0
+	assert not health[1]['Faulty'] and health[1]['FailedReads'] == 0
+
+	# the sensor is back on the session period with its first good read
+	controller.setFault(controller.serial(1), False)
+	sim.sweep()
+	assert not sensor.isStale() and sensor.getBackoff() == 0
+	assert sensor.period == sim.temperature.scheduler.period
+	assert sim.eventMgr.first(tgEvent.EVTOPIC_TEMP_SENSOR_OK)[3] == '1,Sim 1,SIM000001'
+	assert last_frame(sim) == (tgEvent.EVTOPIC_TEMP_DELTA_DATA, '1,20.0,30,40,0,0')
+
+
+def test_all_sensors_faulty(sim):
+	controller = sim.controllers[0]
+	for pos in range(1, 4):
+		controller.setFault(controller.serial(pos))
+	for read in range(tgTemperature.SENSOR_FAULT_READS):
+		sim.sweep()
+	assert sim.eventMgr.first(tgEvent.EVTOPIC_TEMP_NO_SENSORS) is not None
+	assert all(sensor['Faulty'] and sensor['LastContact'] == 0 for sensor in sim.temperature.getSensorHealth())
+
+
+@pytest.fixture
+def journal(tmp_path):
+	return tgTemperature.TriggerJournal(path=str(tmp_path / 'temperature.trig'))
+
+
+def test_journal_replay(journal):
+	assert journal.replay(1) == {}
+
+	journal.update(1, True, False)
+	journal.update(2, True, False)
+	# latest flags of a sensor win until flushed
+	journal.update(1, True, True)
+	journal.flush()
+	assert journal.records == 2
+	journal.update(2, False, False)
+	journal.flush()
+
+	assert journal.replay(1) == {'1': (True, True), '2': (False, False)}
+	assert journal.records == 3
+	# records of another commit are not for this config
+	assert journal.replay(2) == {}
+
+
+def test_journal_torn_tail(journal):
+	journal.replay(1)
+	journal.update(1, True, False)
+	journal.flush()
+	with open(journal.path, 'a') as f:
+		f.write('{"Commit": 1, "Pos": "2", "A1tr')
+
+	assert journal.replay(1) == {'1': (True, False)}
+
+
+def test_journal_reset_and_compaction(journal, monkeypatch):
+	monkeypatch.setattr(tgTemperature, 'TRIGGER_JOURNAL_MAX_RECORDS', 3)
+	journal.replay(1)
+	for pos in range(1, 4):
+		journal.update(pos, True, False)
+	journal.flush()
+	assert journal.needsCompaction()
+
+	journal.update(4, True, False)
+	journal.reset(2)
+	assert not journal.needsCompaction()
+	journal.flush()
+	assert journal.replay(1) == {}
+	assert journal.replay(2) == {}
+
+
+def test_journal_flush_retried(journal, tmp_path):
+	journal.path = str(tmp_path / 'missing' / 'temperature.trig')
+	journal.update(1, True, False)
+	journal.flush()
+	assert journal.pending == {'1': (True, False)}
+
+	journal.path = str(tmp_path / 'temperature.trig')
+	journal.flush()
+	assert journal.pending == {}
+	assert journal.replay(0) == {'1': (True, False)}
+
+
+def test_journal_thread_flushes_on_stop(journal):
+	journal.flushInterval = 60
+	journal.start()
+	journal.update(1, False, True)
+	journal.stop()
+	assert journal.replay(0) == {'1': (False, True)}
+
+
+def test_triggers_replayed_on_load(sim):
+	controller = sim.controllers[0]
+	controller.sensors[controller.serial(2)].temperature = tgSimBus.SIM_A2 + 5
+	for sweep in range(8):
+		sim.sweep()
+	assert sim.temperature.sensors[1].getTriggeredAlarms() == (False, True)
+	sim.temperature.triggerJournal.flush()
+
+	# the config on disk still has the flags clear, the journal restores them
+	temperature = tgTemperature.Temperature(sim.eventMgr, tempLogger=tgSimBus.SimDataLogger(),
+		controllers=sim.controllers, configFile=sim.temperature.configFile, triggerFile=sim.temperature.triggerJournal.path)
+	assert temperature.loadConfig()
+	assert [sensor.getTriggeredAlarms() for sensor in temperature.sensors] == [(False, False), (False, True), (False, False)]
+	assert temperature.getGlobalAlarmState() == tgTemperature.ALARM_STATE_PAST_A2
+
+
+def test_journal_compacted_into_config(sim, monkeypatch):
+	monkeypatch.setattr(tgTemperature, 'TRIGGER_JOURNAL_MAX_RECORDS', 1)
+	sim.temperature.triggerJournal.update(3, True, False)
+	sim.temperature.triggerJournal.flush()
+
+	controller = sim.controllers[0]
+	controller.sensors[controller.serial(2)].temperature = tgSimBus.SIM_A1 + 5
+	for sweep in range(8):
+		sim.sweep()
+
+	with open(sim.temperature.configFile) as f:
+		config = json.load(f)
+	assert config['Sensors']['2']['A1trig']
+	assert sim.temperature.triggerJournal.replay(config['Commit']) == {}
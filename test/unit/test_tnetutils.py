@@ -0,0 +1,132 @@
+"""Unit tests for the gateway dbus proxy cache against a fake bus."""
+import pytest
+
+dbus = pytest.importorskip('dbus')
+import tggateway.tgUtils as tgUtils
+
+SERVICE = 'net.connman'
+OTHER = 'org.ofono'
+
+
+class FakeObject(object):
+
+	def __init__(self, bus, service, path):
+		self.bus = bus
+		self.service = service
+		self.path = path
+
+	def get_dbus_method(self, member, dbus_interface=None):
+		def method(*args, **kwargs):
+			self.bus.calls.append((self.service, self.path, member))
+			if self.bus.errors:
+				raise dbus.exceptions.DBusException('failed', name=self.bus.errors.pop(0))
+			return member
+		return method
+
+
+class FakeBus(object):
+
+	def __init__(self):
+		self.lookups = 0
+		self.calls = []
+		self.errors = []
+		self.owner_changed = None
+
+	def add_signal_receiver(self, handler, **kwargs):
+		self.owner_changed = handler
+
+	def get_object(self, service, path):
+		self.lookups += 1
+		return FakeObject(self, service, path)
+
+
+def make_cache(size=tgUtils.DBUS_CACHE_SIZE):
+	bus = FakeBus()
+	return tgUtils.DBusCache(lambda: bus, size), bus
+
+
+def test_proxy_reused():
+	cache, bus = make_cache()
+	assert cache.call(SERVICE, '/', 'net.connman.Manager', 'GetServices') == 'GetServices'
+	assert cache.call(SERVICE, '/', 'net.connman.Manager', 'GetTechnologies') == 'GetTechnologies'
+	assert bus.lookups == 1
+	stats = cache.get_stats()
+	assert stats['connects'] == 1
+	assert stats['misses'] == 1 and stats['hits'] == 1
+
+
+def test_owner_change_invalidates_service():
+	cache, bus = make_cache()
+	cache.interface(SERVICE, '/', 'net.connman.Manager')
+	cache.interface(OTHER, '/', 'org.ofono.Manager')
+
+	bus.owner_changed(SERVICE, ':1.4', ':1.9')
+	assert cache.get_stats()['proxies'] == 1
+	assert cache.get_stats()['invalidations'] == 1
+
+	cache.interface(SERVICE, '/', 'net.connman.Manager')
+	cache.interface(OTHER, '/', 'org.ofono.Manager')
+	assert bus.lookups == 3
+
+	cache.invalidate()
+	assert cache.get_stats()['proxies'] == 0
+
+
+def test_stale_proxy_retried_once():
+	cache, bus = make_cache()
+	cache.interface(SERVICE, '/', 'net.connman.Manager')
+
+	bus.errors = ['org.freedesktop.DBus.Error.ServiceUnknown']
+	assert cache.call(SERVICE, '/', 'net.connman.Manager', 'GetServices') == 'GetServices'
+	assert len(bus.calls) == 2
+	assert bus.lookups == 2
+	assert cache.get_stats()['retries'] == 1
+
+
+def test_no_reply_not_repeated():
+	cache, bus = make_cache()
+
+	bus.errors = ['org.freedesktop.DBus.Error.NoReply']
+	with pytest.raises(dbus.exceptions.DBusException):
+		cache.call(OTHER, '/ril_0', 'org.ofono.MessageManager', 'SendMessage', '0400', 'text')
+	assert len(bus.calls) == 1
+	assert cache.get_stats()['retries'] == 0
+
+	# other errors go to the caller as they are
+	bus.errors = ['org.freedesktop.DBus.Error.AccessDenied']
+	with pytest.raises(dbus.exceptions.DBusException):
+		cache.call(OTHER, '/ril_0', 'org.ofono.MessageManager', 'SendMessage', '0400', 'text')
+	assert len(bus.calls) == 2
+
+
+def test_least_recently_used_evicted():
+	cache, bus = make_cache(size=2)
+	cache.interface(SERVICE, '/a', 'x')
+	cache.interface(SERVICE, '/b', 'x')
+	# /a is used again so /b is the one to go
+	cache.interface(SERVICE, '/a', 'x')
+	cache.interface(SERVICE, '/c', 'x')
+
+	stats = cache.get_stats()
+	assert stats['proxies'] == 2
+	assert stats['evictions'] == 1
+
+	lookups = bus.lookups
+	cache.interface(SERVICE, '/a', 'x')
+	assert bus.lookups == lookups
+	cache.interface(SERVICE, '/b', 'x')
+	assert bus.lookups == lookups + 1
+
+
+def test_main_loop_installed_on_first_connection(monkeypatch):
+	glib = pytest.importorskip('dbus.mainloop.glib')
+	installs = []
+	monkeypatch.setattr(glib, 'DBusGMainLoop', lambda set_as_default: installs.append(set_as_default))
+	monkeypatch.setattr(tgUtils, 'mainLoopInstalled', False)
+
+	cache, bus = make_cache()
+	assert installs == []
+	cache.bus()
+	cache.bus()
+	make_cache()[0].bus()
+	assert installs == [True]
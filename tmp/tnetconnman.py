@@ -4,6 +4,8 @@ import logging
 import dbus
 import signal
 
+import tggateway.tgUtils as tgutils
+
 ConnmanServiceStates = ('idle', 'failure', 'disconnect', 'association', 'configuration', 'ready', 'online')
 
 def get_services():
@@ -11,9 +13,7 @@ def get_services():
 
 	services = {}
 	try:
-		bus = dbus.SystemBus()
-		manager = dbus.Interface(bus.get_object("net.connman", "/"), "net.connman.Manager")
-		for path, properties in manager.GetServices():
+		for path, properties in tgutils.dbus_cache.call("net.connman", "/", "net.connman.Manager", "GetServices"):
 			services[path] = properties
 	except Exception as e:
 		logging.error(e)
@@ -101,9 +101,7 @@ def wifi_scan():
 
 	wifi_scan_results = {}
 	try:
-		bus = dbus.SystemBus()
-		wifi_tech = dbus.Interface(bus.get_object("net.connman", "/net/connman/technology/wifi"), "net.connman.Technology")
-		wifi_tech.Scan()
+		tgutils.dbus_cache.call("net.connman", "/net/connman/technology/wifi", "net.connman.Technology", "Scan")
 	except Exception as e:
 		logging.error(e)
 
@@ -142,9 +140,7 @@ def connect_service(service_path):
 			return True
 
 	try:
-		bus = dbus.SystemBus()
-		connman_service = dbus.Interface(bus.get_object("net.connman", service_path),"net.connman.Service")
-		connman_service.Connect()
+		tgutils.dbus_cache.call("net.connman", service_path, "net.connman.Service", "Connect")
 		return True
 
 	except Exception as e:
@@ -155,9 +151,7 @@ def disconnect_service(service_path):
 	''' Disconnect a service given by the service path '''
 
 	try:
-		bus = dbus.SystemBus()
-		connman_service = dbus.Interface(bus.get_object("net.connman", service_path),"net.connman.Service")
-		connman_service.Disconnect()
+		tgutils.dbus_cache.call("net.connman", service_path, "net.connman.Service", "Disconnect")
 		return True
 
 	except Exception as e:
@@ -182,10 +176,7 @@ def is_online():
 
 	online = False
 	try:
-
-		bus = dbus.SystemBus()
-		connman_manager = manager = dbus.Interface(bus.get_object("net.connman", "/"),"net.connman.Manager")
-		properties = connman_manager.GetProperties()
+		properties = tgutils.dbus_cache.call("net.connman", "/", "net.connman.Manager", "GetProperties")
 		if 'State' in properties:
 			if properties['State'] == 'online':
 				online = True
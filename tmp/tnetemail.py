@@ -1,18 +1,21 @@
-#!/usr/bin/env python2
+#!/usr/bin/env python3
 
 ''' @file : tgEmail.py
 	@brief : Email with SMTP.
 '''
 import os
 import sys
+import ssl
+import uuid
+import base64
+import mimetypes
+import collections
 import logging
 import logging.handlers
 import smtplib
-from email.MIMEMultipart import MIMEMultipart 
-from email.MIMEText import MIMEText
-from email.MIMEImage import MIMEImage
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
 import threading 
-import Queue 
 import time
 import json
 import copy
@@ -22,19 +25,602 @@ from tggateway.tgModel import Model
 import tggateway.tgEvent as tgEvent
 
 EMAIL_CONFIG_FILE = '/home/tgard/config/email.json'
+EMAIL_OUTBOX_FILE = '/home/tgard/db/outbox.journal'
+
+# retry delay of a deferred message or an unreachable server doubles from the base up to the max
+OUTBOX_RETRY_BASE			= 30
+OUTBOX_RETRY_MAX			= 3600
+# deferred this many times the message is given up on
+OUTBOX_MAX_ATTEMPTS			= 10
+# journal is rewritten with only the undelivered messages once it is this big
+OUTBOX_COMPACT_SIZE			= 1024 * 1024
+# bytes read or written at a time when streaming a message
+OUTBOX_CHUNK_SIZE			= 64 * 1024
+
+# rendered MIME kept for the most recent subject and body
+EMAIL_MIME_CACHE			= 16
+# attachment bytes base64 encoded at a time, a multiple of 57 gives whole 76 character lines
+EMAIL_ATTACH_CHUNK			= 57 * 1024
+
+# delivery state of an outbox message
+OUTBOX_QUEUED				= 'Q'
+OUTBOX_RETRY				= 'R'
+OUTBOX_SENT					= 'S'
+OUTBOX_FAILED				= 'F'
+
+# seconds without a command after which the server is assumed to have dropped the connection,
+# a new connection is made instead of probing the old one
+SMTP_IDLE_TIMEOUT			= 120
+# socket timeout of smtp commands
+SMTP_TIMEOUT				= 60
+
+# result of SmtpSession.send
+SEND_OK						= 0
+SEND_RETRY					= 1
+SEND_FAILED					= 2
+SEND_UNREACHABLE			= 3
+
+
+def retryDelay(attempts):
+	''' @fn retryDelay
+		@brief : Exponential backoff in seconds after the given number of failed attempts.
+	'''
+	return min(OUTBOX_RETRY_MAX, OUTBOX_RETRY_BASE * 2 ** max(0, min(attempts - 1, 16)))
+
+
+class MimeStream(object):
+	''' @class : MimeStream
+		@brief : Multipart message whose attachments are base64 encoded from their files while it is written.
+		@details : Nothing bigger than an encoding chunk is held in memory, the length is known up front
+				from the file sizes so the message can be streamed into the outbox.
+	'''
+	def __init__(self, headers):
+		''' @fn init
+			@brief : Class initialisation.
+			@param headers : List of (name, value) message headers.
+		'''
+		self.boundary = '=' * 15 + uuid.uuid4().hex + '=='
+		head = ''.join('{}: {}\n'.format(name, value) for name, value in headers)
+		head += 'MIME-Version: 1.0\nContent-Type: multipart/mixed; boundary="{}"\n\n'.format(self.boundary)
+		# text segments and (path, size) attachments in order
+		self.segments = [head.encode()]
+
+	def attachText(self, text, subtype='html'):
+		''' @fn attachText
+			@brief : Add a text part.
+		'''
+		part = MIMEText(text, subtype)
+		self.segments.append('--{}\n'.format(self.boundary).encode() + part.as_bytes() + b'\n')
+
+	def attachFile(self, path):
+		''' @fn attachFile
+			@brief : Add a file as a base64 attachment, it is read when the message is written.
+		'''
+		name = os.path.basename(path)
+		contentType = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+		self.segments.append('--{}\nContent-Type: {}; name="{}"\nMIME-Version: 1.0\n'
+			'Content-Transfer-Encoding: base64\nContent-Disposition: attachment; filename="{}"\n\n'.format(
+			self.boundary, contentType, name, name).encode())
+		self.segments.append((path, os.path.getsize(path)))
+		self.segments.append(b'\n')
+
+	def length(self):
+		''' @fn length
+			@brief : Bytes the whole message will take.
+		'''
+		total = len('--{}--\n'.format(self.boundary))
+		for segment in self.segments:
+			if isinstance(segment, bytes):
+				total += len(segment)
+			else:
+				encoded = 4 * ((segment[1] + 2) // 3)
+				total += encoded + (encoded + 75) // 76
+		return total
+
+	def chunks(self):
+		''' @fn chunks
+			@brief : The message a chunk at a time.
+		'''
+		for segment in self.segments:
+			if isinstance(segment, bytes):
+				yield segment
+				continue
+
+			path, size = segment
+			with open(path, 'rb') as f:
+				while size > 0:
+					data = f.read(min(size, EMAIL_ATTACH_CHUNK))
+					if not data:
+						raise IOError('{} shorter than {} bytes'.format(path, segment[1]))
+					size -= len(data)
+					yield base64.encodebytes(data)
+
+		yield '--{}--\n'.format(self.boundary).encode()
+
+
+class OutboxCorrupt(Exception):
+	''' @class : OutboxCorrupt
+		@brief : An outbox message could not be read back whole, retrying it won't help.
+	'''
+
+
+class OutboxEntry(object):
+	''' @class : OutboxEntry
+		@brief : Undelivered message, the message itself stays in the journal file.
+	'''
+	__slots__ = ('id', 'offset', 'length', 'state', 'attempts', 'nextTry')
+
+	def __init__(self, id, offset, length):
+		self.id = id
+		self.offset = offset
+		self.length = length
+		self.state = OUTBOX_QUEUED
+		self.attempts = 0
+		self.nextTry = 0
+
+
+class Outbox(object):
+	''' @class : Outbox
+		@brief : Append only journal of outgoing messages and their delivery state.
+		@details : 'Q id length' records carry the sender, recipients and rendered MIME, 'S id state
+				attempts nextTry' records their state changes. Only the offsets of undelivered messages
+				are kept in memory. Every record is synced before add() returns so a queued alarm
+				survives a crash, a record cut short by one is dropped at start up.
+	'''
+	def __init__(self, path=EMAIL_OUTBOX_FILE, sync=True):
+		''' @fn init
+			@brief : Class initialisation.
+		'''
+		self.path = path
+		self.sync = sync
+		self.lock = threading.Lock()
+		self.entries = {}
+		self.lastId = 0
+		self.stats = {'Added': 0, 'Sent': 0, 'Retries': 0, 'Failed': 0}
+
+		good = self.load()
+		self.file = open(path, 'ab')
+		if good < self.file.tell():
+			logging.warning('Email: Outbox truncating partial record at {}.'.format(good))
+			self.file.truncate(good)
+			self.file.seek(good)
+
+		logging.info('Email: Outbox has {} undelivered messages.'.format(len(self.entries)))
+
+	def load(self):
+		''' @fn load
+			@brief : Rebuild the undelivered entries from the journal.
+			@return : Offset of the end of the last whole record.
+		'''
+		good = 0
+		try:
+			with open(self.path, 'rb') as f:
+				while True:
+					header = f.readline()
+					if not header.endswith(b'\n'):
+						break
+					fields = header.split()
+					try:
+						if fields[0] == b'Q' and len(fields) == 3:
+							entry = OutboxEntry(int(fields[1]), f.tell(), int(fields[2]))
+							f.seek(entry.length + 1, os.SEEK_CUR)
+							if f.tell() > os.fstat(f.fileno()).st_size:
+								break
+							self.entries[entry.id] = entry
+							self.lastId = max(self.lastId, entry.id)
+
+						elif fields[0] == b'S' and len(fields) == 5:
+							entry = self.entries.get(int(fields[1]))
+							state = fields[2].decode()
+							if entry is not None and state in (OUTBOX_SENT, OUTBOX_FAILED):
+								del self.entries[entry.id]
+							elif entry is not None:
+								entry.state = state
+								entry.attempts = int(fields[3])
+								entry.nextTry = float(fields[4])
+						else:
+							break
+
+					except (ValueError, IndexError):
+						break
+
+					good = f.tell()
+
+		except IOError:
+			pass
+
+		return good
+
+	def write(self, data):
+		''' @fn write
+			@brief : Append records, the lock is held by the caller.
+		'''
+		self.file.write(data)
+		self.file.flush()
+		if self.sync:
+			os.fsync(self.file.fileno())
+
+	def add(self, fromAddr, toAddrs, msg):
+		''' @fn add
+			@brief : Store a message for delivery.
+			@param msg : MIME string or a MimeStream written a chunk at a time.
+			@return : Message id.
+		'''
+		if isinstance(msg, MimeStream):
+			length, chunks = msg.length(), msg.chunks()
+		else:
+			msg = msg.encode()
+			length, chunks = len(msg), [msg]
+
+		addresses = '{}\n{}\n'.format(fromAddr, ','.join(toAddrs)).encode()
+		with self.lock:
+			start = self.file.tell()
+			header = 'Q {} {}\n'.format(self.lastId + 1, len(addresses) + length).encode()
+			try:
+				self.file.write(header + addresses)
+				written = 0
+				for chunk in chunks:
+					self.file.write(chunk)
+					written += len(chunk)
+				if written != length:
+					raise IOError('message is {} bytes not {}'.format(written, length))
+				self.write(b'\n')
+
+			except Exception:
+				# a partial record would hide every record after it
+				self.file.truncate(start)
+				self.file.seek(start)
+				raise
+
+			self.lastId += 1
+			entry = OutboxEntry(self.lastId, start + len(header), len(addresses) + length)
+			self.entries[entry.id] = entry
+			self.stats['Added'] += 1
+			return entry.id
+
+	def open(self, entry):
+		''' @fn open
+			@brief : Sender, recipients and the journal positioned at the MIME of a message.
+			@return : (sender, recipients, file, MIME length), the caller closes the file.
+		'''
+		f = open(self.path, 'rb')
+		try:
+			f.seek(entry.offset)
+			fromAddr = f.readline().decode().rstrip('\n')
+			toAddrs = f.readline().decode().rstrip('\n')
+		except Exception:
+			f.close()
+			raise
+		return fromAddr, toAddrs.split(','), f, entry.offset + entry.length - f.tell()
+
+	def due(self, now):
+		''' @fn due
+			@brief : Entries ready to send, oldest first.
+		'''
+		with self.lock:
+			return sorted([entry for entry in self.entries.values() if entry.nextTry <= now], key=lambda entry: entry.id)
+
+	def nextDue(self):
+		''' @fn nextDue
+			@brief : Earliest retry time, None when the outbox is empty.
+		'''
+		with self.lock:
+			if not self.entries:
+				return None
+			return min(entry.nextTry for entry in self.entries.values())
+
+	def mark(self, entry, state, now=None):
+		''' @fn mark
+			@brief : Record a delivery state, a retry is scheduled with backoff.
+		'''
+		with self.lock:
+			if state == OUTBOX_RETRY:
+				entry.attempts += 1
+				entry.nextTry = (now or time.time()) + retryDelay(entry.attempts)
+				self.stats['Retries'] += 1
+			elif state == OUTBOX_SENT:
+				self.stats['Sent'] += 1
+			else:
+				self.stats['Failed'] += 1
+
+			entry.state = state
+			if state in (OUTBOX_SENT, OUTBOX_FAILED):
+				self.entries.pop(entry.id, None)
+			self.write('S {} {} {} {:.3f}\n'.format(entry.id, state, entry.attempts, entry.nextTry).encode())
+
+	def compact(self):
+		''' @fn compact
+			@brief : Rewrite the journal with the undelivered messages once it has grown and is mostly delivered ones.
+		'''
+		with self.lock:
+			size = self.file.tell()
+			if size < OUTBOX_COMPACT_SIZE or sum(entry.length for entry in self.entries.values()) * 2 > size:
+				return
+
+			entries = sorted(self.entries.values(), key=lambda entry: entry.id)
+			with open(self.path, 'rb') as old, open(self.path + '.tmp', 'wb') as new:
+				for entry in entries:
+					old.seek(entry.offset)
+					payload = old.read(entry.length)
+					new.write('Q {} {}\n'.format(entry.id, entry.length).encode())
+					entry.offset = new.tell()
+					new.write(payload + b'\n')
+					if entry.state != OUTBOX_QUEUED:
+						new.write('S {} {} {} {:.3f}\n'.format(entry.id, entry.state, entry.attempts, entry.nextTry).encode())
+				new.flush()
+				os.fsync(new.fileno())
+
+			self.file.close()
+			os.rename(self.path + '.tmp', self.path)
+			self.file = open(self.path, 'ab')
+			logging.info('Email: Outbox compacted from {} to {} bytes.'.format(size, self.file.tell()))
+
+	def getStats(self):
+		''' @fn getStats
+			@brief : Delivery counters, undelivered messages and journal size.
+		'''
+		with self.lock:
+			stats = dict(self.stats)
+			stats['Pending'] = len(self.entries)
+			stats['Deferred'] = sum(1 for entry in self.entries.values() if entry.state == OUTBOX_RETRY)
+			stats['JournalBytes'] = None if self.file.closed else self.file.tell()
+		return stats
+
+	def close(self):
+		''' @fn close
+			@brief : Close the journal.
+		'''
+		with self.lock:
+			self.file.close()
+
+
+class TlsResumeContext(object):
+	''' @class : TlsResumeContext
+		@brief : SSL context that offers the last TLS session when wrapping a socket.
+		@details : smtplib only calls wrap_socket on the context it is given, this passes the
+				session of the previous connection so the server can resume it without a full handshake.
+	'''
+	def __init__(self, context):
+		''' @fn init
+			@brief : Class initialisation.
+		'''
+		self.context = context
+		self.session = None
+
+	def wrap_socket(self, sock, server_hostname=None, **kwargs):
+		try:
+			return self.context.wrap_socket(sock, server_hostname=server_hostname, session=self.session, **kwargs)
+		except ValueError:
+			# session of another host or context, full handshake
+			self.session = None
+			return self.context.wrap_socket(sock, server_hostname=server_hostname, **kwargs)
+
+
+class SmtpSession(object):
+	''' @class : SmtpSession
+		@brief : Persistent connection to the smtp server.
+		@details : The connection is kept open between messages and only replaced when a send
+				fails on it or it has been idle longer than the server is likely to keep it,
+				there is no NOOP before every message. Reconnects offer the previous TLS session.
+				Config keys are Url, Port, User, Pass and optionally Tls, False for plain smtp.
+	'''
+	def __init__(self, idleTimeout=SMTP_IDLE_TIMEOUT, timeout=SMTP_TIMEOUT):
+		''' @fn init
+			@brief : Class initialisation.
+		'''
+		self.config = {}
+		self.idleTimeout = idleTimeout
+		self.timeout = timeout
+		self.server = None
+		self.lastUsed = 0
+		self.tls = TlsResumeContext(ssl.create_default_context())
+		self.stats = {'Connects': 0, 'ConnectFails': 0, 'TlsResumed': 0, 'IdleCloses': 0, 'Reused': 0,
+					'Sent': 0, 'Failed': 0, 'Bytes': 0, 'SendTime': 0.0}
+
+	def configure(self, config):
+		''' @fn configure
+			@brief : New server settings, the current connection is closed.
+		'''
+		self.close()
+		self.config = config
+		self.tls.session = None
+
+	def connected(self):
+		''' @fn connected
+			@brief : Connection open and not idle for too long, no round trip.
+		'''
+		return self.server is not None and time.time() - self.lastUsed < self.idleTimeout
+
+	def connect(self):
+		''' @fn connect
+			@brief : Connect and log in to the mail server.
+			@return : Boolean
+		'''
+		self.close()
+		try:
+			server = smtplib.SMTP(self.config['Url'], self.config['Port'], timeout=self.timeout)
+			if self.config.get('Tls', True):
+				server.starttls(context=self.tls)
+			if self.config.get('User'):
+				server.login(self.config['User'], self.config['Pass'])
+
+		except (smtplib.SMTPException, socket.error, ssl.SSLError, KeyError) as e:
+			logging.error('Email: SMTP connect error {0}.'.format(e))
+			self.stats['ConnectFails'] += 1
+			return False
+
+		sock = server.sock
+		if isinstance(sock, ssl.SSLSocket):
+			if sock.session_reused:
+				self.stats['TlsResumed'] += 1
+			self.tls.session = sock.session
+
+		self.server = server
+		self.lastUsed = time.time()
+		self.stats['Connects'] += 1
+		logging.info('Email: SMTP connected.')
+		return True
+
+	def close(self):
+		''' @fn close
+			@brief : Quit the connection, errors are ignored as it may already be gone.
+		'''
+		if self.server is None:
+			return
+
+		try:
+			self.server.quit()
+		except (smtplib.SMTPException, socket.error, ssl.SSLError):
+			self.server.close()
+		self.server = None
+		logging.debug('Email: SMTP disconnected.')
+
+	def expireIdle(self):
+		''' @fn expireIdle
+			@brief : Close a connection the server has probably dropped already.
+		'''
+		if self.server is not None and not self.connected():
+			self.stats['IdleCloses'] += 1
+			self.close()
+
+	def transfer(self, fromAddr, toAddrs, msgFile, length):
+		''' @fn transfer
+			@brief : Send a message read from a file a chunk at a time, as smtplib sendmail does for a string.
+		'''
+		server = self.server
+		server.ehlo_or_helo_if_needed()
+		code, resp = server.mail(fromAddr)
+		if code != 250:
+			server.rset()
+			raise smtplib.SMTPSenderRefused(code, resp, fromAddr)
+
+		refused = {}
+		for addr in toAddrs:
+			code, resp = server.rcpt(addr)
+			if code not in (250, 251):
+				refused[addr] = (code, resp)
+		if len(refused) == len(toAddrs):
+			server.rset()
+			raise smtplib.SMTPRecipientsRefused(refused)
+
+		code, resp = server.docmd('data')
+		if code != 354:
+			# end the transaction or the next MAIL on the connection is refused as nested
+			server.rset()
+			raise smtplib.SMTPDataError(code, resp)
+
+		# crlf line endings and a dot doubled at the start of a line
+		chunk = []
+		size = 0
+		lineStart = True
+		while length > 0:
+			# read errors are kept apart from socket errors, both are OSError
+			try:
+				line = msgFile.readline(min(length, OUTBOX_CHUNK_SIZE))
+			except (IOError, OSError) as e:
+				raise OutboxCorrupt('message unreadable {}'.format(e))
+			if not line:
+				raise OutboxCorrupt('message cut short by {} bytes'.format(length))
+			length -= len(line)
+
+			if lineStart and line.startswith(b'.'):
+				line = b'.' + line
+			lineStart = line.endswith(b'\n')
+			if lineStart:
+				line = line[:-1].rstrip(b'\r') + b'\r\n'
+
+			chunk.append(line)
+			size += len(line)
+			if size >= OUTBOX_CHUNK_SIZE:
+				server.send(b''.join(chunk))
+				chunk = []
+				size = 0
+
+		chunk.append(b'.\r\n' if lineStart else b'\r\n.\r\n')
+		server.send(b''.join(chunk))
+		code, resp = server.getreply()
+		if code != 250:
+			raise smtplib.SMTPDataError(code, resp)
+
+	def send(self, fromAddr, toAddrs, msg, length=None):
+		''' @fn send
+			@brief : Send one message over the session, reconnects once if the connection was lost.
+			@param msg : MIME string, or a file positioned at the MIME with length given.
+			@return : SEND_OK, SEND_UNREACHABLE, SEND_RETRY if the server deferred the message or SEND_FAILED
+					if it refused it.
+			@exception OutboxCorrupt : The message file could not be read whole, the connection is closed.
+		'''
+		for attempt in range(2):
+			self.expireIdle()
+			if self.server is None:
+				if not self.connect():
+					return SEND_UNREACHABLE
+			elif attempt == 0:
+				self.stats['Reused'] += 1
+
+			start = time.time()
+			try:
+				if length is None:
+					self.server.sendmail(fromAddr, toAddrs, msg)
+				else:
+					if attempt == 0:
+						position = msg.tell()
+					else:
+						msg.seek(position)
+					self.transfer(fromAddr, toAddrs, msg, length)
+
+			except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as e:
+				self.lastUsed = time.time()
+				logging.error('Email: SMTP refused message {0}.'.format(e))
+				self.stats['Failed'] += 1
+				# a 4xx reply is worth another try later, refused recipients carry a reply each
+				if isinstance(e, smtplib.SMTPRecipientsRefused):
+					codes = [code for code, resp in e.recipients.values()]
+				else:
+					codes = [getattr(e, 'smtp_code', None)]
+				return SEND_RETRY if all(code is not None and 400 <= code < 500 for code in codes) else SEND_FAILED
+
+			except OutboxCorrupt:
+				# the server is part way through the data, ending it would send the message cut short
+				self.server.close()
+				self.server = None
+				raise
+
+			except (smtplib.SMTPException, socket.error, ssl.SSLError) as e:
+				logging.warning('Email: SMTP connection lost {0}.'.format(e))
+				self.server.close()
+				self.server = None
+				continue
+
+			self.lastUsed = time.time()
+			self.stats['Sent'] += 1
+			self.stats['Bytes'] += len(msg) if length is None else length
+			self.stats['SendTime'] += self.lastUsed - start
+			return SEND_OK
+
+		return SEND_UNREACHABLE
+
+	def getStats(self):
+		''' @fn getStats
+			@brief : Connection and send counters, throughput in messages per second of send time.
+		'''
+		stats = dict(self.stats)
+		stats['Connected'] = self.connected()
+		stats['Throughput'] = stats['Sent'] / stats['SendTime'] if stats['SendTime'] else 0.0
+		return stats
 
 
 class Email(Model):
 	''' @class : SmtpClient
-		@brief : Contains smtplib.SMTP object which handles the connection, 
+		@brief : Contains the SmtpSession which handles the connection, 
 				MIME contruction and sending of emails to SMTP server.
 					
-				smtplib.STMP methods are run from the Thread object's run method.
-				A Queue object is used to queue requests to send emails upon events
-				triggered by the owner of the SmtpClient instance.
+				Messages are sent from the Thread object's run method.
+				Requests to send emails upon events triggered by the owner of the
+				SmtpClient instance are stored in the Outbox until delivered.
 	'''
 
-	def __init__(self, deviceName, eventMgr):
+	def __init__(self, deviceName, eventMgr, outbox=None):
 		
 		super(Email, self).__init__('Email')
 
@@ -43,7 +629,6 @@ class Email(Model):
 		# some stats
 		self.totalEmailsRequested = 0
 		self.totalEmailsSent = 0
-		self.interval = 1
 		
 		self.deviceName = deviceName
 		# smtp server settings
@@ -51,9 +636,19 @@ class Email(Model):
 		self.configured = False
 	
 		self.connectFail = True
-		# Create the required mail queue
-		self.queue = Queue.Queue(maxsize=30)
-		self.mailserver = None
+		# messages survive restarts and outages on disk
+		if outbox is None:
+			outbox = Outbox()
+		self.outbox = outbox
+		self.wakeup = threading.Event()
+		self.session = SmtpSession()
+		# new config for the session, applied from the thread
+		self.sessionConfig = None
+		# consecutive passes the server couldn't be reached
+		self.unreachable = 0
+		# rendered MIME by from header, subject and body
+		self.mimeCache = collections.OrderedDict()
+		self.stats = {'MimeBuilt': 0, 'MimeCached': 0}
 
 		# raise event if can't connect to smtp server after 30mins
 		self.noConnectionTimeout = 1800 
@@ -64,104 +659,121 @@ class Email(Model):
 	def run(self):
 		''' @fn run
 			@brief : Executes in the thread.
-					Handles connection to Smtp mail server.
-					Pulls from the MIME messages from the queue and sends the emails.
+					Sends every due message in the outbox back to back over the session,
+					then waits for a new message or the next retry.
 		'''	
-		lasttime = 0
-		while True:
-			
-			# Sleep for a moment
-			time.sleep(1)
-
-			# Check if self.stop has been set
-			if self.stopThread:
-				break
-
-			if time.time() - lasttime < self.interval:
-				continue
+		while not self.stopThread:
 
 			# not configured yet
 			if not self.configured:
-				logging.debug('Email: Not configured.')
-				self.interval = 30
-				lasttime = time.time()
+				time.sleep(1)
 				continue
 
-			# Make sure there is something in the queue
-			if self.queue.qsize() == 0:
-				logging.debug('Email: Queue empty nothing todo.')
-				self.interval = 10
-				lasttime = time.time()
-				continue
+			self.applyConfig()
+			self.sendDue()
+
+			due = self.outbox.nextDue()
+			timeout = 1 if due is None else min(1, max(0, due - time.time()))
+			if self.wakeup.wait(timeout):
+				self.wakeup.clear()
 			else:
-				self.interval = 1
+				self.session.expireIdle()
+				self.outbox.compact()
 
-			if not self.isConnected():
-				self.connect()
-				self.interval = 5
-				lasttime = time.time()
-				continue
-	
-			# pull from the queue (only if connected)
-			message = self.queue.get()
-			self.send(message)
-							
-			# inform queue that task is done
-			self.queue.task_done()
+	def applyConfig(self):
+		''' @fn applyConfig
+			@brief : Hand a changed config to the session, closes its connection.
+		'''
+		config = self.sessionConfig
+		if config is not None:
+			self.sessionConfig = None
+			self.session.configure(config)
+
+	def sendDue(self):
+		''' @fn sendDue
+			@brief : Send due messages oldest first, stops at the first one the server can't be reached for.
+		'''
+		for entry in self.outbox.due(time.time()):
+			if self.stopThread:
+				return
 
-			lasttime = time.time()
+			try:
+				fromAddr, toAddrs, msgFile, length = self.outbox.open(entry)
+			except (IOError, ValueError) as e:
+				logging.error('Email: Outbox message {} unreadable {}.'.format(entry.id, e))
+				self.outbox.mark(entry, OUTBOX_FAILED)
+				continue
 
-		# stopped thread at this point, process any remaining
-		self.processRemaining()
+			try:
+				result = self.send([fromAddr, toAddrs, msgFile, length])
+			except OutboxCorrupt as e:
+				logging.error('Email: Outbox message {} unreadable {}.'.format(entry.id, e))
+				result = SEND_FAILED
+			finally:
+				msgFile.close()
 
-		
-	def processRemaining(self):
-		''' @brief : Process outstanding emails in the queue. '''
-		while True:
-			if self.queue.qsize():
-				message = self.queue.get()
-				self.send(message)
-				self.queue.task_done()
+			if result == SEND_OK:
+				self.outbox.mark(entry, OUTBOX_SENT)
+			elif result == SEND_FAILED:
+				self.outbox.mark(entry, OUTBOX_FAILED)
+			elif result == SEND_RETRY and entry.attempts + 1 >= OUTBOX_MAX_ATTEMPTS:
+				logging.error('Email: Giving up on message {} after {} attempts.'.format(entry.id, entry.attempts + 1))
+				self.outbox.mark(entry, OUTBOX_FAILED)
+			elif result == SEND_RETRY:
+				self.outbox.mark(entry, OUTBOX_RETRY)
 			else:
-				break
+				self.connectionStatus()
+				return
 
+		self.unreachable = 0
 
 	def connectionStatus(self):
 		''' @fn connectionStatus
-			@brief : Check status of connection.
+			@brief : Wait with backoff before the next attempt while the server can't be reached,
+					woken early by a queued message, networkUp() or stop.
 		'''		
+		self.unreachable += 1
 		logging.debug('Email: Still not connected.')
-		self.interval = 60
 		
 		# no connection after 30 mins?
 		if time.time() - self.noConnectionTime >= self.noConnectionTimeout:
 			logging.warning('Email: No connection after 30mins.')
 			self.noConnectionTime = time.time()
 
+		# a new message, the network coming up or stop ends the wait early
+		if self.wakeup.wait(retryDelay(self.unreachable)):
+			self.wakeup.clear()
+
+	def networkUp(self):
+		''' @fn networkUp
+			@brief : The gateway has a route again, retry the outbox now rather than after the backoff.
+					Called by Network when the default route moves to an interface.
+		'''
+		self.unreachable = 0
+		self.wakeup.set()
+
 	def send(self, message):
 		''' @fn send
-			@return : Boolean
-			@param message: List containing smtp user, list of recipient email addresses and the MIME
+			@return : SEND_OK, SEND_RETRY, SEND_FAILED or SEND_UNREACHABLE
+			@param message: List containing smtp user, list of recipient email addresses, the MIME
+					and optionally its length when it is a file
 			@brief : Actually send the mail.
 		'''
-	 
-		try:
-			self.mailserver.sendmail(message[0], message[1], message[2])
-		except Exception as e:
-			logging.error("Email: SMTP error {0}.".format(e))
-			return False
-			
+		result = self.session.send(*message)
+		self.connectFail = result == SEND_UNREACHABLE
+		if result != SEND_OK:
+			return result
+
 		# a config setting to report stats
 		self.totalEmailsSent += 1
 		logging.debug('Email: Sent. Total emails sent {0}.'.format(self.totalEmailsSent))
-		return True
+		return result
 
 	def queueSize(self):
 		''' @fn queueSize
-			@return : Number of messages in the queue
-			@brief : Wrapper around the queue.qsize() function.
+			@return : Number of undelivered messages in the outbox
 		'''
-		return self.queue.qsize()
+		return len(self.outbox.entries)
 
 	def queueMessage(self, from_addr, to_addr_list, msg):
 		''' @fn queueMessage
@@ -169,18 +781,46 @@ class Email(Model):
 			@param from_addr : Smtp user
 			@param to_addr_list : Recipient email address list 
 			@param msg : MIME 
-			@brief : Puts the email content in the queue which is processed by the worker thread.
+			@brief : Stores the email in the outbox which is processed by the worker thread.
 		'''
-	
-		if not self.stopThread:
-			message = [from_addr, to_addr_list, msg]
-			self.queue.put(message)
-			self.totalEmailsRequested += 1
-			return True
-		else:
-			logging.warning("Email: Thread not running. Not adding to queue.")
+		try:
+			self.outbox.add(from_addr, to_addr_list, msg)
+		except (IOError, OSError) as e:
+			logging.error('Email: Outbox write error {0}.'.format(e))
 			return False
 
+		self.totalEmailsRequested += 1
+		self.wakeup.set()
+		return True
+
+	def fromHeader(self):
+		''' @fn fromHeader
+			@brief : From header with the device name.
+		'''
+		return "TempNetZ {} <".format(self.deviceName) + self.config['User'] + ">"
+
+	def mimeContent(self, subject, body):
+		''' @fn mimeContent
+			@brief : Rendered MIME of an email without the To header, shared by every recipient list.
+		'''
+		key = (self.fromHeader(), subject, body)
+		content = self.mimeCache.get(key)
+		if content is not None:
+			self.stats['MimeCached'] += 1
+			return content
+
+		mime = MIMEMultipart()
+		mime['From'] = key[0]
+		mime['Subject'] = "{}".format(subject)
+		mime.attach(MIMEText(body, 'html'))
+		content = mime.as_string()
+
+		self.mimeCache[key] = content
+		if len(self.mimeCache) > EMAIL_MIME_CACHE:
+			self.mimeCache.popitem(last=False)
+		self.stats['MimeBuilt'] += 1
+		return content
+
 	def mailRequest(self, addressList, emailData):
 		''' @fn mailRequest
 			@brief : Creates the MIME and pushes it on to the queue.
@@ -195,22 +835,18 @@ class Email(Model):
 				logging.debug('Email: No addresses to email.')
 				return False
 			
-			# MIME setup
-			mime = MIMEMultipart()
-			mime['From'] = "TempNetZ {} <".format(self.deviceName) + self.config['User'] + ">"
-			mime['To'] = ", ".join(addressList)
-			mime['Subject'] = "{}".format(emailData['subject'])
-			mime.attach(MIMEText(emailData['body'], 'html'))
+			# MIME setup, only the To header differs between recipient lists
+			mime = 'To: {}\n'.format(", ".join(addressList)) + self.mimeContent(emailData['subject'], emailData['body'])
 		except Exception as e:
 			logging.error('Email: Request error {0}.'.format(e))
 			return False
 		
 		# put in queue
-		return self.queueMessage(self.config['User'], addressList, mime.as_string())
+		return self.queueMessage(self.config['User'], addressList, mime)
 
 	def mailImages(self, addressList=[], imagePaths=[]):
 		''' @fn mailImage
-			@brief : Creates MIME image and queues it.
+			@brief : Creates MIME image and queues it, images are encoded straight from their files into the outbox.
 			@return : Boolean
 			@param addressList : List of the email addresses to send this email to.
 			@param images : List of image paths
@@ -218,104 +854,52 @@ class Email(Model):
 		try:
 
 			# MIME setup
-			mime = MIMEMultipart()
-			mime['From'] = "TempNetZ {} <".format(self.deviceName) + self.config['User'] + ">"
-			mime['To'] = ", ".join(addressList)
-			mime['Subject'] = "Screenshots"
+			mime = MimeStream([('From', self.fromHeader()), ('To', ", ".join(addressList)), ('Subject', "Screenshots")])
 
 			for imagePath in imagePaths:
 				if os.path.exists(imagePath):
-					imageData = open(imagePath, "rb").read()
-					image = MIMEImage(imageData, name=os.path.basename(imagePath))
-					mime.attach(image)
+					mime.attachFile(imagePath)
 
 			# put in queue
-			return self.queueMessage(self.config['User'], addressList, mime.as_string())
+			return self.queueMessage(self.config['User'], addressList, mime)
 
 		except Exception as e:
 			logging.error('Email: Send images error {0}.'.format(e))
 			return False		
 
-	def connect(self):
-		''' @fn connect
-			@return : Boolean
-			@brief : Connects and logs in to the mail server. 
-			@note: Only called from the worker thread.
-		'''
-	
-		# socket connection
-		try:
-			self.mailserver = smtplib.SMTP(self.config['Url'], self.config['Port'],"", 60)
-		except Exception as e:
-			logging.error("Email: SMTP error {0}.".format(e))
-			self.connectFail = True
-			return False
-			
-		# tls
-		try:
-			self.mailserver.starttls()
-		except Exception as e:
-			logging.error("Email: SMTP error {0}.".format(e))
-			self.connectFail = True
-			return False
-			
-		# login
-		try:
-			self.mailserver.login(self.config['User'], self.config['Pass'])
-		except Exception as e:
-			logging.error("Email: SMTP error {0}.".format(e))
-			self.connectFail = True
-			return False
-
-		logging.info("Email: SMTP connected.")
-		self.connectFail = False
-		return True
-
-	def disconnect(self):
-		''' @fn disconnect
-			@brief : Disconnects from the mail server. 
-		'''
-	
-		try:
-			self.mailserver.quit()
-			logging.info("Email: SMTP disconnected.")
-		except Exception as e :
-			logging.error("Email: SMTP error {0}.".format(e))
-		self.mailserver = None
-
 	def isConnected(self):
 		''' @fn isConnected
-			@brief : Probes the status of the connection.
+			@brief : Session has an open connection, no round trip to the server.
 		'''
-		
-		if self.mailserver == None:
-			return False
-		try:
-			status = self.mailserver.noop()[0]
-		except Exception as e:
-			logging.error("Email: SMTP error {0}.".format(e))
-			status = -1
-		
-		if status == 250:
-			return True  
-		else: 
-			return False
+		return self.session.connected()
+
+	def getStats(self):
+		''' @fn getStats
+			@brief : Session counters and queued messages.
+		'''
+		stats = self.session.getStats()
+		stats.update(self.stats)
+		stats['Outbox'] = self.outbox.getStats()
+		return stats
 
 	def stop(self):
 		''' @fn destroy
 			@brief : Stops the worker thread and disconnects from the Smtp mail server.
 		'''
-		# Stop thread (will process remaining emails)
+		# Stop thread, undelivered emails stay in the outbox
+		self.stopThread = True
+		self.wakeup.set()
 		super(Email, self).stop()
 
 		# disconnect
-		if not self.connectFail:
-			self.disconnect()
+		self.session.close()
+		self.outbox.close()
 		
 		qsize = self.queueSize()
 		logging.info("Email: Total emails requested {0}.".format(self.totalEmailsRequested))
 		logging.info("Email: Total emails sent {0}.".format(self.totalEmailsSent))
 		logging.info("Email: Remaining jobs {0}.".format(qsize))
+		logging.info("Email: Session {0}.".format(self.session.getStats()))
 
 	def setDeviceName(self, deviceName):
 		'''
@@ -340,6 +924,7 @@ class Email(Model):
 			#logging.debug(' Report status: {0}.'.format(self.config['Report']['Status']))
 			
 			logging.info('Email: Config loaded from file.')
+			self.sessionConfig = copy.deepcopy(self.config)
 			self.configured = True
 
 		except Exception as e:
@@ -376,6 +961,7 @@ class Email(Model):
 
 			logging.debug('Email: SMTP set config.')
 
+			self.sessionConfig = copy.deepcopy(self.config)
 			self.configured = True
 			return True
 		except Exception as e:
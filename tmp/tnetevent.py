@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 ''' @file : tgEvent.py
 	@brief : Event handler.
@@ -10,12 +10,14 @@ import time
 import logging
 import logging.handlers
 import json
-import Queue
+import itertools
+import collections
+import threading
+import queue
 from functools import wraps
-from twisted.internet.protocol import Factory, Protocol
-from twisted.internet.endpoints import TCP4ServerEndpoint
 
-from tggateway.tgDataLogger import TnetEventLogger
+from tggateway.tgEventLog import EventLog
+from tggateway.tgStreamer import Streamer, StreamJournal
 from tggateway.tgModel import Model
 
 # Event classes
@@ -28,6 +30,7 @@ EVCLASS_EMAIL				= 'EML'
 EVCLASS_SMS 				= 'SMS'
 EVCLASS_GATEWAY				= 'GWY'
 EVCLASS_AUDVIS				= 'AUV'
+EVCLASS_EVENT				= 'EVT'
 
 # Event topics
 EVTOPIC_LIVE_DATA 			= '0'
@@ -42,6 +45,10 @@ EVTOPIC_TEMP_RESTART_SESH   = '006'
 EVTOPIC_TEMP_RESUME_SESH   	= '007'
 EVTOPIC_TEMP_NO_SENSORS     = '008'
 EVTOPIC_TEMP_NEW_DATA 		= '009'
+EVTOPIC_TEMP_SENSOR_FAULT 	= '010'
+EVTOPIC_TEMP_SENSOR_OK 		= '011'
+EVTOPIC_TEMP_DELTA_DATA 	= '012'
+EVTOPIC_TEMP_STATS 			= '013'
 
 EVTOPIC_SYS_NO_CONFIG 		= '100'
 EVTOPIC_SYS_SHUTDOWN 		= '101'
@@ -51,6 +58,7 @@ EVTOPIC_SYS_UPDATING 		= '104'
 EVTOPIC_SYS_DISKFULL  	 	= '105'
 EVTOPIC_SYS_POWERCHANGE    	= '106'
 EVTOPIC_SYS_BATTERYLOW 		= '107'
+EVTOPIC_SYS_METRICS			= '108'
 
 EVTOPIC_HAM_NO_CONFIG 		= '200'
 EVTOPIC_HAM_JOINED 			= '201'
@@ -88,11 +96,19 @@ EVTOPIC_NET_NO_CONFIG 		= '700'
 EVTOPIC_NET_IFACECHANGE 	= '701'
 EVTOPIC_NET_NOINET 			= '702'
 
+EVTOPIC_EVT_SUPPRESSED		= '800'
+
 
 # Event priorities
 EVENT_PRIORITY_LOW			= 0
 EVENT_PRIORITY_MEDIUM   	= 1
 EVENT_PRIORITY_HIGH			= 2
+EVENT_PRIORITIES			= (EVENT_PRIORITY_LOW, EVENT_PRIORITY_MEDIUM, EVENT_PRIORITY_HIGH)
+
+# events waiting to be processed before new ones are dropped
+EVENT_QUEUE_SIZE			= 50
+# events waiting on each action worker
+ACTION_QUEUE_SIZE			= 50
 
 # Event action types
 EVACTION_STREAM				= 1
@@ -100,79 +116,277 @@ EVACTION_NOTIFICATIONS		= 2
 EVACTION_AUDIOVISUAL   		= 3
 EVACTION_DATABASE 			= 4
 
-event_model = None
+# seconds a repeat of the same (class, topic, source) is suppressed after it was raised, state
+# changes (power source, interface, sensor fault/recovery) have no window as a suppressed change
+# would leave the last state downstream wrong
+EVENT_SUPPRESS_WINDOWS		= {(EVCLASS_TEMP, EVTOPIC_TEMP_ALRM_A1): 60,
+								(EVCLASS_TEMP, EVTOPIC_TEMP_ALRM_A2): 60,
+								(EVCLASS_SYSTEM, EVTOPIC_SYS_BATTERYLOW): 300}
+# longest the event thread blocks before checking for expired suppression windows
+EVENT_SUPPRESS_CHECK		= 1.0
 
+# human readable event time
+EVENT_TIME_FORMAT			= '%H:%M %d/%m/%Y'
 
-class StreamerProtocol(Protocol):
-	''' @class StreamerProtocol
-		@brief : Publishes data on socket. No receive.
-	'''
+event_model = None
 
-	def __init__(self, connections):
-		''' @class __init__
-			@brief : Initilise
-			@note : Reference to connections is a list of DataPublisher instances.
-		'''
-		self.connections = connections
+class AlarmEntry(collections.namedtuple('AlarmEntry', 'pos name temp a1 a2 state trigger')):
+	''' @class : AlarmEntry
+		@brief : One sensor of an A1/A2 alarm event.
+		@details : pos is an int and temp, a1 and a2 are numbers, state and trigger are the human
+				readable sensor alarm state and trigger. They are only formatted by serialize().
+	'''
+	__slots__ = ()
 
-	def connectionMade(self):
-		''' @fn connectionMade
-			@brief : New socket connection made. Add to list of connections.
+	@classmethod
+	def parse(cls, fields):
+		''' @fn parse
+			@brief : Entry from its serialized fields, raises ValueError when malformed.
 		'''
-		if self not in self.connections:
-			logging.debug('Streamer: Connection made.')
-			self.connections.append(self)
+		pos, name, temp, a1, a2, state, trigger = fields
+		return cls(int(pos), name, float(temp), float(a1), float(a2), state, trigger)
 
-	def connectionLost(self, reason):
-		''' @fn connectionLost
-			@brief : Lost socket connection. Remove from list of connections.
+	def serialize(self):
+		''' @fn serialize
+			@brief : Event data of the entry, 'pos,name,temp,a1,a2,state,trigger'.
 		'''
-		if self in self.connections:
-			logging.debug('Streamer: Connection closed. Reason = {}.'.format(reason))
-			self.connections.remove(self)
+		return '{},{},{:g},{:g},{:g},{},{}'.format(*self)
 
-	def publish(self, data):
-		''' @fn publish
-			@brief : Send data on socket
-		'''
-		self.transport.write(data)
-		logging.debug('Streamer: Data written {}.'.format(data))
+ALARM_ENTRY_FIELDS = len(AlarmEntry._fields)
 
 
-class StreamerFactory(Factory):
-	''' @class StreamerFactory
-		@brief : Data Publisher factory.
+class EventRecord(object):
+	''' @class : EventRecord
+		@brief : One raised event.
+		@details : Slotted, so a burst of events doesn't allocate a dictionary per event. The human
+				readable time is formatted on first use, the comma joined data is split once for
+				every consumer and serialize() is the one place the stream format is built.
 	'''
+	__slots__ = ('seq', 'evClass', 'evTopic', 'priority', 'data', 'actions', 'timestamp', '_time', '_fields', '_serialized')
 
-	def __init__(self):
-		''' @class __init__
-			@brief : Initilise
+	def __init__(self, seq, evClass, evTopic, priority, data, actions, timestamp=None):
+		''' @fn init
+			@brief : Class initialisation.
 		'''
-		self.connections = []
-
+		self.seq = seq
+		self.evClass = evClass
+		self.evTopic = evTopic
+		self.priority = priority
+		self.data = data
+		self.actions = actions
+		self.timestamp = time.time() if timestamp is None else timestamp
+		self._time = None
+		self._fields = None
+		self._serialized = None
+
+	@property
+	def time(self):
+		''' @fn time
+			@brief : Local time of the event as EVENT_TIME_FORMAT.
+		'''
+		if self._time is None:
+			self._time = time.strftime(EVENT_TIME_FORMAT, time.localtime(self.timestamp))
+		return self._time
 
-	def buildProtocol(self, addr):
-		''' @fn buildProtocol
-			@brief : Build protocol that will be handled by incomming connection.
-			@param addr : The socket address of the incomming connection.
+	def fields(self):
+		''' @fn fields
+			@brief : Data split on commas.
 		'''
+		if self._fields is None:
+			self._fields = tuple(self.data.split(',')) if self.data else ()
+		return self._fields
+
+	def alarmEntries(self):
+		''' @fn alarmEntries
+			@brief : Payload of an A1/A2 alarm event, 'global,pos,name,temp,a1,a2,state,trigger,...'.
+			@return : (global alarm state, list of AlarmEntry).
+			@exception ValueError : The data is not a list of alarm entries.
+		'''
+		fields = self.fields()
+		if len(fields) < 1 + ALARM_ENTRY_FIELDS or (len(fields) - 1) % ALARM_ENTRY_FIELDS != 0:
+			raise ValueError('alarm data has {} fields'.format(len(fields)))
+
+		entries = []
+		for i in range(1, len(fields), ALARM_ENTRY_FIELDS):
+			entries.append(AlarmEntry.parse(fields[i:i+ALARM_ENTRY_FIELDS]))
+		return fields[0], entries
+
+	def serialize(self):
+		''' @fn serialize
+			@brief : Stream wire format, '<class:topic:priority:data>'.
+		'''
+		if self._serialized is None:
+			self._serialized = '<{}:{}:{}:{}>'.format(self.evClass, self.evTopic, self.priority, self.data).encode()
+		return self._serialized
+
+	def __repr__(self):
+		return 'EventRecord(seq={}, class={}, topic={}, priority={}, actions={}, data={!r})'.format(self.seq,
+			self.evClass, self.evTopic, self.priority, self.actions, self.data)
+
+
+class EventSuppressor(object):
+	''' @class : EventSuppressor
+		@brief : Deduplication window per (class, topic, source).
+		@details : The first event of a key passes and opens a window of the configured length,
+				repeats inside the window are only counted. When a window with repeats closes a
+				summary is handed back by expire(), so downstream work follows distinct situations
+				rather than raw event counts. Topics without a window are never suppressed.
+	'''
+	def __init__(self, windows=EVENT_SUPPRESS_WINDOWS):
+		''' @fn init
+			@brief : Class initialisation.
+			@param windows : Dictionary of (class, topic) to window in seconds.
+		'''
+		self.windows = dict(windows)
+		self.lock = threading.Lock()
+		# key to [window end, suppressed, window start, priority, actions]
+		self.active = {}
+		self.summaries = []
+		self.stats = {'Passed': 0, 'Suppressed': 0, 'Summaries': 0}
+
+	def setWindow(self, evClass, evTopic, seconds):
+		''' @fn setWindow
+			@brief : Change the window of a topic, 0 stops suppressing it.
+		'''
+		with self.lock:
+			if seconds > 0:
+				self.windows[(evClass, evTopic)] = seconds
+			else:
+				self.windows.pop((evClass, evTopic), None)
+
+	def admit(self, evClass, evTopic, source, evPriority, evActions, now):
+		''' @fn admit
+			@brief : Event should be raised, False if it repeats one inside its window.
+		'''
+		with self.lock:
+			window = self.windows.get((evClass, evTopic))
+			if not window:
+				return True
+
+			key = (evClass, evTopic, source)
+			state = self.active.get(key)
+			if state is not None and now < state[0]:
+				state[1] += 1
+				self.stats['Suppressed'] += 1
+				return False
+
+			if state is not None and state[1] > 0:
+				self.summaries.append((key, state))
+
+			self.active[key] = [now + window, 0, now, evPriority, evActions]
+			self.stats['Passed'] += 1
+			return True
+
+	def expire(self, now):
+		''' @fn expire
+			@brief : Close windows that have ended.
+			@return : List of (class, topic, source, suppressed, seconds, priority, actions) for windows with repeats.
+		'''
+		with self.lock:
+			for key, state in list(self.active.items()):
+				if now >= state[0]:
+					del self.active[key]
+					if state[1] > 0:
+						self.summaries.append((key, state))
+
+			summaries = self.summaries
+			self.summaries = []
+			self.stats['Summaries'] += len(summaries)
+
+		expired = []
+		for (evClass, evTopic, source), (end, suppressed, start, evPriority, evActions) in summaries:
+			expired.append((evClass, evTopic, source, suppressed, end - start, evPriority, evActions))
+		return expired
+
+	def getStats(self):
+		''' @fn getStats
+			@brief : Passed, suppressed and summary counts and open windows.
+		'''
+		with self.lock:
+			stats = dict(self.stats)
+			stats['Windows'] = len(self.active)
+		return stats
 
-		logging.info('Streamer Factory: Incomming connection {0}.'.format(addr))
-		return StreamerProtocol(self.connections)
 
-	def publish(self, newData):
-		''' @class publish
-			@brief : Publish new data to all connections (listeners)
-			@param measurement : The data to send.
+class ActionWorker(Model):
+	''' @class : ActionWorker
+		@brief : Performs one action type for events on its own thread.
+		@details : Every action has its own bounded queue, so a slow or failing action
+				(database write, email) never delays the others (audiovisual alarm).
+	'''
+	def __init__(self, name, handler, maxsize=ACTION_QUEUE_SIZE):
+		''' @fn init
+			@brief : Class initialisation.
+			@param handler : Called with the EventRecord.
 		'''
-
-		if len(self.connections) == 0:
-			logging.debug('Streamer: No connections, nothing to publish.')
+		super(ActionWorker, self).__init__(name)
+		self.handler = handler
+		self.queue = queue.Queue(maxsize=maxsize)
+		self.statsLock = threading.Lock()
+		self.stats = {'Dispatched': 0, 'Dropped': 0, 'Done': 0, 'Failed': 0, 'LatencyTotal': 0.0, 'LatencyMax': 0.0}
+
+	def dispatch(self, event):
+		''' @fn dispatch
+			@brief : Queue event for the action, dropped if the action is backed up.
+		'''
+		try:
+			self.queue.put((time.time(), event), block=False)
+		except queue.Full:
+			logging.warning('{}: Queue full, dropped event {}:{}.'.format(self.name, event.evClass, event.evTopic))
+			with self.statsLock:
+				self.stats['Dropped'] += 1
 			return
 
-		for streamer in self.connections:
-			streamer.publish(newData)
+		with self.statsLock:
+			self.stats['Dispatched'] += 1
+
+	def getStats(self):
+		''' @fn getStats
+			@brief : Dispatched, dropped, done and failed counts and dispatch to completion latency.
+		'''
+		with self.statsLock:
+			stats = {'Dispatched': self.stats['Dispatched'],
+					'Dropped': self.stats['Dropped'],
+					'Done': self.stats['Done'],
+					'Failed': self.stats['Failed'],
+					'LatencyAvg': self.stats['LatencyTotal'] / self.stats['Done'] if self.stats['Done'] else 0.0,
+					'LatencyMax': self.stats['LatencyMax']}
+		stats['Queued'] = self.queue.qsize()
+		return stats
+
+	def run(self):
+		''' @fn run
+			@brief : Perform queued actions until stopped.
+		'''
+		while True:
+			dispatched, event = self.queue.get()
+			# None is the stop marker, queued behind pending actions
+			if event is None:
+				break
 
+			try:
+				self.handler(event)
+				failed = False
+			except Exception as e:
+				logging.error('{}: Failed on event {}:{} {}.'.format(self.name, event.evClass, event.evTopic, e))
+				failed = True
+
+			latency = time.time() - dispatched
+			with self.statsLock:
+				if failed:
+					self.stats['Failed'] += 1
+				else:
+					self.stats['Done'] += 1
+					self.stats['LatencyTotal'] += latency
+					self.stats['LatencyMax'] = max(self.stats['LatencyMax'], latency)
+
+	def stop(self):
+		''' @fn stop
+			@brief : Stop worker thread once the actions already queued are done.
+		'''
+		self.stopThread = True
+		self.queue.put((time.time(), None))
+		super(ActionWorker, self).stop()
 
 
 class Event(Model):
@@ -180,96 +394,228 @@ class Event(Model):
 		@brief : Event handling class.
 	'''
 	# def __init__(self, reactor, eventStreamer, emailPublisher, smsPublisher, ioHandler):
-	def __init__(self, reactor=None, notifications=None, audvis=None, streamPort=54113):
+	def __init__(self, reactor=None, notifications=None, audvis=None, streamPort=54113, eventLog=None,
+				suppressWindows=EVENT_SUPPRESS_WINDOWS, streamJournal=None):
 		''' @fn init
 			@brief : Class initialisation.
+			@param reactor : Unused, the streamer runs its own asyncio loop.
+			@param eventLog : Event log storage, defaults to the EventLog database.
+			@param suppressWindows : Dictionary of (class, topic) to deduplication window in seconds.
+			@param streamJournal : Journal of streamed events for resuming clients, defaults to the journal file.
 		'''
 		super(Event, self).__init__('Event')
-		self.streamFactory = StreamerFactory()
-		server = TCP4ServerEndpoint(reactor, interface='0.0.0.0', port=streamPort)
-		server.listen(self.streamFactory)
+		if streamJournal is None:
+			streamJournal = StreamJournal()
+		self.streamer = Streamer(port=streamPort, journal=streamJournal)
+		self.suppressor = EventSuppressor(suppressWindows)
 
 		self.notifications = notifications
 		self.audiovisual = audvis
 
-		self.queue = Queue.Queue(maxsize=50)
-		self.interval = 1
-		self.eventLogger = TnetEventLogger()
+		# highest priority first, in raise order within a priority
+		self.queue = queue.PriorityQueue(maxsize=EVENT_QUEUE_SIZE)
+		self.sequence = itertools.count()
+		self.statsLock = threading.Lock()
+		self.lastTempEvent = 0
+		self.stats = {}
+		for priority in EVENT_PRIORITIES:
+			self.stats[priority] = {'Enqueued': 0, 'Dropped': 0, 'Processed': 0, 'WaitTotal': 0.0, 'WaitMax': 0.0}
+		if eventLog is None:
+			eventLog = EventLog()
+		self.eventLog = eventLog
+
+		# one worker per action type
+		self.actions = {EVACTION_STREAM: ActionWorker('StreamAction', self.streamAction),
+						EVACTION_DATABASE: ActionWorker('DatabaseAction', self.databaseAction),
+						EVACTION_AUDIOVISUAL: ActionWorker('AudiovisualAction', self.audiovisualAction),
+						EVACTION_NOTIFICATIONS: ActionWorker('NotificationsAction', self.notificationsAction)}
 
 		logging.info('Event: Initialised.')
 
-	def raise_event(self, evClass, evTopic, evData, evPriority, evActions):
+	def raise_event(self, evClass, evTopic, evData, evPriority, evActions, source=None):
 		''' @fn raiseEvent
 			@brief : Put event on the queue.
+			@param source : What raised the event for deduplication, defaults to the data.
+			@return : The EventRecord, None if it was suppressed or dropped.
 		'''
+		now = time.time()
+		if not self.suppressor.admit(evClass, evTopic, evData if source is None else source, evPriority, evActions, now):
+			return None
 
-		event = {}
-		event['Class'] = evClass
-		event['Topic'] = evTopic
-		event['Priority'] = evPriority
-		event['Data'] = evData
-		event['Actions'] = evActions
-		# pk for database
-		event['Pk'] = int(time.time())
-		event['Time'] = time.strftime("%H:%M %d/%m/%Y", time.localtime(time.time()))
+		# sequence is the unique, increasing key for the event log
+		event = EventRecord(self.eventLog.nextSequence(), evClass, evTopic, evPriority, evData, evActions, now)
 
+		stats = self.stats.get(evPriority)
 		try:
-			self.queue.put(event,block=False)
-			logging.debug('Queue size = {}.'.format(self.queue.qsize()))
-		except Exception as e:
-			logging.warning(e)
+			self.queue.put((-evPriority, next(self.sequence), now, event), block=False)
+		except queue.Full:
+			logging.warning('Event: Queue full, dropped event {}:{} priority {}.'.format(evClass, evTopic, evPriority))
+			if stats is not None:
+				with self.statsLock:
+					stats['Dropped'] += 1
+			return None
 
-	def run(self):
+		if stats is not None:
+			with self.statsLock:
+				stats['Enqueued'] += 1
 
-		lastTempEvent = 0
-		while True:
+		return event
 
-			time.sleep(0.5)
+	raiseEvent = raise_event
 
-			if self.stopThread:
-				break
+	def getStats(self):
+		''' @fn getStats
+			@brief : Enqueued, dropped and processed counts and queue wait in seconds per priority.
+		'''
+		stats = {}
+		with self.statsLock:
+			for priority in EVENT_PRIORITIES:
+				counters = self.stats[priority]
+				stats[priority] = {'Enqueued': counters['Enqueued'],
+								'Dropped': counters['Dropped'],
+								'Processed': counters['Processed'],
+								'WaitAvg': counters['WaitTotal'] / counters['Processed'] if counters['Processed'] else 0.0,
+								'WaitMax': counters['WaitMax']}
+		stats['Queued'] = self.queue.qsize()
+		stats['Suppression'] = self.suppressor.getStats()
+		stats['Actions'] = {}
+		for action, worker in self.actions.items():
+			stats['Actions'][worker.name] = worker.getStats()
+		stats['EventLog'] = self.eventLog.getStats()
+		stats['Streamer'] = self.streamer.getStats()
+		return stats
+
+	def queryEvents(self, evClass=None, evTopic=None, since=None, until=None, limit=100):
+		''' @fn queryEvents
+			@brief : Recent events from the event log, newest first.
+		'''
+		return self.eventLog.query(evClass, evTopic, since, until, limit)
 
-			if self.queue.qsize() == 0:
-				continue
+	def start(self):
+		''' @fn start
+			@brief : Start action workers then the event thread.
+		'''
+		self.eventLog.start()
+		self.streamer.start()
+		for worker in self.actions.values():
+			worker.start()
+		super(Event, self).start()
 
-			# pull from queue
-			event = self.queue.get()
-			self.queue.task_done()
+	def run(self):
+		''' @fn run
+			@brief : Block on the queue and drain everything available per wakeup.
+		'''
+		while not self.stopThread:
+
+			# wakes at least every check period to close suppression windows
+			events = []
+			try:
+				events.append(self.queue.get(timeout=EVENT_SUPPRESS_CHECK))
+			except queue.Empty:
+				pass
+
+			while True:
+				try:
+					events.append(self.queue.get_nowait())
+				except queue.Empty:
+					break
+
+			for priority, sequence, enqueued, event in events:
+				# None is the stop marker
+				if event is None or self.stopThread:
+					break
+
+				wait = time.time() - enqueued
+				stats = self.stats.get(event.priority)
+				if stats is not None:
+					with self.statsLock:
+						stats['Processed'] += 1
+						stats['WaitTotal'] += wait
+						stats['WaitMax'] = max(stats['WaitMax'], wait)
+
+				try:
+					self.processEvent(event)
+				except Exception as e:
+					logging.error('Event: Error processing event {}:{} {}.'.format(event.evClass, event.evTopic, e))
+
+			self.raiseSummaries(time.time())
+
+	def raiseSummaries(self, now):
+		''' @fn raiseSummaries
+			@brief : Raise a summary event for every closed suppression window with repeats.
+			@details : Data is 'class,topic,suppressed,seconds,source', the summary goes to the stream
+					and database when the suppressed event did.
+		'''
+		for evClass, evTopic, source, suppressed, seconds, evPriority, evActions in self.suppressor.expire(now):
+			logging.info('Event: {} {}:{} events suppressed in last {:.0f} s.'.format(suppressed, evClass, evTopic, seconds))
+			actions = [action for action in evActions if action in (EVACTION_STREAM, EVACTION_DATABASE)]
+			self.raise_event(EVCLASS_EVENT, EVTOPIC_EVT_SUPPRESSED, '{},{},{},{:.0f},{}'.format(evClass, evTopic, suppressed, seconds, source),
+				evPriority, actions)
+
+	def stop(self):
+		''' @fn stop
+			@brief : Stop event thread, wakes it with a stop marker ahead of any queued event.
+		'''
+		self.stopThread = True
+		try:
+			self.queue.put((-(EVENT_PRIORITY_HIGH+1), next(self.sequence), time.time(), None), block=False)
+		except queue.Full:
+			pass
+		super(Event, self).stop()
+
+		for worker in self.actions.values():
+			worker.stop()
+		self.eventLog.stop()
+		self.streamer.stop()
+
+	def processEvent(self, event):
+		''' @fn processEvent
+			@brief : Perform the actions of one event.
+		'''
+		# lazy, the record is only formatted when debug logging is on
+		logging.debug('Event: %r.', event)
 
-			logging.debug('Class = {} Topic = {} Priority = {} Action = {} Data = {} Time = {} Pk = {}.'.format(
-				event['Class'],
-				event['Topic'],
-				event['Priority'],
-				event['Actions'],
-				event['Data'],
-				event['Time'],
-				event['Pk']))
 
+		# temperature event not received for some time, do something
+		if event.evTopic in (EVTOPIC_TEMP_NEW_DATA, EVTOPIC_TEMP_DELTA_DATA):
+			# something wrong? have not received temperature event in 3 minutes
+			if self.lastTempEvent != 0 and (time.time() - self.lastTempEvent) >= 180:
+				logging.warning('Event: Not received temperature event in 3 minutes.')
 
-			# temperature event not received for some time, do something
-			if event['Topic'] == EVTOPIC_TEMP_NEW_DATA:
-				# something wrong? have not received temperature event in 3 minutes
-				if lastTempEvent != 0 and (time.time() - lastTempEvent) >= 180:
-					logging.warning('Event: Not received temperature event in 3 minutes.')
+			self.lastTempEvent = time.time()
 
-				lastTempEvent = time.time()
+		# hand the event to the worker of each action to perform
+		for action in event.actions:
+			worker = self.actions.get(action)
+			if worker is None:
+				logging.warning('Event: Unknown action {}.'.format(action))
+				continue
 
-			# what action(s) to perform for this event
-			# to stream
-			if EVACTION_STREAM in event['Actions']:
-				self.streamFactory.publish('<{}:{}:{}:{}>'.format(event['Class'], event['Topic'], event['Priority'], event['Data']))
+			worker.dispatch(event)
 
-			# to database
-			if EVACTION_DATABASE in event['Actions']:
-				self.eventLogger.log(event['Pk'], event['Class'], event['Topic'], event['Priority'], event['Data'])
+	def streamAction(self, event):
+		''' @fn streamAction
+			@brief : Publish event to stream listeners, the mqtt server bridges live data from the stream.
+		'''
+		self.streamer.publish(event.evClass, event.evTopic, event.serialize())
 
-			# to audio visual
-			if EVACTION_AUDIOVISUAL in event['Actions']:
-				self.audiovisual.alert(event['Topic'])
+	def databaseAction(self, event):
+		''' @fn databaseAction
+			@brief : Add event to the next event log batch.
+		'''
+		self.eventLog.log(event.seq, event.timestamp, event.evClass, event.evTopic, event.priority, event.data)
 
-			# to notifications
-			if EVACTION_NOTIFICATIONS in event['Actions']:
-				self.notifications.alert(event)
+	def audiovisualAction(self, event):
+		''' @fn audiovisualAction
+			@brief : Drive the buzzer and lights.
+		'''
+		self.audiovisual.alert(event.evTopic)
+
+	def notificationsAction(self, event):
+		''' @fn notificationsAction
+			@brief : Send email and sms notifications.
+		'''
+		self.notifications.alert(event)
 
 
 def event_start():
@@ -285,8 +631,76 @@ def event_stop():
 	global event_model
 	event_model.stop()
 
-def event_raise(ev_class, ev_topic, ev_data, ev_priority, ev_actions):
+def event_raise(ev_class, ev_topic, ev_data, ev_priority, ev_actions, source=None):
 	''' raise an event '''
 
 	global event_model
-	event_model.raise_event(ev_class, ev_topic, ev_data, ev_priority, ev_actions)
+	event_model.raise_event(ev_class, ev_topic, ev_data, ev_priority, ev_actions, source)
+
+
+def benchmarkRecords(count=1000):
+	''' @fn benchmarkRecords
+		@brief : Allocation and CPU cost per event of the former dictionary events against EventRecord.
+		@details : Every event is built, serialized for the stream and its data split for two
+				consumers, i.e. one second of a 1000 events/s burst.
+		@return : Dictionary of name to (bytes held per event, microseconds of cpu per event).
+	'''
+	import tracemalloc
+
+	data = 'Current A2 alarms,3,Freezer,41,30,40,A2 alarm,A2 rising'
+	actions = [EVACTION_STREAM, EVACTION_DATABASE, EVACTION_NOTIFICATIONS]
+
+	def dictEvent(seq):
+		event = {}
+		event['Class'] = EVCLASS_TEMP
+		event['Topic'] = EVTOPIC_TEMP_ALRM_A2
+		event['Priority'] = EVENT_PRIORITY_HIGH
+		event['Data'] = data
+		event['Actions'] = actions
+		event['Seq'] = seq
+		event['Timestamp'] = time.time()
+		event['Time'] = time.strftime(EVENT_TIME_FORMAT, time.localtime(event['Timestamp']))
+		stream = '<{}:{}:{}:{}>'.format(event['Class'], event['Topic'], event['Priority'], event['Data']).encode()
+		event['Data'].split(',')
+		event['Data'].split(',')
+		return event, stream
+
+	def recordEvent(seq):
+		event = EventRecord(seq, EVCLASS_TEMP, EVTOPIC_TEMP_ALRM_A2, EVENT_PRIORITY_HIGH, data, actions)
+		event.fields()
+		event.fields()
+		return event, event.serialize()
+
+	results = {}
+	for name, build in (('Dict', dictEvent), ('Record', recordEvent)):
+		tracemalloc.start()
+		events = [build(i) for i in range(count)]
+		held = tracemalloc.get_traced_memory()[0]
+		tracemalloc.stop()
+		del events
+
+		start = time.process_time()
+		for i in range(count):
+			build(i)
+		cpu = time.process_time() - start
+		results[name] = (float(held) / count, cpu * 1e6 / count)
+
+	return results
+
+
+if __name__ == '__main__':
+
+	# root logger
+	logger = logging.getLogger('')
+	logger.setLevel(logging.INFO)
+
+	# format for logging
+	format = logging.Formatter(fmt='%(asctime)s %(levelname)8s [%(module)10s.%(funcName)10s %(lineno)d] %(message)s', datefmt='%b %d %H:%M:%S')
+
+	# add stdout stream handler
+	stdouth = logging.StreamHandler(sys.stdout)
+	stdouth.setFormatter(format)
+	logger.addHandler(stdouth)
+
+	for name, (held, cpu) in sorted(benchmarkRecords().items()):
+		logging.info('Event: {} {:.0f} bytes held, {:.1f} us cpu per event.'.format(name, held, cpu))
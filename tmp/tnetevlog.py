@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+
+''' @file : tgEventLog.py
+	@brief : Batched event log storage.
+'''
+
+import sys
+import time
+import logging
+import sqlite3
+import threading
+
+from tggateway.tgModel import Model
+
+EVENT_LOG_FILE				= '/home/tgard/db/events.db'
+
+# commit after this many events or this many seconds, whichever comes first
+EVENT_LOG_BATCH_SIZE		= 100
+EVENT_LOG_BATCH_INTERVAL	= 0.5
+# events kept for another attempt while commits fail, the oldest are dropped beyond it
+EVENT_LOG_MAX_PENDING		= 10 * EVENT_LOG_BATCH_SIZE
+
+# rows returned by query when no limit is given
+EVENT_LOG_QUERY_LIMIT		= 100
+
+EVENT_LOG_SCHEMA = (
+	'CREATE TABLE IF NOT EXISTS events (Seq INTEGER PRIMARY KEY, Time REAL, Class TEXT, Topic TEXT, Priority INTEGER, Data TEXT)',
+	'CREATE INDEX IF NOT EXISTS events_time ON events (Time)',
+	'CREATE INDEX IF NOT EXISTS events_class_topic_time ON events (Class, Topic, Time)')
+
+
+class EventLog(Model):
+	''' @class : EventLog
+		@brief : Event log writer, events are committed in batches from the writer thread.
+		@details : Every event gets a sequence number from nextSequence(), unique and increasing
+				across restarts, which is the primary key of the events table.
+	'''
+	def __init__(self, path=EVENT_LOG_FILE, batchSize=EVENT_LOG_BATCH_SIZE, batchInterval=EVENT_LOG_BATCH_INTERVAL,
+				maxPending=EVENT_LOG_MAX_PENDING):
+		''' @fn init
+			@brief : Class initialisation.
+		'''
+		super(EventLog, self).__init__('EventLog')
+		self.path = path
+		self.batchSize = batchSize
+		self.batchInterval = batchInterval
+		self.maxPending = maxPending
+		self.lock = threading.Lock()
+		self.dbLock = threading.Lock()
+		self.wakeup = threading.Event()
+		self.pending = []
+		self.stats = {'Logged': 0, 'Committed': 0, 'Batches': 0, 'Failed': 0, 'Dropped': 0}
+
+		self.db = sqlite3.connect(path, check_same_thread=False)
+		with self.db:
+			for statement in EVENT_LOG_SCHEMA:
+				self.db.execute(statement)
+
+		last = self.db.execute('SELECT MAX(Seq) FROM events').fetchone()[0]
+		self.sequence = 0 if last is None else last
+
+		logging.info('EventLog: Initialised at sequence {}.'.format(self.sequence))
+
+	def nextSequence(self):
+		''' @fn nextSequence
+			@brief : Reserve the next event sequence number.
+		'''
+		with self.lock:
+			self.sequence += 1
+			return self.sequence
+
+	def log(self, seq, evTime, evClass, evTopic, evPriority, evData):
+		''' @fn log
+			@brief : Add event to the next batch.
+		'''
+		with self.lock:
+			self.pending.append((seq, evTime, evClass, evTopic, evPriority, evData))
+			self.stats['Logged'] += 1
+			full = len(self.pending) >= self.batchSize
+
+		if full:
+			self.wakeup.set()
+
+	def flush(self):
+		''' @fn flush
+			@brief : Commit pending events in one transaction.
+		'''
+		with self.lock:
+			batch = self.pending
+			self.pending = []
+
+		if not batch:
+			return
+
+		try:
+			with self.dbLock:
+				with self.db:
+					self.db.executemany('INSERT OR REPLACE INTO events VALUES (?,?,?,?,?,?)', batch)
+
+		except sqlite3.Error as e:
+			logging.error('EventLog: Commit of {} events failed {}.'.format(len(batch), e))
+			# keep the events for the next attempt, a disk that stays full or read only mustn't use up memory
+			with self.lock:
+				self.pending[:0] = batch
+				self.stats['Failed'] += 1
+				excess = len(self.pending) - self.maxPending
+				if excess > 0:
+					del self.pending[:excess]
+					self.stats['Dropped'] += excess
+			if excess > 0:
+				logging.error('EventLog: Dropped {} oldest events.'.format(excess))
+			return
+
+		with self.lock:
+			self.stats['Committed'] += len(batch)
+			self.stats['Batches'] += 1
+
+	def query(self, evClass=None, evTopic=None, since=None, until=None, limit=EVENT_LOG_QUERY_LIMIT):
+		''' @fn query
+			@brief : Most recent events, newest first.
+			@param since : Earliest event time, seconds since the epoch.
+			@param until : Latest event time, seconds since the epoch.
+			@return : List of event dictionaries.
+		'''
+		# events still waiting in the batch are part of the result
+		self.flush()
+
+		conditions = []
+		args = []
+		if evClass is not None:
+			conditions.append('Class = ?')
+			args.append(evClass)
+		if evTopic is not None:
+			conditions.append('Topic = ?')
+			args.append(evTopic)
+		if since is not None:
+			conditions.append('Time >= ?')
+			args.append(since)
+		if until is not None:
+			conditions.append('Time <= ?')
+			args.append(until)
+
+		sql = 'SELECT Seq, Time, Class, Topic, Priority, Data FROM events'
+		if conditions:
+			sql += ' WHERE ' + ' AND '.join(conditions)
+		sql += ' ORDER BY Time DESC, Seq DESC LIMIT ?'
+		args.append(limit)
+
+		with self.dbLock:
+			rows = self.db.execute(sql, args).fetchall()
+
+		events = []
+		for seq, evTime, evClass, evTopic, evPriority, evData in rows:
+			events.append({'Seq': seq, 'Time': evTime, 'Class': evClass, 'Topic': evTopic, 'Priority': evPriority, 'Data': evData})
+		return events
+
+	def getStats(self):
+		''' @fn getStats
+			@brief : Logged, committed, batch, failed commit and dropped event counts.
+		'''
+		with self.lock:
+			stats = dict(self.stats)
+			stats['Pending'] = len(self.pending)
+		return stats
+
+	def run(self):
+		''' @fn run
+			@brief : Commit a batch when it is full or the batch interval has passed.
+		'''
+		while not self.stopThread:
+			self.wakeup.wait(self.batchInterval)
+			self.wakeup.clear()
+			self.flush()
+
+		self.flush()
+
+	def stop(self):
+		''' @fn stop
+			@brief : Stop writer thread, pending events are committed on the way out.
+		'''
+		self.stopThread = True
+		self.wakeup.set()
+		super(EventLog, self).stop()
+		self.flush()
+
+	def close(self):
+		''' @fn close
+			@brief : Close the database.
+		'''
+		with self.dbLock:
+			self.db.close()
+
+
+if __name__ == '__main__':
+
+	# root logger
+	logger = logging.getLogger('')
+	logger.setLevel(logging.INFO)
+
+	# format for logging
+	format = logging.Formatter(fmt='%(asctime)s %(levelname)8s [%(module)10s.%(funcName)10s %(lineno)d] %(message)s', datefmt='%b %d %H:%M:%S')
+
+	# add stdout stream handler
+	stdouth = logging.StreamHandler(sys.stdout)
+	stdouth.setFormatter(format)
+	logger.addHandler(stdouth)
+
+	# log a burst of events to a scratch database and report the rate
+	path = sys.argv[1] if len(sys.argv) > 1 else ':memory:'
+	eventLog = EventLog(path=path)
+	eventLog.start()
+	start = time.time()
+	for i in range(10000):
+		eventLog.log(eventLog.nextSequence(), time.time(), 'TMP', '009', 2, 'benchmark {}'.format(i))
+	eventLog.stop()
+	elapsed = time.time() - start
+	logging.info('EventLog: {:.0f} events/s, {}.'.format(10000 / elapsed, eventLog.getStats()))
+	logging.info('EventLog: Latest {}.'.format(eventLog.query(evClass='TMP', limit=1)))
+	eventLog.close()
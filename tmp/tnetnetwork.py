@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 ''' @file : tgNetwork.py
 	@brief : Network manager.
@@ -10,19 +10,25 @@ import sys
 import os
 import subprocess
 import json
-import string
-
-import ConfigParser
+import copy
+import socket
+import struct
+import fcntl
+import threading
+import collections
+
+import configparser
 import dbus
 import dbus.service
 import dbus.mainloop.glib
-import gobject
+from gi.repository import GLib
 
 from tggateway.tgModel import Model
 import tggateway.tgEvent as tgEvent
 import tggateway.tgModem as tgmodem
 import tggateway.tgConnman as tgconnman
 import tggateway.tgHamachi as tghamachi
+import tggateway.tgUtils as tgutils
 
 INTERFACE_UNKNOWN 	= 0
 INTERFACE_ETHERNET 	= 1
@@ -35,6 +41,26 @@ TECHNOLOGY_ETH = '/net/connman/technology/ethernet'
 TECHNOLOGY_WIFI = '/net/connman/technology/wifi'
 TECHNOLOGY_CELL = '/net/connman/technology/cellular'
 
+CONNMAN_SERVICE = 'net.connman'
+OFONO_SERVICE = 'org.ofono'
+
+# connman service type to the interface prefix of its route
+ROUTE_PREFIX = collections.OrderedDict([('ethernet', 'eth'), ('wifi', 'wlan'), ('cellular', 'wwan')])
+
+PROC_NET_ROUTE = '/proc/net/route'
+# ioctl request for the IPv4 address of an interface, linux/sockios.h
+SIOCGIFADDR = 0x8915
+RTF_UP = 0x0001
+RTF_GATEWAY = 0x0002
+
+# lookups are answered from the cache this long, the state tracker clears it on any change
+NETWORK_CACHE_TIME = 5.0
+
+# longest wait for a change before the network thread checks it should stop
+NETWORK_WAIT = 1.0
+# the modem loop retries a mobile connection this often while there is no wifi or ethernet
+NETWORK_MODEM_PERIOD = 10
+
 
 
 class Agent(dbus.service.Object):
@@ -91,11 +117,11 @@ class Agent(dbus.service.Object):
 	def RequestInput(self, path, fields):
 		response = {}
 
-		if fields.has_key("Name"):
+		if "Name" in fields:
 			response.update(self.input_hidden())
-		if fields.has_key("Passphrase"):
+		if "Passphrase" in fields:
 			response.update(self.input_passphrase())
-		if fields.has_key("Username"):
+		if "Username" in fields:
 			response.update(self.input_username())
 
 		logging.debug('Connman: Request input = {}.'.format(response))
@@ -207,13 +233,13 @@ class ConnmanClient:
 		except Exception as e:
 			logging.warning("Agent: Unregister agent exception e={}".format(e))
 
-		if credentials.has_key("name"):
+		if "name" in credentials:
 			self.agent.name = credentials["name"]
 			logging.debug('Agent: Name given = {}.'.format(credentials["name"]))
-		if credentials.has_key("passphrase"):
+		if "passphrase" in credentials:
 			#logging.debug('Agent: Passphrase given = {}.'.format(credentials["passphrase"]))
 			self.agent.passphrase = credentials["passphrase"]
-		if credentials.has_key("identity"):
+		if "identity" in credentials:
 			logging.debug('Agent: Identity given = {}.'.format(credentials["identity"]))
 			self.agent.identity = credentials["identity"]
 
@@ -222,11 +248,11 @@ class ConnmanClient:
 			error_handler=self.handle_connect_error)
 
 		global loop
-		loop = gobject.MainLoop()
+		loop = GLib.MainLoop()
 		loop.run()
 
 	def autoconnect(self):
-		timeout = gobject.timeout_add(1000*self.autoconnect_timeout, self.autoconnect_timeout_handler)
+		timeout = GLib.timeout_add(1000*self.autoconnect_timeout, self.autoconnect_timeout_handler)
 
 		signal = self.bus.add_signal_receiver(property_changed,
 			bus_name="net.connman",
@@ -234,10 +260,10 @@ class ConnmanClient:
 			signal_name="PropertyChanged")
 
 		global loop
-		loop = gobject.MainLoop()
+		loop = GLib.MainLoop()
 		loop.run()
 
-		gobject.source_remove(timeout)
+		GLib.source_remove(timeout)
 		signal.remove()
 
 	def disconnect(self, ServiceId):
@@ -304,7 +330,7 @@ class ConnmanClient:
 
 
 	def setConfig(self, **param):
-		config = ConfigParser.RawConfigParser()
+		config = configparser.RawConfigParser()
 		config.optionxform = str
 		config.read(CONF_FILE)
 
@@ -313,14 +339,14 @@ class ConnmanClient:
 		config.add_section(section)
 		config.set(section, "Type", "wifi")
 		for item in param:
-			if param.has_key(item):
+			if item in param:
 				config.set(section, item, param[item])
 
 		with open(CONF_FILE, 'w') as configfile:
 			config.write(configfile)
 
 	def clearConfig(self, name):
-		config = ConfigParser.RawConfigParser()
+		config = configparser.RawConfigParser()
 		config.read(CONF_FILE)
 
 		section = "service_"+name
@@ -330,6 +356,58 @@ class ConnmanClient:
 			config.write(configfile)
 
 
+# name to (time, value) of the recent route and address lookups
+lookupCache = {}
+lookupLock = threading.Lock()
+ioctlSocket = None
+
+def cachedLookup(key, lookup):
+	''' @brief : Value of a lookup from the cache while it is fresh, the lookup itself runs unlocked. '''
+
+	now = time.time()
+	with lookupLock:
+		entry = lookupCache.get(key)
+	if entry is not None and now - entry[0] < NETWORK_CACHE_TIME:
+		return entry[1]
+
+	value = lookup()
+	with lookupLock:
+		lookupCache[key] = (now, value)
+	return value
+
+def clearLookupCache():
+	''' @brief : Forget every cached route and address, called when the network changes. '''
+
+	with lookupLock:
+		lookupCache.clear()
+
+def interfaceAddress(ifname):
+	''' @brief : IPv4 address of an interface by ioctl, None if it has none or does not exist. '''
+
+	global ioctlSocket
+	with lookupLock:
+		if ioctlSocket is None:
+			ioctlSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		try:
+			ifreq = fcntl.ioctl(ioctlSocket.fileno(), SIOCGIFADDR, struct.pack('256s', ifname[:15].encode()))
+		except (IOError, OSError):
+			return None
+
+	# struct ifreq is the name then a sockaddr_in, its address is 4 bytes into it
+	return socket.inet_ntoa(ifreq[20:24])
+
+def readDefaultRoute(path=PROC_NET_ROUTE):
+	''' @brief : Interface of the default gateway route in the kernel table, '' if there is none. '''
+
+	with open(path) as routes:
+		next(routes)
+		for line in routes:
+			fields = line.split()
+			if len(fields) > 3 and fields[1] == '00000000' and int(fields[3], 16) & (RTF_UP | RTF_GATEWAY) == RTF_UP | RTF_GATEWAY:
+				return fields[0]
+
+	return ''
+
 def getIpAddress(iface):
 	''' @fn getIpAddress
 	    @brief : Get active interface IP address
@@ -338,8 +416,8 @@ def getIpAddress(iface):
 	for i in range(3):
 		ifname = "{}{}".format(iface,i)
 		try:
-			ipaddr = os.popen('ifconfig {} | grep "inet\ addr" | cut -d: -f2 | cut -d" " -f1'.format(ifname)).read().strip()
-			if string.count(ipaddr, '.') == 3:
+			ipaddr = cachedLookup(ifname, lambda: interfaceAddress(ifname))
+			if ipaddr:
 				logging.debug('Network: IP address for {} = {}.'.format(ifname, ipaddr))
 				return ipaddr
 		except Exception as e:
@@ -348,11 +426,30 @@ def getIpAddress(iface):
 def getDefaultRoute():
 	''' @brief : Try determine default route.'''
 	try:
-		return os.popen('route -n | grep UG | tr -s [:blank:] | cut -d" " -f8').read().strip()
-	except:
+		return cachedLookup('route', readDefaultRoute)
+	except Exception:
 		logging.debug('Network: Unable to determine default route.')
 		return ''
 
+def resolveRoute(route):
+	''' @brief : Interface prefix and address of the default route from the state tracker, completed
+			from the kernel. The address comes from the interface while connman hasn't reported one
+			yet, and without an online connman service the kernel default route is used, e.g. a modem
+			bearer brought up by oFono outside connman. '''
+
+	prefix, address = route
+	if prefix is None:
+		ifname = getDefaultRoute()
+		prefix = ifname.rstrip('0123456789')
+		if prefix not in ROUTE_PREFIX.values():
+			return (None, None)
+		address = cachedLookup(ifname, lambda: interfaceAddress(ifname))
+
+	elif not address:
+		address = getIpAddress(prefix)
+
+	return (prefix, address)
+
 def routeToInterface(route):
 	''' @brief : Change gw route to interface. '''
 
@@ -379,12 +476,227 @@ def httpReply(httpObj=None, responseData={}):
 
 
 
+def routeFromServices(services):
+	''' @brief : Interface prefix and address of the first online service, connman lists the
+			default route first. '''
+
+	for path, properties in services.items():
+		if properties.get('State') == 'online' and properties.get('Type') in ROUTE_PREFIX:
+			return (ROUTE_PREFIX[properties['Type']], properties.get('IPv4', {}).get('Address'))
+
+	return (None, None)
+
+
+class NetworkState(object):
+	''' @brief : Connman services, default route and modems kept in memory from D-Bus signals.
+
+		The model is loaded once from GetServices, GetProperties and GetModems and then updated by
+		ServicesChanged and PropertyChanged of connman and by the oFono modem signals, it is loaded
+		again when either daemon restarts. The signals are dispatched by a GLib main loop running
+		in its own thread, queries are answered from the model without any D-Bus call. '''
+
+	def __init__(self, bus=None):
+		self.bus = bus
+		self.lock = threading.Lock()
+		# set whenever the route, the connman state or a modem changes
+		self.changed = threading.Event()
+		self.services = collections.OrderedDict()
+		self.managerState = 'offline'
+		self.modems = {}
+		self.route = (None, None)
+		self.receivers = []
+		self.loop = None
+		self.thread = None
+		self.stats = {'Updates': 0, 'Loads': 0, 'Changes': 0}
+
+	def start(self):
+		''' @brief : Subscribe to the signals, load the model and run the main loop. '''
+
+		if self.bus is None:
+			self.bus = tgutils.dbus_cache.bus()
+
+		# subscribe first so no change is lost between the load and the first signal
+		for handler, kwargs in ((self.servicesChanged, {'signal_name': 'ServicesChanged', 'dbus_interface': 'net.connman.Manager'}),
+								(self.managerChanged, {'signal_name': 'PropertyChanged', 'dbus_interface': 'net.connman.Manager'}),
+								(self.serviceChanged, {'signal_name': 'PropertyChanged', 'dbus_interface': 'net.connman.Service', 'path_keyword': 'path'}),
+								(self.modemAdded, {'signal_name': 'ModemAdded', 'dbus_interface': 'org.ofono.Manager'}),
+								(self.modemRemoved, {'signal_name': 'ModemRemoved', 'dbus_interface': 'org.ofono.Manager'}),
+								(self.modemChanged, {'signal_name': 'PropertyChanged', 'dbus_interface': 'org.ofono.Modem', 'path_keyword': 'path'}),
+								(self.ownerChanged, {'signal_name': 'NameOwnerChanged', 'dbus_interface': 'org.freedesktop.DBus', 'arg0': CONNMAN_SERVICE}),
+								(self.ownerChanged, {'signal_name': 'NameOwnerChanged', 'dbus_interface': 'org.freedesktop.DBus', 'arg0': OFONO_SERVICE})):
+			self.receivers.append(self.bus.add_signal_receiver(handler, **kwargs))
+
+		self.loadConnman()
+		self.loadOfono()
+		self.update()
+
+		self.loop = GLib.MainLoop()
+		self.thread = threading.Thread(target=self.loop.run, name='NetworkState')
+		self.thread.daemon = True
+		self.thread.start()
+
+	def stop(self):
+		''' @brief : Unsubscribe and stop the main loop. '''
+
+		for receiver in self.receivers:
+			receiver.remove()
+		self.receivers = []
+
+		if self.loop is not None:
+			self.loop.quit()
+			self.thread.join()
+			self.loop = None
+
+	def loadConnman(self):
+		''' @brief : Load services and state from connman, empty while it is not running. '''
+
+		services = collections.OrderedDict()
+		state = 'offline'
+		try:
+			for path, properties in tgutils.dbus_cache.call(CONNMAN_SERVICE, '/', 'net.connman.Manager', 'GetServices'):
+				services[str(path)] = dict(properties)
+			state = str(tgutils.dbus_cache.call(CONNMAN_SERVICE, '/', 'net.connman.Manager', 'GetProperties').get('State', 'offline'))
+		except dbus.exceptions.DBusException as e:
+			logging.warning('Network: Load connman error {}.'.format(e))
+
+		with self.lock:
+			self.services = services
+			self.managerState = state
+			self.stats['Loads'] += 1
+
+	def loadOfono(self):
+		''' @brief : Load modems from oFono, empty while it is not running. '''
+
+		modems = {}
+		try:
+			for path, properties in tgutils.dbus_cache.call(OFONO_SERVICE, '/', 'org.ofono.Manager', 'GetModems'):
+				modems[str(path)] = dict(properties)
+		except dbus.exceptions.DBusException as e:
+			logging.debug('Network: Load ofono error {}.'.format(e))
+
+		with self.lock:
+			self.modems = modems
+			self.stats['Loads'] += 1
+
+	def update(self, modem=False):
+		''' @brief : Work out the route again and wake the network thread if anything it acts on changed. '''
+
+		with self.lock:
+			self.stats['Updates'] += 1
+			route = routeFromServices(self.services)
+			if route == self.route and not modem:
+				return
+			self.route = route
+			self.stats['Changes'] += 1
+
+		clearLookupCache()
+		self.changed.set()
+
+	def servicesChanged(self, changed, removed):
+		''' @brief : Services added, changed or reordered, the changed list holds every service in order. '''
+
+		with self.lock:
+			services = collections.OrderedDict()
+			for path, properties in changed:
+				path = str(path)
+				services[path] = self.services.get(path, {})
+				services[path].update(properties)
+			self.services = services
+
+		self.update()
+
+	def managerChanged(self, name, value):
+		''' @brief : Connman state idle, ready or online. '''
+
+		if name == 'State':
+			with self.lock:
+				self.managerState = str(value)
+			self.update(modem=True)
+
+	def serviceChanged(self, name, value, path=None):
+		''' @brief : Property of one service, State and IPv4 move the route. '''
+
+		with self.lock:
+			if path in self.services:
+				self.services[path][str(name)] = value
+		self.update()
+
+	def modemAdded(self, path, properties):
+		''' @brief : Modem appeared, usually after ofono starts or the modem is powered. '''
+
+		with self.lock:
+			self.modems[str(path)] = dict(properties)
+		self.update(modem=True)
+
+	def modemRemoved(self, path):
+		''' @brief : Modem went away. '''
+
+		with self.lock:
+			self.modems.pop(str(path), None)
+		self.update(modem=True)
+
+	def modemChanged(self, name, value, path=None):
+		''' @brief : Property of one modem, only Powered and Online wake the network thread. '''
+
+		with self.lock:
+			if path in self.modems:
+				self.modems[path][str(name)] = value
+		self.update(modem=name in ('Powered', 'Online'))
+
+	def ownerChanged(self, name, oldOwner, newOwner):
+		''' @brief : Connman or oFono started, stopped or restarted, load its part again. '''
+
+		logging.info('Network: {} owner changed to {}.'.format(name, newOwner or 'none'))
+		if name == CONNMAN_SERVICE:
+			self.loadConnman()
+		else:
+			self.loadOfono()
+		self.update(modem=True)
+
+	def getRoute(self):
+		''' @brief : Interface prefix and address of the default route. '''
+
+		with self.lock:
+			return self.route
+
+	def getServices(self):
+		with self.lock:
+			return copy.deepcopy(self.services)
+
+	def getOnlineTypes(self):
+		''' @brief : Types of the online services. '''
+
+		with self.lock:
+			return set(str(p.get('Type')) for p in self.services.values() if p.get('State') == 'online')
+
+	def wifiOrEthernetOnline(self):
+		return bool(self.getOnlineTypes() & set(['wifi', 'ethernet']))
+
+	def isOnline(self):
+		with self.lock:
+			return self.managerState == 'online'
+
+	def getModems(self):
+		with self.lock:
+			return copy.deepcopy(self.modems)
+
+	def getStats(self):
+		with self.lock:
+			stats = dict(self.stats)
+			stats['Services'] = len(self.services)
+			stats['Modems'] = len(self.modems)
+		return stats
+
+
 class Network(Model):
 	''' Network adapter to manage network interfaces '''
 
-	def __init__(self, eventMgr=None):
+	def __init__(self, eventMgr=None, state=None, email=None):
 		super(Network, self).__init__('Network')
 		self.eventMgr = eventMgr
+		self.state = state if state is not None else NetworkState()
+		# outbox retried as soon as there is a route again
+		self.email = email
 		# can report metrics at different configurable frequency
 		self.currentInterface = INTERFACE_UNKNOWN
 		self.ipAddress = ''
@@ -397,66 +709,129 @@ class Network(Model):
 		status = '{},{}'.format(hrInterface[self.currentInterface], self.ipAddress)
 		return status
 
+	def stop(self):
+		''' Stop the thread and the signal tracking. '''
+
+		super(Network, self).stop()
+		self.state.stop()
+
 	def run(self):
-		''' Checks network metrics '''
+		''' Acts on route changes as the state tracker signals them, the modem loop runs on every
+			change and every NETWORK_MODEM_PERIOD while there is no wifi or ethernet. '''
 
-		lasttime = 0
-		while True:
+		self.state.start()
 
-			time.sleep(1)
+		lasttime = 0
+		while not self.stopThread:
 
+			changed = self.state.changed.wait(NETWORK_WAIT)
 			if self.stopThread:
 				break
 
-			if time.time() - lasttime < 10:
+			if not changed and (time.time() - lasttime < NETWORK_MODEM_PERIOD or self.state.wifiOrEthernetOnline()):
 				continue
 
+			self.state.changed.clear()
+
+			# route first, the event should not wait on the modem
+			self.updateRoute(*resolveRoute(self.state.getRoute()))
+
 			# run modem loop
 			tgmodem.loop()
+			lasttime = time.time()
 
-			# get default Internet route
-			route_iface, ip_addr = tgconnman.get_route()
+	def updateRoute(self, route_iface, ip_addr):
+		''' Raise an interface change and log in or out of hamachi when the default route moves. '''
 
-			logging.debug('Network: Default Internet route={}, ip_address={}.'.format(route_iface, ip_addr))
+		logging.debug('Network: Default Internet route={}, ip_address={}.'.format(route_iface, ip_addr))
 
-			if any(x in route_iface for x in ['eth', 'wlan', 'wwan']):
-				newInterface = routeToInterface(route_iface)
-				if newInterface != self.currentInterface:
-					self.eventMgr.raiseEvent(tgEvent.EVCLASS_NETWORK,
-											tgEvent.EVTOPIC_NET_IFACECHANGE,
-											'{},{}'.format(hrInterface[ self.currentInterface ], hrInterface[ newInterface ]),
-											tgEvent.EVENT_PRIORITY_HIGH,
-											[tgEvent.EVACTION_STREAM, tgEvent.EVACTION_DATABASE, tgEvent.EVACTION_NOTIFICATIONS])
+		if route_iface is not None:
+			newInterface = routeToInterface(route_iface)
+			if newInterface != self.currentInterface:
+				self.eventMgr.raiseEvent(tgEvent.EVCLASS_NETWORK,
+										tgEvent.EVTOPIC_NET_IFACECHANGE,
+										'{},{}'.format(hrInterface[ self.currentInterface ], hrInterface[ newInterface ]),
+										tgEvent.EVENT_PRIORITY_HIGH,
+										[tgEvent.EVACTION_STREAM, tgEvent.EVACTION_DATABASE, tgEvent.EVACTION_NOTIFICATIONS])
 
-				# if changing from no interface to an interface, do hamachi logout/login
-				if self.currentInterface == INTERFACE_UNKNOWN:
-					tghamachi.logout()
-					tghamachi.login()
+			# if changing from no interface to an interface, do hamachi logout/login
+			if self.currentInterface == INTERFACE_UNKNOWN:
+				tghamachi.logout()
+				tghamachi.login()
 
-				self.currentInterface = newInterface
+			if newInterface != self.currentInterface and self.email is not None:
+				self.email.networkUp()
 
-				# cut the number off
-				if ip_addr:
-					self.ipAddress = ip_addr
-				else:
-					self.ipAddress = ''
+			self.currentInterface = newInterface
 
+			# cut the number off
+			if ip_addr:
+				self.ipAddress = ip_addr
 			else:
-				# from some interface to no interface
-				if self.currentInterface != INTERFACE_UNKNOWN:
+				self.ipAddress = ''
 
-					# Probably can't stream this event due to network being down
-					self.eventMgr.raiseEvent(tgEvent.EVCLASS_NETWORK,
-											tgEvent.EVTOPIC_NET_IFACECHANGE,
-											'{},{}'.format(hrInterface[ self.currentInterface ], hrInterface[ INTERFACE_UNKNOWN ]),
-											tgEvent.EVENT_PRIORITY_HIGH,
-											[tgEvent.EVACTION_STREAM, tgEvent.EVACTION_DATABASE, tgEvent.EVACTION_NOTIFICATIONS])
+		else:
+			# from some interface to no interface
+			if self.currentInterface != INTERFACE_UNKNOWN:
 
-					# logout from hamachi too as it just reports as still logged in
-					tghamachi.logout()
+				# Probably can't stream this event due to network being down
+				self.eventMgr.raiseEvent(tgEvent.EVCLASS_NETWORK,
+										tgEvent.EVTOPIC_NET_IFACECHANGE,
+										'{},{}'.format(hrInterface[ self.currentInterface ], hrInterface[ INTERFACE_UNKNOWN ]),
+										tgEvent.EVENT_PRIORITY_HIGH,
+										[tgEvent.EVACTION_STREAM, tgEvent.EVACTION_DATABASE, tgEvent.EVACTION_NOTIFICATIONS])
 
-				self.currentInterface = INTERFACE_UNKNOWN
-				self.ipAddress = ''
+				# logout from hamachi too as it just reports as still logged in
+				tghamachi.logout()
 
+			self.currentInterface = INTERFACE_UNKNOWN
+			self.ipAddress = ''
 
-			lasttime = time.time()
+
+def benchmarkLookups(iface='eth', count=1000):
+	''' @brief : Seconds per route and address lookup through the old ifconfig and route pipelines,
+		through procfs and ioctl and from the cache. '''
+
+	def forked():
+		ifname = '{}0'.format(iface)
+		os.popen('ifconfig {} | grep "inet\\ addr" | cut -d: -f2 | cut -d" " -f1'.format(ifname)).read()
+		os.popen('route -n | grep UG | tr -s [:blank:] | cut -d" " -f8').read()
+
+	def direct():
+		interfaceAddress('{}0'.format(iface))
+		readDefaultRoute()
+
+	def cached():
+		getIpAddress(iface)
+		getDefaultRoute()
+
+	results = {}
+	# forking is slow enough that a tenth of the runs gives a steady figure
+	for name, lookup, runs in (('forked', forked, max(1, count // 10)), ('direct', direct, count), ('cached', cached, count)):
+		clearLookupCache()
+		start = time.time()
+		for i in range(runs):
+			lookup()
+		results[name] = (time.time() - start) / runs
+	return results
+
+
+if __name__ == '__main__':
+
+	# root logger
+	logger = logging.getLogger('')
+	logger.setLevel(logging.INFO)
+
+	# format for logging
+	format = logging.Formatter(fmt='%(asctime)s %(levelname)8s [%(module)10s.%(funcName)10s %(lineno)d] %(message)s', datefmt='%b %d %H:%M:%S')
+
+	handler = logging.StreamHandler(sys.stdout)
+	handler.setFormatter(format)
+	logger.addHandler(handler)
+
+	argc = len(sys.argv)
+	if argc > 1 and sys.argv[1] == 'benchmark':
+		iface = sys.argv[2] if argc > 2 else 'eth'
+		for name, seconds in sorted(benchmarkLookups(iface).items()):
+			logging.info('Network: {} {:.1f} us per route and address lookup.'.format(name, seconds * 1e6))
+		logging.info('Network: route {}, address {}.'.format(getDefaultRoute(), getIpAddress(iface)))
@@ -1,4 +1,4 @@
-#!/usr/bin/env python2
+#!/usr/bin/env python3
 
 ''' @file : tgNotifications.py
 	@brief : Notifications.
@@ -7,9 +7,11 @@ import sys
 import copy
 import time
 import signal
+import re
 import json
 import logging
-import Queue 
+import collections
+import queue
 from tggateway.tgEmail import Email
 from tggateway.tgSms import Sms
 import tggateway.tgEvent as tgEvent
@@ -30,6 +32,12 @@ ALERT_TYPE_ALARM_2			= 'A2Alarms'
 ALERT_TYPE_NETIFACE			= 'IfaceChange'
 ALERT_TYPE_DISK_FULL 		= 'DiskFull'
 
+NOTIFICATION_QUEUE_SIZE		= 50
+# alerts for a recipient within this many seconds of its last email go out together in one digest
+NOTIFICATION_DIGEST_WINDOW	= 10
+# longest the thread blocks on the queue when nothing is due
+NOTIFICATION_WAIT			= 1.0
+
 LOGDEBUG_ENABLED = True
 LOGINFO_ENABLED = True
 LOGWARNING_ENABLED = True
@@ -56,376 +64,237 @@ def LOGCRITICAL(logstr):
 	if LOGCRITICAL_ENABLED:
 		logging.critical(logstr)
 
-class EmailTemplate(object):
+# every email is one page, a digest puts the sections of several alerts on the page
+EMAIL_PAGE = '<html><body>{}</body></html>'
+EMAIL_SECTION_SEPARATOR = '<hr>'
+
+# email template sources, layout whitespace is stripped when they are compiled
+TEMPLATE_TIME = '''\
+				<h4>Date/time of event: {}</h4>
+				'''
+
+TEMPLATE_POWEROFF = '''\
+				<h4>Date/time of event: {}</h4>
+				<h4>Cause of shutdown: {}</h4>
+				'''
+
+TEMPLATE_CHANGE = '''\
+				<h4>Date/time of event: {}</h4>
+				<h4>Change from {} to {}</h4>
+				'''
+
+TEMPLATE_LOWBATTERY = '''\
+				<h4>Date/time of event: {}</h4>
+				<h4>Battery capacity: {} %</h4>
+				'''
+
+TEMPLATE_SESSION = '''\
+				<h4>Date/time of event: {}</h4>
+				<h4>Session number: {}</h4>
+				<h4>Session alias: {}</h4>
+				'''
+
+TEMPLATE_SESSION_RESUME = '''\
+				<h4>Date/time of event: {}</h4>
+				<h4>Session number: {}</h4>
+				<h4>Session alias: {}</h4>
+				<h4>Trigger rate: {}</h4>
+				{}
+				'''
+
+TEMPLATE_SENSOR_CHANGES = '''\
+				<h4>Sensor changes:</h4>
+				<table border="0" cellspacing="20px">
+					<tr><th>POS</th><th>NAME</th><th>A1</th><th>A2</th></tr>
+					{}
+				</table>
+				'''
+
+# row templates number their fields, pos, name, A1, A2 from the event data
+TEMPLATE_SENSOR_CHANGE_ROW = '''\
+				<tr><td align="left">{0}</td>
+					<td align="left">{1}</td>
+					<td align="left">{2}</td>
+					<td align="left">{3}</td></tr>
+				'''
+
+TEMPLATE_ALARM = '''\
+				<h4>Date/time of event: {}</h4>
+				<h4>Device alarm status: {}</h4>
+				<h4>Sensor alarm status:</h4>
+				<table border="0" cellspacing="20px">
+					<tr>
+						<th>POS</th>
+						<th>NAME</th>
+						<th>TRIGGER</th>
+						<th>TEMP</th>
+						<th>A1</th>
+						<th>A2</th>
+						<th>STATUS</th>
+					</tr>
+					{}
+				</table>
+				'''
+
+# pos, name, temp, a1, a2, state, trigger from the event data
+TEMPLATE_ALARM_ROW = '''\
+				<tr><td align="left">{0}</td>
+					<td align="left">{1}</td>
+					<td align="left">{6}</td>
+					<td align="left">{2}C</td>
+					<td align="left">{3}C</td>
+					<td align="left">{4}C</td>
+					<td align="left">{5}</td></tr>
+				'''
+
+# rendered email section
+EmailContent = collections.namedtuple('EmailContent', 'subject body')
+
+
+class CompiledTemplate(object):
+	''' @class : CompiledTemplate
+		@brief : Template source with the layout whitespace stripped, compiled once.
+	'''
+	__slots__ = ('subject', 'format', 'tables')
 
-	def __init__(self):
+	def __init__(self, subject, source):
 		'''
 			@brief : Class initialisation.
 		'''
-		self.template = {}
-		self.templates = {'PowerOn':self.powerOnTemplate, 
-						'PowerOff':self.powerOffTemplate,
-						'PowerChange':self.powerChangeTemplate,
-						'LowBattery':self.lowBatteryTmplate,
-						'SessionRestart':self.sessionRestartTemplate,
-						'SessionResume':self.sessionResumeTemplate,
-						'SessionNew':self.sessionNewTemplate,
-						'SessionStop':self.sessionStopTemplate,
-						'A1Alarms':self.alarmTemplate,
-						'A2Alarms':self.alarmTemplate,
-						'IfaceChange':self.ifaceChangeTemplate,
-						'DiskFull':self.diskFullTemplate}
-		return
+		self.subject = subject
+		self.format = ''.join(line.strip() for line in source.splitlines())
+		# row count to the format of a whole table
+		self.tables = {}
 
-	def getTemplate(self):
-		''' @brief : Return template '''
-		return copy.copy(self.template)
+	def render(self, *args):
+		''' @brief : Fill in the template '''
+		return self.format.format(*args)
 
-	def generate(self, alertType, alertData, alertTime):
+	def table(self, fields, width):
 		'''
-			@brief : Generate template.
+			@brief : Table of rows in one format call, the row template is repeated for every row.
+			@param fields : Row fields one row after the other, width fields per row.
 		'''
-		return self.templates[alertType](alertType, alertData, alertTime)
-
-	def powerOnTemplate(self, alertType, alertData, alertTime):
-		''' @brief : Power on template '''
-
-		body = ''			
-		self.template = {}
-		
-		self.template['subject'] = 'POWER ON notification'
-
-		body += '''\
-				<html>
-					<body>
-						<h4>Date/time of event: {0}</h4>					
-					</body>
-				</html>
-				'''.format(alertTime)
-
-		self.template['body'] = body
-		return True	
-
-	def powerOffTemplate(self, alertType, alertData, alertTime):
-		''' @brief : Power off template '''
-
-		body = ''			
-		self.template = {}
-		
-		self.template['subject'] = 'POWER OFF notification'
-
-		body += '''\
-				<html>
-					<body>
-						<h4>Date/time of event: {}</h4>
-						<h4>Cause of shutdown: {}</h4>					
-					</body>
-				</html>
-				'''.format(alertTime, alertData)
-
-		self.template['body'] = body
-		return True
-
-	def powerChangeTemplate(self, alertType, alertData, alertTime):
-		''' @brief : Power change template '''
-			
-		body = ''			
-		self.template = {}
-		
-		self.template['subject'] = 'POWER CHANGE notification'
-
-		try:
-			# split alertData into 2 tokens, 0 should be previous power interface, 1 should be current power interface
-			data = alertData.split(',')
-			body += '''\
-					<html>
-						<body>
-							<h4>Date/time of event: {}</h4>
-							<h4>Change from {} to {}</h4>					
-						</body>
-					</html>
-					'''.format(alertTime, data[0], data[1])
-
-			self.template['body'] = body
-
-		except Exception as e:
-			logging.error('Notification: Power change template unexpected error {}'.format(e))
-		
-		return True
-
-	def lowBatteryTmplate(self, alertType, alertData, alertTime):
-		''' @brief : Low battery template '''
-			
-		body = ''			
-		self.template = {}
-		
-		self.template['subject'] = 'BATTERY LOW notification'
-
-		body += '''\
-				<html>
-					<body>
-						<h4>Date/time of event: {}</h4>
-						<h4>Battery capacity: {} %</h4>					
-					</body>
-				</html>
-				'''.format(alertTime, alertData)
-
-		self.template['body'] = body
-		return True
-
-	def sessionRestartTemplate(self, alertType, alertData, alertTime):
-		''' @brief : Session restart template '''
-			
-		body = ''			
-		self.template = {}
-		
-		self.template['subject'] = 'SESSION RESTART notification'
-		try:
-			# split alertData into tokens 0=session number, 1=session alias
-			data = alertData.split(',')
-			body += '''\
-					<html>
-						<body>
-							<h4>Date/time of event: {}</h4>
-							<h4>Session number: {}</h4>
-							<h4>Session alias: {}</h4>					
-						</body>
-					</html>
-					'''.format(alertTime, data[0], data[1])
-
-			self.template['body'] = body
-
-		except Exception as e:
-			logging.error('Notification: Session restart template unexpected error {}'.format(e))
-				
-		return True
-
-	def sessionResumeTemplate(self, alertType, alertData, alertTime):
-		''' @brief : Session resume template '''
-			
-		body = ''			
-		self.template = {}
-		
-		self.template['subject'] = 'SESSION CONFIG CHANGE notification'
-		try:
-
-			# alertData contains {session number, session alias, alarm type, trigger rate, sensor change={pos, alias, A1, A2}, {}, ...}
-
-			data = alertData.split(',')
-			datalen = len(data) - 4
-			table = ''
-			if datalen > 4:
-				i = 0
-				while True:
-					table += '<tr><td align="left">{}</td>\
-							<td align="left">{}</td>\
-							<td align="left">{}</td>\
-							<td align="left">{}</td></tr>'.format(data[4+i], data[5+i], data[6+i], data[7+i])
-
-					i += 4
-					if i == datalen:
-						break
-
-				body += '''\
-						<html>
-							<body>
-								<h4>Date/time of event: {}</h4>
-								<h4>Session number: {}</h4>
-								<h4>Session alias: {}</h4>
-								<h4>Trigger rate: {}</h4>
-
-								<h4>Sensor changes:</h4>
-								<table border="0" cellspacing="20px">
-									<tr><th>POS</th><th>NAME</th><th>A1</th><th>A2</th></tr>
-									{}
-								</table>
-
-							</body>
-						</html>
-						'''.format(alertTime, data[0], data[1], data[3], table)
-			else:
-				body += '''\
-						<html>
-							<body>
-								<h4>Date/time of event: {}</h4>
-								<h4>Session number: {}</h4>
-								<h4>Session alias: {}</h4>
-								<h4>Trigger rate: {}</h4>
-							</body>
-						</html>
-						'''.format(alertTime, data[0], data[1], data[3])
-
-
-			self.template['body'] = body
-
-		except Exception as e:
-			logging.error('Notification: Session resume template unexpected error {}'.format(e))
-			return False
-
-		return True
-
-	def sessionNewTemplate(self, alertType, alertData, alertTime):
-		''' @brief : Session new template '''
-			
-		body = ''			
-		self.template = {}
-		
-		self.template['subject'] = 'SESSION NEW notification'
-
-		try:
-			# split alertData into tokens 0=session number, 1=session alias
-
-			data = alertData.split(',')
+		rows = len(fields) // width
+		table = self.tables.get(rows)
+		if table is None:
+			table = ''.join([re.sub(r'\{(\d+)\}', lambda m: '{{{}}}'.format(int(m.group(1)) + row * width), self.format)
+							for row in range(rows)])
+			self.tables[rows] = table
+		return table.format(*fields)
 
-			body += '''\
-					<html>
-						<body>
-							<h4>Date/time of event: {}</h4>
-							<h4>Session number: {}</h4>
-							<h4>Session alias: {}</h4>					
-						</body>
-					</html>
-					'''.format(alertTime, data[0], data[1])
-
-			self.template['body'] = body
-
-		except Exception as e:
-			logging.error('Notification: Session new template unexpected error {}'.format(e))
-
-		return True
-
-	def sessionStopTemplate(self, alertType, alertData, alertTime):
-		''' @brief : Session restart template '''
-			
-		body = ''			
-		self.template = {}
-		
-		self.template['subject'] = 'SESSION STOP notification'
-
-		body += '''\
-				<html>
-					<body>
-						<h4>Date/time of event: {}</h4>			
-					</body>
-				</html>
-				'''.format(alertTime)
-
-		self.template['body'] = body
-		return True
-
-	def ifaceChangeTemplate(self, alertType, alertData, alertTime):
-		''' @brief : Interface change template '''
-			
-		body = ''			
-		self.template = {}
-		
-		self.template['subject'] = 'NETWORK INTERFACE CHANGE notification'
 
+class EmailTemplate(object):
+	''' @class : EmailTemplate
+		@brief : Email section for every alert type.
+		@details : Templates are compiled once, render() keeps no state so it may be
+				called from any thread.
+	'''
+	def __init__(self):
+		'''
+			@brief : Class initialisation.
+		'''
+		self.sensorChanges = CompiledTemplate(None, TEMPLATE_SENSOR_CHANGES)
+		self.sensorChangeRow = CompiledTemplate(None, TEMPLATE_SENSOR_CHANGE_ROW)
+		self.alarmRow = CompiledTemplate(None, TEMPLATE_ALARM_ROW)
+
+		# alert type to (template, function of the event returning the template arguments)
+		self.templates = {ALERT_TYPE_POWERON: (CompiledTemplate('POWER ON notification', TEMPLATE_TIME), self.timeArgs),
+						ALERT_TYPE_POWEROFF: (CompiledTemplate('POWER OFF notification', TEMPLATE_POWEROFF), self.dataArgs),
+						ALERT_TYPE_POWERCHANGE: (CompiledTemplate('POWER CHANGE notification', TEMPLATE_CHANGE), self.fieldArgs),
+						ALERT_TYPE_LOWBATTERY: (CompiledTemplate('BATTERY LOW notification', TEMPLATE_LOWBATTERY), self.dataArgs),
+						ALERT_TYPE_SESSION_RESTART: (CompiledTemplate('SESSION RESTART notification', TEMPLATE_SESSION), self.fieldArgs),
+						ALERT_TYPE_SESSION_RESUME: (CompiledTemplate('SESSION CONFIG CHANGE notification', TEMPLATE_SESSION_RESUME), self.sessionResumeArgs),
+						ALERT_TYPE_SESSION_NEW: (CompiledTemplate('SESSION NEW notification', TEMPLATE_SESSION), self.fieldArgs),
+						ALERT_TYPE_SESSION_STOP: (CompiledTemplate('SESSION STOP notification', TEMPLATE_TIME), self.timeArgs),
+						ALERT_TYPE_ALARM_1: (CompiledTemplate('ALARM A1 notification', TEMPLATE_ALARM), self.alarmArgs),
+						ALERT_TYPE_ALARM_2: (CompiledTemplate('ALARM A2 notification', TEMPLATE_ALARM), self.alarmArgs),
+						ALERT_TYPE_NETIFACE: (CompiledTemplate('NETWORK INTERFACE CHANGE notification', TEMPLATE_CHANGE), self.fieldArgs),
+						ALERT_TYPE_DISK_FULL: (CompiledTemplate('DISK FULL notification', TEMPLATE_TIME), self.timeArgs)}
+
+	def render(self, alertType, event):
+		'''
+			@brief : Render the email section of an alert.
+			@param event : tgEvent.EventRecord of the alert.
+			@return : EmailContent, None if the event data doesn't fit the template.
+		'''
+		template, args = self.templates[alertType]
 		try:
-			# split alertData into tokens 0=previous network interface, 1=current network interface
+			return EmailContent(template.subject, template.render(*args(event)))
+		except (IndexError, ValueError) as e:
+			logging.warning('Notification: {} data seems incorrect {}.'.format(alertType, e))
+			return None
 
-			data = alertData.split(',')
+	def timeArgs(self, event):
+		''' @brief : Event time only '''
+		return (event.time,)
 
-			body += '''\
-					<html>
-						<body>
-							<h4>Date/time of event: {}</h4>
-							<h4>Change from {} to {}</h4>					
-						</body>
-					</html>
-					'''.format(alertTime, data[0], data[1])
+	def dataArgs(self, event):
+		''' @brief : Event time and data '''
+		return (event.time, event.data)
 
-			self.template['body'] = body
-
-		except Exception as e:
-			logging.error('Notification: Network interface change template unexpected error {}'.format(e))
-
-		return True
-
-	def diskFullTemplate(self, alertType, alertData, alertTime):
-		''' @brief : Disk full template '''
-			
-		body = ''			
-		self.template = {}
-		
-		self.template['subject'] = 'DISK FULL notification'
+	def fieldArgs(self, event):
+		'''
+			@brief : Event time and the first two data fields.
+			@details : Previous and current power or network interface, or session number and alias.
+		'''
+		fields = event.fields()
+		return (event.time, fields[0], fields[1])
 
-		body += '''\
-				<html>
-					<body>
-						<h4>Date/time of event: {0}</h4>					
-					</body>
-				</html>
-				'''.format(alertTime)
+	def sessionResumeArgs(self, event):
+		'''
+			@brief : Session config change.
+			@details : event data contains {session number, session alias, alarm type, trigger rate, sensor change={pos, alias, A1, A2}, {}, ...}
+		'''
+		fields = event.fields()
+		changes = fields[4:]
+		if len(changes) % 4 != 0:
+			raise ValueError('sensor changes have {} fields'.format(len(changes)))
 
-		self.template['body'] = body
-		return True
+		table = ''
+		if changes:
+			table = self.sensorChanges.render(self.sensorChangeRow.table(changes, 4))
+		return (event.time, fields[0], fields[1], fields[3], table)
 
-	def alarmTemplate(self, alertType, alertData, alertTime):
+	def alarmArgs(self, event):
 		'''
-			@brief : Alarm template.
-			@details : alertdata is string "addr1,name1,temp1,a11,a21,s1,trig1,addr2,name2,temp2,a12,a22,s2,trig2, ...."
+			@brief : Alarm table.
+			@details : event data is "global,addr1,name1,temp1,a11,a21,s1,trig1,addr2,name2,temp2,a12,a22,s2,trig2, ...."
 		'''
+		fields = event.fields()
+		if len(fields) < 1 + tgEvent.ALARM_ENTRY_FIELDS or (len(fields) - 1) % tgEvent.ALARM_ENTRY_FIELDS != 0:
+			raise ValueError('alarm data has {} fields'.format(len(fields)))
 
-		body = ''			
-		self.template = {}
-		
-		# split into tokens
-		data = alertData.split(',')
-		datalen = len(data)
-		# check validity NOTE first token is global alarm status
-		if datalen < 8:
-			logging.warning('Notifications: Alarm data seems incorrect not expecting {} fields.'.format(datalen))
-			return False
+		return (event.time, fields[0], self.alarmRow.table(fields[1:], tgEvent.ALARM_ENTRY_FIELDS))
 
-		if (datalen-1) % 7 != 0:
-			logging.warning('Notifications: Alarm data seems incorrect not modular 7.')
-			return False
-
-		if alertType == ALERT_TYPE_ALARM_1:
-			self.template['subject'] = 'ALARM A1 notification'
-		elif alertType == ALERT_TYPE_ALARM_2:
-			self.template['subject'] = 'ALARM A2 notification'
 
-		table = ''
-		i = 1
-		while True:
-			table += '<tr><td align="left">{0}</td>\
-					<td align="left">{1}</td>\
-					<td align="left">{2}</td>\
-					<td align="left">{3}C</td>\
-					<td align="left">{4}C</td>\
-					<td align="left">{5}C</td>\
-					<td align="left">{6}</td></tr>'.format(data[i], data[i+1], data[i+6], data[i+2], data[i+3],data[i+4],data[i+5])
-
-			i += 7
-			if i == datalen:
-				break
-
-		body += '''\
-				<html>
-					<body>
-						<h4>Date/time of event: {0}</h4>
-						<h4>Device alarm status: {1}</h4>						
-						<h4>Sensor alarm status:</h4>
-						<table border="0" cellspacing="20px">
-							<tr>
-								<th>POS</th>
-								<th>NAME</th>
-								<th>TRIGGER</th>
-								<th>TEMP</th>
-								<th>A1</th>
-								<th>A2</th>
-								<th>STATUS</th>
-							</tr>
-							{2}
-						</table>
-					</body>
-				</html>
-				'''.format(alertTime, data[0], table)
-
-		self.template['body'] = body
-		return True 
+def benchmarkTemplates(rows=60, count=1000):
+	''' @fn benchmarkTemplates
+		@brief : Render time of every template, alarms with a table of the given rows.
+		@return : Dictionary of alert type to seconds per render.
+	'''
+	sensors = ''.join(',{},Sensor {},21.5,25,30,A1,RISING'.format(pos, pos) for pos in range(1, rows + 1))
+	changes = ''.join(',{},Sensor {},25,30'.format(pos, pos) for pos in range(1, rows + 1))
+	data = {ALERT_TYPE_POWEROFF: 'shutdown',
+			ALERT_TYPE_POWERCHANGE: 'mains,battery',
+			ALERT_TYPE_LOWBATTERY: '20',
+			ALERT_TYPE_SESSION_RESTART: '3,Cellar',
+			ALERT_TYPE_SESSION_RESUME: '3,Cellar,A1,10' + changes,
+			ALERT_TYPE_SESSION_NEW: '3,Cellar',
+			ALERT_TYPE_ALARM_1: 'ARMED' + sensors,
+			ALERT_TYPE_ALARM_2: 'ARMED' + sensors,
+			ALERT_TYPE_NETIFACE: 'eth0,wlan0'}
+
+	emailTemplate = EmailTemplate()
+	results = {}
+	for alertType in emailTemplate.templates:
+		events = [tgEvent.EventRecord(i, tgEvent.EVCLASS_TEMP, '', tgEvent.EVENT_PRIORITY_HIGH, data.get(alertType, ''), [])
+					for i in range(count)]
+		start = time.time()
+		for event in events:
+			emailTemplate.render(alertType, event)
+		results[alertType] = (time.time() - start) / count
+	return results
 
 
 class Notification(Model):
@@ -441,8 +310,15 @@ class Notification(Model):
 		self.sms = sms
 		self.config = {}
 		self.configured = False
-		self.queue = Queue.Queue(maxsize=50)
-		self.interval = 1
+		self.queue = queue.Queue(maxsize=NOTIFICATION_QUEUE_SIZE)
+		self.digestWindow = NOTIFICATION_DIGEST_WINDOW
+		# alert type to email addresses and mobile numbers, rebuilt when the config changes
+		self.recipients = {}
+		self.smsRecipients = {}
+		# email address to [due time, [(alertType, event)]] and time of its last email
+		self.pending = {}
+		self.lastSent = {}
+		self.stats = {'Events': 0, 'Alerts': 0, 'Emails': 0, 'Digests': 0, 'Sms': 0}
 		logging.debug('Notification: Initialised.')
 
 	def loadConfig(self):
@@ -467,6 +343,8 @@ class Notification(Model):
 					logging.debug('		{0} {1}.'.format(alert, self.config['Users'][user]['Alerts'][alert]))
 		
 			logging.info('Notification: Config loaded from file.')
+			self.recipients = self.buildRecipients(self.config, 'Email', 'Email')
+			self.smsRecipients = self.buildRecipients(self.config, 'Sms', 'Mobile')
 			self.configured = True
 
 		except Exception as e:
@@ -500,6 +378,8 @@ class Notification(Model):
 
 			logging.debug('Notification: Config set.')
 
+			self.recipients = self.buildRecipients(self.config, 'Email', 'Email')
+			self.smsRecipients = self.buildRecipients(self.config, 'Sms', 'Mobile')
 			self.configured = True
 			return True
 		except Exception as e:
@@ -516,6 +396,26 @@ class Notification(Model):
 		'''
 		return copy.deepcopy(self.config)
 
+	def buildRecipients(self, config, channel, contact):
+		'''
+			@brief : Index of alert type to the contacts of users subscribing to it.
+			@param channel : Config flag enabling the channel, Email or Sms.
+			@param contact : User key of the address, Email or Mobile.
+		'''
+		recipients = {}
+		if not config.get(channel):
+			return recipients
+
+		for user in config['Users'].values():
+			if not user.get(contact):
+				continue
+			for alertType, enabled in user['Alerts'].items():
+				if enabled:
+					recipients.setdefault(alertType, []).append(user[contact])
+
+		logging.debug('Notification: Recipients {}.'.format(recipients))
+		return recipients
+
 	def evtopicToAlert(self, evtopic):
 		'''@brief : Convert event topic to user alert '''
 		if evtopic == tgEvent.EVTOPIC_TEMP_ALRM_A1:
@@ -556,8 +456,8 @@ class Notification(Model):
 
 	def alert(self, event):
 		''' 
-		event['Class'], event['Topic'], event['Data'], event['Time']
 			@brief : Send alert.
+			@param event : tgEvent.EventRecord.
 		'''
 		try:
 			self.queue.put(event,block=False)
@@ -566,96 +466,157 @@ class Notification(Model):
 			logging.warning('Notification: Queue put error = {}.'.format(e))
 
 
-	def run(self):
-		''' @brief : Run called in thread. '''
-
-		lasttime = 0
-		while True:
-
-			time.sleep(1)
-
-			if self.stopThread:
-				break
-
-			if time.time() - lasttime < self.interval:
-				continue
-
-			if self.queue.qsize() == 0:
-				logging.debug('Notification: Empty nothing to process.')
-				self.interval = 10
-				lasttime = time.time()
+	def collect(self, event, now):
+		'''
+			@brief : Add an alert to the pending email of every recipient.
+			@details : A recipient whose last email is older than the digest window is due now,
+					otherwise the alert waits for the end of the window along with any others.
+		'''
+		self.stats['Events'] += 1
+
+		# translate evtopic to alert type
+		alertType = self.evtopicToAlert(event.evTopic)
+		if alertType is None:
+			logging.warning('Notification: Event topic not supported evclass={} evtopic={}.'.format(event.evClass, event.evTopic))
+			return
+
+		numbers = self.smsRecipients.get(alertType)
+		if numbers and self.sms is not None:
+			self.sms.smsRequest(numbers, self.smsText(alertType, event))
+			self.stats['Sms'] += 1
+
+		addresses = self.recipients.get(alertType)
+		if not addresses:
+			logging.debug('Notification: Email no users subscribing to {}.'.format(alertType))
+			return
+
+		self.stats['Alerts'] += 1
+		for address in addresses:
+			if address not in self.pending:
+				self.pending[address] = [max(now, self.lastSent.get(address, 0) + self.digestWindow), []]
+			self.pending[address][1].append((alertType, event))
+
+	def smsText(self, alertType, event):
+		'''
+			@brief : Short text of an alert, alarms list the sensors, the sms channel trims it to its budget.
+		'''
+		text = '{} {}'.format(self.emailTemplate.templates[alertType][0].subject, event.time)
+		if alertType in (ALERT_TYPE_ALARM_1, ALERT_TYPE_ALARM_2):
+			try:
+				globalState, entries = event.alarmEntries()
+			except ValueError:
+				return text
+			text += ' {}'.format(globalState)
+			text += ''.join('\n{} {} {:g}C {}'.format(entry.pos, entry.name, entry.temp, entry.trigger) for entry in entries)
+		elif event.data:
+			text += ' {}'.format(event.data)
+		return text
+
+	def flush(self, now, force=False):
+		'''
+			@brief : Send the pending emails that are due.
+			@details : Recipients with the same alerts share one email, several alerts make a digest.
+		'''
+		groups = {}
+		for address, (due, alerts) in list(self.pending.items()):
+			if not force and due > now:
 				continue
-			else:
-				self.interval = 1
-
-			# pull from queue
-			event = self.queue.get()
-
-			emailAddr = []
-			#smsAddr = []
 
-			evclass = event['Class']
-			evtopic = event['Topic']
-			evdata = event['Data']
-			evtime = event['Time']
-			self.queue.task_done()
-			# translate evtopic to alert type
-			alertType = self.evtopicToAlert(evtopic)
-			if alertType == '':
-				logging.warning('Notification: Event topic not supported evclass={} evtopic={}.'.format(evclass, evtopic))
-				return
+			del self.pending[address]
+			self.lastSent[address] = now
+			key = tuple((alertType, event.seq) for alertType, event in alerts)
+			groups.setdefault(key, (alerts, []))[1].append(address)
 
-			# email
-			if self.config['Email']:
-
-				# any users subscribing to this alert type?
-				for user in self.config['Users'].keys():
-					logging.debug("Notification: User = {}, Alert-{} = {}".format(user, alertType, self.config['Users'][user]['Alerts'][alertType]))		
-					if not self.config['Users'][user]['Alerts'][alertType]:
-						continue
-					else:
-						emailAddr.append(self.config['Users'][user]['Email'])
+		for alerts, addresses in groups.values():
+			template = self.render(alerts)
+			if template is None:
+				continue
 
-				# prepare template depending on topic
-				if len(emailAddr) > 0:
-					result = self.emailTemplate.generate(alertType, evdata, evtime)
+			self.email.mailRequest(addresses, template)
+			self.stats['Emails'] += 1
+			if len(alerts) > 1:
+				self.stats['Digests'] += 1
 
-					# send it
-					if result:
-						self.email.mailRequest(emailAddr, self.emailTemplate.getTemplate())
-				else:
-					logging.debug('Notification: Email no users subscribing to this event.')
+	def render(self, alerts):
+		'''
+			@brief : Template of a single alert, or a digest of several in the order raised.
+		'''
+		sections = []
+		for alertType, event in alerts:
+			section = self.emailTemplate.render(alertType, event)
+			if section is not None:
+				sections.append(section)
+
+		if not sections:
+			return None
+		if len(sections) == 1:
+			return {'subject': sections[0].subject, 'body': EMAIL_PAGE.format(sections[0].body)}
+
+		subjects = []
+		for section in sections:
+			if section.subject not in subjects:
+				subjects.append(section.subject)
+
+		logging.info('Notification: Digest of {} alerts.'.format(len(sections)))
+		return {'subject': '{} notifications: {}'.format(len(sections), ', '.join(subjects)),
+				'body': EMAIL_PAGE.format(EMAIL_SECTION_SEPARATOR.join(section.body for section in sections))}
+
+	def nextDue(self):
+		'''
+			@brief : Earliest time a pending email is due, None when nothing is pending.
+		'''
+		if not self.pending:
+			return None
+		return min(due for due, alerts in self.pending.values())
 
-			else:
-				logging.debug('Notification: Email alerts disabled.')
+	def getStats(self):
+		'''
+			@brief : Event, alert, email and digest counts.
+		'''
+		stats = dict(self.stats)
+		stats['Pending'] = len(self.pending)
+		stats['Queued'] = self.queue.qsize()
+		return stats
 
-			lasttime = time.time()
+	def run(self):
+		''' @brief : Run called in thread, drains the queue in batches, requests sms and sends due emails. '''
 
-			# sms
-			'''if self.config['Sms']:
+		while not self.stopThread:
 
-				# any users subscribing to this alert type?
-				for user in self.config['Users'].keys():
-					if not self.config['Users'][user]['Alerts'][alertType]:
-						continue
-					else:
-						smsAddr.append(self.config['Users'][user]['Email'])
+			due = self.nextDue()
+			timeout = NOTIFICATION_WAIT if due is None else min(NOTIFICATION_WAIT, max(0, due - time.time()))
 
-				if len(smsAddr) > 0:
-					# prepare template depending on topic
-					#result, smsMsg = smsTemplate.generate(alertType, evdata, evtime)
-					result = smsTemplate.generate(alertType, evdata, evtime)
+			events = []
+			try:
+				events.append(self.queue.get(timeout=timeout))
+				while True:
+					events.append(self.queue.get_nowait())
+			except queue.Empty:
+				pass
 
-					# send it
-					if result:
-						self.sms.smsRequest(smsAddr, smsTemplate.getTemplate())
-				else:
-					logging.debug('Notification: Sms no users subscribing to this event.')
+			now = time.time()
+			for event in events:
+				self.collect(event, now)
 
-			else:
-				logging.debug('Notification: Sms alerts disabled.')'''
+			if self.pending:
+				self.flush(now)
 
+		# anything still waiting for its digest window goes now
+		for event in self.drain():
+			self.collect(event, time.time())
+		self.flush(time.time(), force=True)
 
+	def drain(self):
+		'''
+			@brief : Events left in the queue.
+		'''
+		events = []
+		try:
+			while True:
+				events.append(self.queue.get_nowait())
+		except queue.Empty:
+			pass
+		return events
 
 
 
@@ -688,5 +649,11 @@ if __name__ == '__main__':
 	stdouth.setFormatter(format)
 	logger.addHandler(stdouth)
 
+	if argc > 1 and sys.argv[1] == 'benchmark':
+		rows = int(sys.argv[2]) if argc > 2 else 60
+		for alertType, seconds in sorted(benchmarkTemplates(rows).items()):
+			logging.info('Notification: {} {:.1f} us per render.'.format(alertType, seconds * 1e6))
+		sys.exit()
+
 	tgNfy = Notification()
 	tgNfy.loadConfig()
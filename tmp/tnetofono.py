@@ -52,16 +52,16 @@ class Ofono():
 		else:
 			return False
 
+	def modem_path(self):
+		''' Path of the first modem '''
+
+		return tgutils.dbus_cache.call('org.ofono', '/', 'org.ofono.Manager', 'GetModems')[0][0]
+
 	def get_properties(self):
 		try:
-			bus = dbus.SystemBus()
-			mgr = dbus.Interface(bus.get_object('org.ofono', '/'),'org.ofono.Manager')
-			modems = mgr.GetModems()
-			modem = dbus.Interface(bus.get_object('org.ofono', modems[0][0]),'org.ofono.Modem')
-
 			#modem.connect_to_signal("PropertyChanged", property_changed)
 
-			properties = modem.GetProperties()
+			properties = tgutils.dbus_cache.call('org.ofono', self.modem_path(), 'org.ofono.Modem', 'GetProperties')
 
 			if 'Name' in properties:
 				self._properties["Name"] = properties['Name']
@@ -140,15 +140,13 @@ class Ofono():
 	def set_apn(self, apn):
 		logging.debug("Setting APN to {}".format(apn))
 		try:
-			bus = dbus.SystemBus()
-			manager = dbus.Interface(bus.get_object('org.ofono', '/'),'org.ofono.Manager')
-			modems = manager.GetModems()
+			modems = tgutils.dbus_cache.call('org.ofono', '/', 'org.ofono.Manager', 'GetModems')
 
 			for path, properties in modems:
 				if "org.ofono.ConnectionManager" not in properties["Interfaces"]:
 					continue
 
-				connman = dbus.Interface(bus.get_object('org.ofono', path), 'org.ofono.ConnectionManager')
+				connman = tgutils.dbus_cache.interface('org.ofono', path, 'org.ofono.ConnectionManager')
 				contexts = connman.GetContexts()
 				path = "";
 
@@ -163,7 +161,7 @@ class Ofono():
 				else:
 					logging.debug("Found context {}".format(path))
 
-				context = dbus.Interface(bus.get_object('org.ofono', path), 'org.ofono.ConnectionContext')
+				context = tgutils.dbus_cache.interface('org.ofono', path, 'org.ofono.ConnectionContext')
 
 				get_apn = context.GetProperties()["AccessPointName"]
 
@@ -179,33 +177,19 @@ class Ofono():
 
 	def data_connect(self):
 		try:
-			bus = dbus.SystemBus()
-			manager = dbus.Interface(bus.get_object('org.ofono', '/'),'org.ofono.Manager')
-			modems = manager.GetModems()
-			path = modems[0][0]
-			modem = dbus.Interface(bus.get_object('org.ofono', path), 'org.ofono.Modem')
-			modem.SetProperty("Online", dbus.Boolean(1), timeout = 120)
+			tgutils.dbus_cache.call('org.ofono', self.modem_path(), 'org.ofono.Modem', 'SetProperty', "Online", dbus.Boolean(1), timeout = 120)
 		except Exception as e:
 			logging.error(e)
 
 	def data_disconnect(self):
 		try:
-			bus = dbus.SystemBus()
-			manager = dbus.Interface(bus.get_object('org.ofono', '/'),'org.ofono.Manager')
-			modems = manager.GetModems()
-			path = modems[0][0]
-			modem = dbus.Interface(bus.get_object('org.ofono', path), 'org.ofono.Modem')
-			modem.SetProperty("Online", dbus.Boolean(0), timeout = 120)
+			tgutils.dbus_cache.call('org.ofono', self.modem_path(), 'org.ofono.Modem', 'SetProperty', "Online", dbus.Boolean(0), timeout = 120)
 		except Exception as e:
 			logging.error(e)
 
 	def send_sms(self, recipient, message):
 		logging.debug('Sending message {} to {}'.format(message, recipient))
-		bus = dbus.SystemBus()
-		manager = dbus.Interface(bus.get_object('org.ofono', '/'),'org.ofono.Manager')
-		modems = manager.GetModems()
-		path = modems[0][0]
-		mm = dbus.Interface(bus.get_object('org.ofono', path), 'org.ofono.MessageManager')
+		mm = tgutils.dbus_cache.interface('org.ofono', self.modem_path(), 'org.ofono.MessageManager')
 
 		#if len(sys.argv) == 5:
 		#	mm.SetProperty("UseDeliveryReports", dbus.Boolean(int(sys.argv[4])))
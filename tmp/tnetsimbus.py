@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+
+''' @file : tgSimBus.py
+	@brief : Simulated 1-wire bus for running the temperature subsystem off-device.
+'''
+
+import sys
+import os
+import time
+import json
+import random
+import shutil
+import logging
+import tempfile
+import threading
+
+import tggateway.tgEvent as tgEvent
+import tggateway.tgTemperature as tgTemperature
+
+SIM_SERIAL_FORMAT			= 'SIM{:06d}'
+SIM_BASE_TEMPERATURE		= 20.0
+SIM_A1						= 30
+SIM_A2						= 40
+
+
+class SimSensor(object):
+	''' @class : SimSensor
+		@brief : One simulated probe, a base temperature plus scripted ramps.
+	'''
+	def __init__(self, serial, temperature):
+		''' @fn init
+			@brief : Class initialisation.
+		'''
+		self.serial = serial
+		self.temperature = temperature
+		self.faulty = False
+		# list of (start time, duration, from, to)
+		self.ramps = []
+
+	def value(self, now):
+		''' @fn value
+			@brief : Temperature at time now, the last ramp to have started wins.
+		'''
+		value = self.temperature
+		for start, duration, fromTemp, toTemp in self.ramps:
+			if now < start:
+				continue
+			if duration <= 0 or now >= start + duration:
+				value = toTemp
+			else:
+				value = fromTemp + (toTemp - fromTemp) * (now - start) / duration
+		return value
+
+
+class SimController(tgTemperature.BusController):
+	''' @class : SimController
+		@brief : Pure python stand in for the 1-wire Controller.
+		@details : Sensors are named by SIM_SERIAL_FORMAT from first. Each read sleeps for the
+				configured latency, adds gaussian noise and fails with faultRate probability
+				or always for sensors set faulty.
+	'''
+	def __init__(self, totalSensors=60, latency=0.0, noise=0.0, faultRate=0.0, temperature=SIM_BASE_TEMPERATURE, seed=None, first=1):
+		''' @fn init
+			@brief : Class initialisation.
+			@param first : Number of the first serial, keeps serials unique across simulated buses.
+			@param latency : Seconds per read.
+			@param noise : Standard deviation of the reading noise.
+			@param faultRate : Probability of any read failing.
+		'''
+		super(SimController, self).__init__()
+		self.latency = latency
+		self.noise = noise
+		self.faultRate = faultRate
+		self.random = random.Random(seed)
+		self.lock = threading.Lock()
+		self.reads = 0
+		self.failedReads = 0
+		self.sensors = {}
+		self.serials = []
+		for i in range(totalSensors):
+			serial = SIM_SERIAL_FORMAT.format(first+i)
+			self.sensors[serial] = SimSensor(serial, temperature)
+			self.serials.append(serial)
+
+	def acquire(self):
+		self.ctlHandle = 1
+		logging.debug('SimController: Acquired {} sensors.'.format(len(self.sensors)))
+
+	def release(self):
+		self.ctlHandle = -1
+
+	def serial(self, pos):
+		''' @fn serial
+			@brief : Serial of the sensor at pos on this bus, from 1.
+		'''
+		return self.serials[pos-1]
+
+	def setFault(self, serial, faulty=True):
+		''' @fn setFault
+			@brief : Make every read of a sensor fail, or recover it.
+		'''
+		self.sensors[serial].faulty = faulty
+
+	def addRamp(self, serial, toTemp, duration, delay=0, fromTemp=None):
+		''' @fn addRamp
+			@brief : Ramp a sensor to toTemp over duration seconds, starting delay seconds from now.
+			@return : Time the ramp starts.
+		'''
+		sensor = self.sensors[serial]
+		start = time.time() + delay
+		if fromTemp is None:
+			fromTemp = sensor.value(start)
+		sensor.ramps.append((start, duration, fromTemp, toTemp))
+		return start
+
+	def crossingTime(self, serial, threshold):
+		''' @fn crossingTime
+			@brief : Time the scripted temperature of a sensor first reaches threshold, None if never.
+		'''
+		for start, duration, fromTemp, toTemp in self.sensors[serial].ramps:
+			if (fromTemp < threshold) != (toTemp < threshold) or fromTemp == threshold:
+				if duration <= 0 or toTemp == fromTemp:
+					return start
+				return start + duration * float(threshold - fromTemp) / (toTemp - fromTemp)
+		return None
+
+	def temperature(self, sensorSerial):
+		''' @fn temperature
+			@brief : Read temperature from sensor.
+		'''
+		if self.latency:
+			time.sleep(self.latency)
+
+		with self.lock:
+			self.reads += 1
+			sensor = self.sensors.get(sensorSerial)
+			if sensor is None or sensor.faulty or (self.faultRate and self.random.random() < self.faultRate):
+				self.failedReads += 1
+				return tgTemperature.CONTROLLER_READ_FAIL
+
+			value = sensor.value(time.time())
+			if self.noise:
+				value += self.random.gauss(0, self.noise)
+
+		# the real controller rounds to whole degrees
+		return round(value)
+
+
+class SimEventMgr(object):
+	''' @class : SimEventMgr
+		@brief : Records raised events with the time they were raised.
+	'''
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.events = []
+
+	def raiseEvent(self, evClass, evTopic, evData, evPriority, evActions, source=None):
+		with self.lock:
+			self.events.append((time.time(), evClass, evTopic, evData))
+
+	def first(self, evTopic, since=0):
+		''' @fn first
+			@brief : First event of topic raised at or after since.
+		'''
+		with self.lock:
+			for event in self.events:
+				if event[2] == evTopic and event[0] >= since:
+					return event
+		return None
+
+
+class SimDataLogger(object):
+	''' @class : SimDataLogger
+		@brief : Data logger that discards everything.
+	'''
+	def newSession(self, session, removePrevious=False):
+		pass
+
+	def setBatchSize(self, size):
+		pass
+
+	def log(self, pk, data):
+		pass
+
+	def flushLogs(self):
+		pass
+
+
+def simBuses(controllers):
+	''' @fn simBuses
+		@brief : List of controllers from one controller or a list.
+	'''
+	if isinstance(controllers, tgTemperature.BusController):
+		return [controllers]
+	return list(controllers)
+
+def simConfig(controllers, a1=SIM_A1, a2=SIM_A2, alarmType=tgTemperature.ALARM_TYPE_HIGH_HIGH, triggerRate=1, samplePeriod=None):
+	''' @fn simConfig
+		@brief : Temperature config with every sensor of the simulated buses, numbered bus by bus.
+	'''
+	controllers = simBuses(controllers)
+	total = sum(len(controller.sensors) for controller in controllers)
+	config = {'Commit': 0,
+			'Session': {'Number': 1, 'Alias': 'Simulation', 'TotalSensors': total, 'AlarmType': alarmType, 'TriggerRate': triggerRate},
+			'Sensors': {}}
+	if samplePeriod is not None:
+		config['Session']['SamplePeriod'] = samplePeriod
+
+	pos = 0
+	for bus, controller in enumerate(controllers):
+		for i in range(len(controller.sensors)):
+			pos += 1
+			config['Sensors']['{}'.format(pos)] = {'Serial': controller.serial(i+1),
+												'Alias': 'Sim {}'.format(pos),
+												'Bus': bus,
+												'A1': a1,
+												'A2': a2,
+												'Diffmode': 0,
+												'A1trig': False,
+												'A2trig': False}
+	return config
+
+
+class Simulation(object):
+	''' @class : Simulation
+		@brief : Temperature manager wired to simulated buses, config kept in a scratch directory.
+	'''
+	def __init__(self, controllers, config=None):
+		''' @fn init
+			@brief : Class initialisation.
+			@param controllers : One SimController or a list, one per bus.
+		'''
+		self.controllers = simBuses(controllers)
+		self.eventMgr = SimEventMgr()
+		self.path = tempfile.mkdtemp(prefix='tnetsim')
+		if config is None:
+			config = simConfig(self.controllers)
+
+		configFile = os.path.join(self.path, 'temperature.json')
+		with open(configFile, 'w') as f:
+			json.dump(config, f)
+
+		self.temperature = tgTemperature.Temperature(self.eventMgr,
+													tempLogger=SimDataLogger(),
+													controllers=self.controllers,
+													configFile=configFile,
+													triggerFile=os.path.join(self.path, 'temperature.trig'))
+		self.temperature.loadConfig()
+		self.temperature.startController()
+
+	def sweep(self):
+		''' @fn sweep
+			@brief : Read every sensor now, regardless of its sample deadline.
+		'''
+		for sensor in self.temperature.sensors:
+			sensor.nextSample = 0
+		self.temperature.updateSensors()
+
+	def close(self):
+		''' @fn close
+			@brief : Stop and remove the scratch directory.
+		'''
+		if self.temperature.thread is not None:
+			self.temperature.stop()
+		else:
+			self.temperature.stopController()
+		shutil.rmtree(self.path, ignore_errors=True)
+
+
+def benchmarkSweep(totalSensors, sweeps=20, latency=0.0):
+	''' @fn benchmarkSweep
+		@brief : updateSensors throughput over full sweeps of the network.
+		@return : Sensors processed per second.
+	'''
+	sim = Simulation(SimController(totalSensors, latency=latency, noise=0.5, seed=1))
+	try:
+		start = time.time()
+		for i in range(sweeps):
+			sim.sweep()
+		elapsed = time.time() - start
+	finally:
+		sim.close()
+
+	return totalSensors * sweeps / elapsed
+
+def benchmarkAlarmLatency(totalSensors, latency=0.0, rampTime=10.0):
+	''' @fn benchmarkAlarmLatency
+		@brief : Seconds from the last sensor crossing A2 to the A2 alarm event, with the real scheduler.
+	'''
+	controller = SimController(totalSensors, latency=latency, seed=1)
+	serial = controller.serial(totalSensors)
+	controller.addRamp(serial, SIM_A2 + 5, rampTime, delay=1)
+	# readings are rounded to whole degrees, so the alarm level is reached half a degree early
+	crossing = controller.crossingTime(serial, SIM_A2 - 0.5)
+
+	sim = Simulation(controller)
+	try:
+		sim.temperature.start()
+		event = None
+		while event is None and time.time() < crossing + rampTime + 60:
+			time.sleep(0.05)
+			event = sim.eventMgr.first(tgEvent.EVTOPIC_TEMP_ALRM_A2)
+	finally:
+		sim.close()
+
+	if event is None:
+		return None
+	return event[0] - crossing
+
+def benchmarkBuses(sensorsPerBus, buses, sweeps=5, latency=0.0):
+	''' @fn benchmarkBuses
+		@brief : Full sweep time with the network spread over several buses.
+		@return : Seconds per sweep.
+	'''
+	controllers = []
+	for bus in range(buses):
+		controllers.append(SimController(sensorsPerBus, latency=latency, seed=bus, first=bus*sensorsPerBus+1))
+
+	sim = Simulation(controllers)
+	try:
+		start = time.time()
+		for i in range(sweeps):
+			sim.sweep()
+		elapsed = time.time() - start
+	finally:
+		sim.close()
+
+	return elapsed / sweeps
+
+def benchmarkStream(totalSensors=60, sweeps=300, keyframeSweeps=30, noise=0.3, ramps=6):
+	''' @fn benchmarkStream
+		@brief : Live data bytes streamed with keyframes and deltas against a full frame every sweep.
+		@details : A few sensors climb 0.1 degrees per sweep, the rest sit at the base temperature
+				with reading noise. A keyframe is forced every keyframeSweeps sweeps.
+		@return : (full frame bytes, keyframe and delta bytes), including the '<class:topic:priority:>' framing.
+	'''
+	controller = SimController(totalSensors, noise=noise, seed=1)
+	sim = Simulation(controller)
+	encoder = sim.temperature.liveEncoder
+	encoder.keyframeInterval = float('inf')
+	fullBytes = 0
+	try:
+		for i in range(sweeps):
+			if i % keyframeSweeps == 0:
+				encoder.requestKeyframe()
+
+			for pos in range(1, ramps + 1):
+				controller.sensors[controller.serial(pos)].temperature += 0.1
+
+			sim.sweep()
+			topic, data = tgTemperature.LiveEncoder().encode(sim.temperature.sensors, 0)
+			fullBytes += len('<{}:{}:{}:{}>'.format(tgEvent.EVCLASS_TEMP, topic, tgEvent.EVENT_PRIORITY_HIGH, data))
+	finally:
+		sim.close()
+
+	streamBytes = 0
+	for evTime, evClass, evTopic, evData in sim.eventMgr.events:
+		if evTopic in (tgEvent.EVTOPIC_TEMP_NEW_DATA, tgEvent.EVTOPIC_TEMP_DELTA_DATA):
+			streamBytes += len('<{}:{}:{}:{}>'.format(evClass, evTopic, tgEvent.EVENT_PRIORITY_HIGH, evData))
+
+	return fullBytes, streamBytes
+
+def benchmark(sensorCounts=(60, 250, 1000), busCounts=(1, 2, 4), latency=0.0):
+	''' @fn benchmark
+		@brief : Log sweep throughput and alarm latency for each network size, then sweep time per bus count.
+	'''
+	for totalSensors in sensorCounts:
+		rate = benchmarkSweep(totalSensors, latency=latency)
+		alarmLatency = benchmarkAlarmLatency(totalSensors, latency=latency)
+		logging.info('SimBus: {} sensors, {:.0f} sensors/s, A2 alarm latency {}.'.format(totalSensors,
+			rate, 'none' if alarmLatency is None else '{:.3f} s'.format(alarmLatency)))
+
+	# sweep time should stay flat while buses are added at a fixed size per bus
+	for buses in busCounts:
+		sweepTime = benchmarkBuses(sensorCounts[0], buses, latency=latency)
+		logging.info('SimBus: {} buses of {} sensors, {:.3f} s per sweep.'.format(buses, sensorCounts[0], sweepTime))
+
+	fullBytes, streamBytes = benchmarkStream(sensorCounts[0])
+	logging.info('SimBus: {} sensors live stream {} bytes with deltas, {} bytes with full frames ({:.0f}% saved).'.format(sensorCounts[0],
+		streamBytes, fullBytes, 100.0 * (fullBytes - streamBytes) / fullBytes))
+
+
+if __name__ == '__main__':
+
+	# root logger
+	logger = logging.getLogger('')
+	logger.setLevel(logging.INFO)
+
+	# format for logging
+	format = logging.Formatter(fmt='%(asctime)s %(levelname)8s [%(module)10s.%(funcName)10s %(lineno)d] %(message)s', datefmt='%b %d %H:%M:%S')
+
+	# add stdout stream handler
+	stdouth = logging.StreamHandler(sys.stdout)
+	stdouth.setFormatter(format)
+	logger.addHandler(stdouth)
+
+	# optional per read latency in milliseconds
+	latency = 0.0
+	if len(sys.argv) > 1:
+		latency = float(sys.argv[1]) / 1000
+
+	benchmark(latency=latency)
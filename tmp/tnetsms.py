@@ -1,47 +1,252 @@
-#!/usr/bin/env python2
+#!/usr/bin/env python3
 
 ''' @file : tgSms.py
 	@brief : Sms with ofono.
 '''
 import sys
+import time
+import queue
 import logging
+import collections
+import dbus
 import tggateway.tgEvent as tgEvent
+import tggateway.tgUtils as tgutils
+from tggateway.tgModel import Model
 
+OFONO_SERVICE				= 'org.ofono'
+OFONO_MANAGER				= 'org.ofono.Manager'
+OFONO_MESSAGE_MANAGER		= 'org.ofono.MessageManager'
 
-class Sms(object):
-	def __init__(self, eventMgr):
+SMS_QUEUE_SIZE				= 20
+
+# characters per segment, a concatenated message loses some of each segment to the header
+SMS_GSM_SEGMENT				= 160
+SMS_GSM_CONCAT_SEGMENT		= 153
+SMS_UCS2_SEGMENT			= 70
+SMS_UCS2_CONCAT_SEGMENT		= 67
+# longest message sent, in segments, anything longer is cut short
+SMS_MAX_SEGMENTS			= 3
+SMS_TRUNCATED				= '...'
+
+# messages per recipient per period, more are held and combined into the next message
+SMS_RATE_COUNT				= 5
+SMS_RATE_PERIOD				= 600
+
+# GSM 03.38 default alphabet, the extension characters take two septets
+SMS_GSM_BASIC = set('@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞ'
+					'ÆæßÉ !"#¤%&\'()*+,-./0123456789:;<=>?¡ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+					'ÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà')
+SMS_GSM_EXTENDED = set('^{}\\[~]|€\f')
+
+
+def smsLength(text):
+	''' @fn smsLength
+		@brief : Length of a text in segment units and whether it needs UCS-2.
+	'''
+	length = 0
+	for char in text:
+		if char in SMS_GSM_BASIC:
+			length += 1
+		elif char in SMS_GSM_EXTENDED:
+			length += 2
+		else:
+			return len(text.encode('utf-16-le')) // 2, True
+	return length, False
+
+def smsSegments(text):
+	''' @fn smsSegments
+		@brief : Number of segments a text is sent in.
+	'''
+	length, ucs2 = smsLength(text)
+	single, concat = (SMS_UCS2_SEGMENT, SMS_UCS2_CONCAT_SEGMENT) if ucs2 else (SMS_GSM_SEGMENT, SMS_GSM_CONCAT_SEGMENT)
+	if length <= single:
+		return 1
+	return (length + concat - 1) // concat
+
+def smsFit(text, maxSegments=SMS_MAX_SEGMENTS):
+	''' @fn smsFit
+		@brief : Cut a text short so it fits in the segment budget.
+	'''
+	if smsSegments(text) <= maxSegments:
+		return text
+
+	length, ucs2 = smsLength(text)
+	budget = (SMS_UCS2_CONCAT_SEGMENT if ucs2 else SMS_GSM_CONCAT_SEGMENT) * maxSegments
+	# the estimate is exact for plain text, extension characters may need another trim
+	text = text[:budget - len(SMS_TRUNCATED)]
+	while text and smsSegments(text + SMS_TRUNCATED) > maxSegments:
+		text = text[:-1]
+	return text + SMS_TRUNCATED
+
+
+class Sms(Model):
+	''' @class : Sms
+		@brief : Sends text messages through the oFono MessageManager of the first modem.
+		@details : Requests go on a bounded queue, every recipient may be sent SMS_RATE_COUNT
+				messages per SMS_RATE_PERIOD, later ones are held and sent combined once the
+				rate allows. Messages are kept within SMS_MAX_SEGMENTS segments. The MessageManager
+				proxy is looked up once and kept until a call on it fails.
+	'''
+	def __init__(self, eventMgr, bus=None, maxsize=SMS_QUEUE_SIZE):
+		''' @fn init
+			@brief : Class initialisation.
+			@param bus : D-Bus connection, defaults to the shared system bus connection when first needed.
+		'''
+		super(Sms, self).__init__('Sms')
 		self.eventMgr = eventMgr
+		self.bus = bus
+		self.manager = None
+		self.queue = queue.Queue(maxsize=maxsize)
+		# recipient to times of its recent messages and to texts held by the rate limit
+		self.sent = collections.defaultdict(collections.deque)
+		self.held = collections.OrderedDict()
+		self.stats = {'Requested': 0, 'Dropped': 0, 'Sent': 0, 'Segments': 0, 'Combined': 0, 'Truncated': 0,
+					'Failed': 0, 'ManagerLookups': 0}
 		logging.info('Sms: Initialised.')
 
+	def smsRequest(self, numbers, text):
+		''' @fn smsRequest
+			@brief : Queue a text to every number.
+			@return : Boolean, False if the queue is full.
+		'''
+		for number in numbers:
+			try:
+				self.queue.put((number, text), block=False)
+				self.stats['Requested'] += 1
+			except queue.Full:
+				logging.warning('Sms: Queue full, message to {} dropped.'.format(number))
+				self.stats['Dropped'] += 1
+				return False
+		return True
+
+	def messageManager(self):
+		''' @fn messageManager
+			@brief : Proxy of the MessageManager of the first modem supporting it, cached.
+		'''
+		if self.manager is None:
+			if self.bus is None:
+				self.bus = tgutils.dbus_cache.bus()
+
+			self.stats['ManagerLookups'] += 1
+			modems = self.bus.get_object(OFONO_SERVICE, '/').GetModems(dbus_interface=OFONO_MANAGER)
+			for path, properties in modems:
+				if OFONO_MESSAGE_MANAGER in properties.get('Interfaces', []):
+					self.manager = self.bus.get_object(OFONO_SERVICE, path)
+					break
+			else:
+				raise dbus.exceptions.DBusException('No modem with a message manager')
+
+		return self.manager
+
 	def send(self, number, message):
+		''' @fn send
+			@brief : Send a text now, the cached proxy is looked up again once if the call fails.
+			@return : Boolean
+		'''
+		for attempt in range(2):
+			try:
+				self.messageManager().SendMessage(number, message, dbus_interface=OFONO_MESSAGE_MANAGER)
+				break
+			except dbus.exceptions.DBusException as e:
+				logging.warning('Sms: Send to {} failed {}.'.format(number, e))
+				self.manager = None
+		else:
+			self.stats['Failed'] += 1
+			self.eventMgr.raiseEvent(tgEvent.EVCLASS_SMS, tgEvent.EVTOPIC_SMS_SEND_FAIL, number, tgEvent.EVENT_PRIORITY_HIGH, [tgEvent.EVACTION_DATABASE])
+			return False
+
+		self.stats['Sent'] += 1
+		self.stats['Segments'] += smsSegments(message)
+		logging.debug('Sms: Sent to {}.'.format(number))
+		return True
+
+	def allowed(self, number, now):
+		''' @fn allowed
+			@brief : Recipient is within its rate.
+		'''
+		times = self.sent[number]
+		while times and now - times[0] >= SMS_RATE_PERIOD:
+			times.popleft()
+		return len(times) < SMS_RATE_COUNT
+
+	def deliver(self, number, texts, now):
+		''' @fn deliver
+			@brief : Send texts to a recipient as one message, or hold them while it is over its rate.
+			@param texts : Texts oldest first, the message puts the newest first so a cut drops the oldest.
+		'''
+		if not self.allowed(number, now):
+			self.held.setdefault(number, []).extend(texts)
+			return
+
+		if len(texts) > 1:
+			self.stats['Combined'] += len(texts) - 1
+		combined = '\n'.join(reversed(texts))
+		message = smsFit(combined)
+		if message.endswith(SMS_TRUNCATED) and message != combined:
+			self.stats['Truncated'] += 1
+
+		self.sent[number].append(now)
+		self.send(number, message)
+
+	def getStats(self):
+		''' @fn getStats
+			@brief : Request, send and rate limit counters.
+		'''
+		stats = dict(self.stats)
+		stats['Queued'] = self.queue.qsize()
+		stats['Held'] = sum(len(texts) for texts in self.held.values())
+		return stats
 
-		# if fail, raise event
-		# self.eventMgr.raiseEvent(tgEvent.EVCLASS_SMS, tgEvent.EVTOPIC_SMS_SEND_FAIL, '', tgEvent.EVENT_PRIORITY_HIGH, [tgEvent.EVACTION_DATABASE])
-		return
+	def run(self):
+		''' @fn run
+			@brief : Drain the queue, texts for the same recipient go out together.
+		'''
+		while not self.stopThread:
+
+			requests = []
+			try:
+				requests.append(self.queue.get(timeout=1))
+				while True:
+					requests.append(self.queue.get_nowait())
+			except queue.Empty:
+				pass
+
+			now = time.time()
+			batches = collections.OrderedDict()
+			for number, text in requests:
+				batches.setdefault(number, []).append(text)
+
+			# held texts join the newer ones for the same recipient, oldest first
+			for number in list(self.held):
+				if number in batches or self.allowed(number, now):
+					batches[number] = self.held.pop(number) + batches.get(number, [])
+
+			for number, texts in batches.items():
+				self.deliver(number, texts, now)
 
 def cleanExit():
 	''' @fn cleanExit
 		@brief : Clean exit handler when signal terminates program.
-	'''	
+	'''
 	logging.info('Sms: Exiting application.')
 	sys.exit()
 
-def fSignalHandler(signal, frame):		
+def fSignalHandler(signal, frame):
 	''' @fn fSignalHandler
 		@brief : Signal handler.
 	'''
 	cleanExit()
 
 if __name__ == '__main__':
-	
+
 	logging.info('Sms: Starting application.')
 
-	argc = len(sys.argv)	
+	argc = len(sys.argv)
 
 	# root logger
 	logger = logging.getLogger('')
 	logger.setLevel(logging.DEBUG)
-	
+
 	# format for logging
 	format = logging.Formatter(fmt='%(asctime)s %(levelname)8s [%(module)10s.%(funcName)10s %(lineno)d] %(message)s', datefmt='%b %d %H:%M:%S')
 
@@ -50,5 +255,5 @@ if __name__ == '__main__':
 	stdouth.setFormatter(format)
 	logger.addHandler(stdouth)
 
-	tgEvt = TgEvent.Event()
+	tgEvt = tgEvent.Event()
 	tgSms = Sms(tgEvt)
@@ -0,0 +1,539 @@
+#!/usr/bin/env python3
+
+''' @file : tgStreamer.py
+	@brief : Live data streamer, publishes events to TCP listeners.
+'''
+
+import os
+import sys
+import time
+import asyncio
+import logging
+import threading
+import collections
+
+from tggateway.tgModel import Model
+
+STREAMER_HOST				= '0.0.0.0'
+STREAMER_PORT				= 54113
+
+# messages queued per client before it is evicted as a slow consumer
+STREAMER_CLIENT_QUEUE		= 256
+# bytes buffered in the socket before the sender waits for the client to drain
+STREAMER_WRITE_BUFFER		= 64 * 1024
+# seconds a client may take to drain its socket before it is evicted
+STREAMER_DRAIN_TIMEOUT		= 5
+
+# subscription commands, one per line from the client
+STREAMER_CMD_SUB			= 'SUB'
+STREAMER_CMD_UNSUB			= 'UNSUB'
+# 'RESUME [seq]', switch to sequenced frames and replay everything after seq
+STREAMER_CMD_RESUME			= 'RESUME'
+
+# sent to a resuming client when the journal no longer reaches back to its sequence,
+# data is the oldest sequence replayed, the client has to fetch its state again
+STREAMER_GAP_FRAME			= '<STR:001:2:{}>'
+
+STREAMER_JOURNAL_FILE		= '/home/tgard/db/stream.journal'
+# recent events kept in memory, older ones are read back from the journal file
+STREAMER_RING_SIZE			= 1024
+# journal file is rotated to a single previous segment at this size
+STREAMER_SEGMENT_SIZE		= 1024 * 1024
+
+
+class StreamJournal(object):
+	''' @class : StreamJournal
+		@brief : Streamed events by sequence number, in a ring in memory and an append only file.
+		@details : Every record is a 'seq class topic length' header line followed by the data. The journal
+				numbers events itself in the order they are appended, so the numbers have no holes and a
+				missing number always means lost events. The file is rotated to path.1 when it reaches the
+				segment size so between one and two segments are kept on disk. The ring is reloaded from
+				disk at start up and numbering continues after it.
+	'''
+	def __init__(self, path=STREAMER_JOURNAL_FILE, ringSize=STREAMER_RING_SIZE, segmentSize=STREAMER_SEGMENT_SIZE):
+		''' @fn init
+			@brief : Class initialisation.
+		'''
+		self.path = path
+		self.segmentSize = segmentSize
+		self.lock = threading.Lock()
+		self.ring = collections.deque(maxlen=ringSize)
+		self.lastSeq = 0
+
+		for segment in (path + '.1', path):
+			entries, good = self.readSegment(segment)
+			self.ring.extend(entries)
+			if entries:
+				self.lastSeq = entries[-1][0]
+
+		# drop a record cut short by a crash so appends start on a boundary
+		self.file = open(path, 'ab')
+		if good < self.file.tell():
+			logging.warning('StreamJournal: Truncating partial record at {}.'.format(good))
+			self.file.truncate(good)
+			self.file.seek(good)
+
+		logging.info('StreamJournal: Initialised at sequence {}.'.format(self.lastSeq))
+
+	@staticmethod
+	def readSegment(path, after=0):
+		''' @fn readSegment
+			@brief : Records of a journal file with a sequence after the one given.
+			@return : List of (seq, class, topic, data) and the offset of the end of the last whole record.
+		'''
+		entries = []
+		good = 0
+		try:
+			with open(path, 'rb') as f:
+				while True:
+					header = f.readline()
+					if not header.endswith(b'\n'):
+						break
+					try:
+						seq, evClass, evTopic, length = header.split()
+						seq = int(seq)
+						length = int(length)
+					except ValueError:
+						break
+
+					data = f.read(length + 1)
+					if len(data) != length + 1:
+						break
+
+					good = f.tell()
+					if seq > after:
+						entries.append((seq, evClass.decode(), evTopic.decode(), data[:-1]))
+
+		except IOError:
+			pass
+
+		return entries, good
+
+	def append(self, evClass, evTopic, data):
+		''' @fn append
+			@brief : Add a serialized event under the next sequence number.
+			@return : Sequence number of the event.
+		'''
+		with self.lock:
+			self.lastSeq += 1
+			seq = self.lastSeq
+			self.ring.append((seq, evClass, evTopic, data))
+			try:
+				self.file.write('{} {} {} {}\n'.format(seq, evClass, evTopic, len(data)).encode() + data + b'\n')
+				self.file.flush()
+				if self.file.tell() >= self.segmentSize:
+					self.file.close()
+					os.rename(self.path, self.path + '.1')
+					self.file = open(self.path, 'ab')
+
+			except (IOError, OSError) as e:
+				logging.error('StreamJournal: Write of {} failed {}.'.format(seq, e))
+
+			return seq
+
+	def since(self, seq):
+		''' @fn since
+			@brief : Events after a sequence number, from the ring when it reaches back far enough.
+			@return : List of (seq, class, topic, data) and False if events after seq were lost.
+		'''
+		with self.lock:
+			if seq >= self.lastSeq:
+				return [], True
+			if self.ring and self.ring[0][0] <= seq + 1:
+				return [entry for entry in self.ring if entry[0] > seq], True
+			self.file.flush()
+
+		entries = []
+		for segment in (self.path + '.1', self.path):
+			entries.extend(self.readSegment(segment, seq)[0])
+		return entries, bool(entries) and entries[0][0] <= seq + 1
+
+	def close(self):
+		''' @fn close
+			@brief : Close the journal file.
+		'''
+		with self.lock:
+			self.file.close()
+
+
+class StreamClient(object):
+	''' @class : StreamClient
+		@brief : One listener connection.
+		@details : Topics are 'CLASS' or 'CLASS:TOPIC' strings, None receives everything.
+				Queued items are (seq, data), a sequenced client gets the sequence in front of every frame.
+	'''
+	def __init__(self, reader, writer, maxsize):
+		''' @fn init
+			@brief : Class initialisation.
+		'''
+		self.reader = reader
+		self.writer = writer
+		self.queue = asyncio.Queue(maxsize=maxsize)
+		self.topics = None
+		self.address = writer.get_extra_info('peername')
+		self.evicted = False
+		self.sequenced = False
+		self.lastSeq = 0
+		# events held while the journal is read for a resume
+		self.resuming = False
+		self.held = []
+
+	def wants(self, evClass, evTopic):
+		''' @fn wants
+			@brief : Client subscribed to the event.
+		'''
+		if self.topics is None:
+			return True
+		return evClass in self.topics or '{}:{}'.format(evClass, evTopic) in self.topics
+
+	def subscribe(self, topic):
+		if self.topics is None:
+			self.topics = set()
+		self.topics.add(topic)
+
+	def unsubscribe(self, topic):
+		if self.topics is not None:
+			self.topics.discard(topic)
+
+	def frame(self, seq, data):
+		''' @fn frame
+			@brief : Data as sent to this client.
+		'''
+		if self.sequenced and seq is not None:
+			return str(seq).encode() + data
+		return data
+
+
+class Streamer(Model):
+	''' @class : Streamer
+		@brief : Asyncio TCP streamer running its event loop on the model thread.
+		@details : publish() may be called from any thread. Every client has a bounded queue
+				and its own sender task, a client that lets its queue fill up or doesn't drain
+				its socket in time is disconnected instead of holding up the others. With a journal
+				a reconnecting client sends 'RESUME <seq>' and is sent only the events it missed.
+	'''
+	def __init__(self, host=STREAMER_HOST, port=STREAMER_PORT, clientQueue=STREAMER_CLIENT_QUEUE, journal=None):
+		''' @fn init
+			@brief : Class initialisation.
+			@param port : Listening port, 0 picks a free port which is set once started.
+			@param journal : StreamJournal of sequenced events for resuming clients.
+		'''
+		super(Streamer, self).__init__('Streamer')
+		self.host = host
+		self.port = port
+		self.clientQueue = clientQueue
+		self.journal = journal
+		self.loop = None
+		self.server = None
+		self.clients = set()
+		# journal order and broadcast order must be the same for clients to dedupe by sequence
+		self.publishLock = threading.Lock()
+		self.ready = threading.Event()
+		self.stats = {'Connected': 0, 'Published': 0, 'Sent': 0, 'Evicted': 0, 'Resumed': 0, 'Replayed': 0, 'Gaps': 0}
+
+	def publish(self, evClass, evTopic, data):
+		''' @fn publish
+			@brief : Send serialized event to every client subscribed to its class and topic, thread safe.
+				With a journal the event is journaled first and streamed under its journal sequence.
+		'''
+		with self.publishLock:
+			seq = self.journal.append(evClass, evTopic, data) if self.journal is not None else None
+
+			if self.loop is None or not self.clients:
+				return
+
+			try:
+				self.loop.call_soon_threadsafe(self.broadcast, evClass, evTopic, data, seq)
+			except RuntimeError:
+				# loop closed while stopping
+				pass
+
+	def broadcast(self, evClass, evTopic, data, seq=None):
+		''' @fn broadcast
+			@brief : Queue data on every subscribed client, runs on the loop.
+		'''
+		self.stats['Published'] += 1
+		for client in list(self.clients):
+			if not client.wants(evClass, evTopic):
+				continue
+
+			if client.resuming:
+				client.held.append((seq, data))
+				if len(client.held) > self.clientQueue:
+					self.evict(client, 'resume backlog full')
+				continue
+
+			try:
+				client.queue.put_nowait((seq, data))
+			except asyncio.QueueFull:
+				self.evict(client, 'queue full')
+
+	def evict(self, client, reason):
+		''' @fn evict
+			@brief : Disconnect a slow client.
+		'''
+		if client.evicted:
+			return
+
+		client.evicted = True
+		self.stats['Evicted'] += 1
+		logging.warning('Streamer: Evicting {}, {}.'.format(client.address, reason))
+		self.clients.discard(client)
+		client.writer.transport.abort()
+
+	async def send(self, client):
+		''' @fn send
+			@brief : Write queued data to a client, everything queued goes in one write.
+		'''
+		while not client.evicted:
+			items = [await client.queue.get()]
+			while not client.queue.empty():
+				items.append(client.queue.get_nowait())
+
+			chunks = []
+			for seq, data in items:
+				# already replayed on resume
+				if client.sequenced and seq is not None:
+					if seq <= client.lastSeq:
+						continue
+					client.lastSeq = seq
+				chunks.append(client.frame(seq, data))
+
+			client.writer.write(b''.join(chunks))
+			self.stats['Sent'] += len(chunks)
+
+			if client.writer.transport.get_write_buffer_size() > STREAMER_WRITE_BUFFER:
+				try:
+					await asyncio.wait_for(client.writer.drain(), STREAMER_DRAIN_TIMEOUT)
+				except asyncio.TimeoutError:
+					self.evict(client, 'not draining')
+				except ConnectionError:
+					break
+
+	async def handleClient(self, reader, writer):
+		''' @fn handleClient
+			@brief : Serve one connection, reads subscription commands until it closes.
+		'''
+		client = StreamClient(reader, writer, self.clientQueue)
+		self.clients.add(client)
+		self.stats['Connected'] += 1
+		logging.debug('Streamer: Connection made {}.'.format(client.address))
+
+		sender = self.loop.create_task(self.send(client))
+		try:
+			while not client.evicted:
+				line = await reader.readline()
+				if not line:
+					break
+
+				words = line.decode(errors='ignore').split()
+				if len(words) == 2 and words[0] == STREAMER_CMD_SUB:
+					client.subscribe(words[1])
+				elif len(words) == 2 and words[0] == STREAMER_CMD_UNSUB:
+					client.unsubscribe(words[1])
+				elif len(words) in (1, 2) and words[0] == STREAMER_CMD_RESUME:
+					await self.resume(client, words[1] if len(words) == 2 else None)
+
+		except ConnectionError:
+			pass
+
+		finally:
+			self.clients.discard(client)
+			sender.cancel()
+			writer.close()
+			logging.debug('Streamer: Connection closed {}.'.format(client.address))
+
+	async def resume(self, client, seq):
+		''' @fn resume
+			@brief : Switch a client to sequenced frames and send the events after seq from the journal.
+			@details : Live events are held while the journal is read, then sent after the replay
+					so the client sees every sequence once and in order.
+		'''
+		try:
+			seq = int(seq) if seq is not None else None
+		except ValueError:
+			return
+
+		if self.journal is None or seq is None:
+			client.lastSeq = self.journal.lastSeq if self.journal is not None else 0
+			client.sequenced = True
+			return
+
+		# queued but unsent events go out after the replay
+		client.resuming = True
+		while not client.queue.empty():
+			client.held.append(client.queue.get_nowait())
+
+		try:
+			entries, complete = await self.loop.run_in_executor(None, self.journal.since, seq)
+		except Exception as e:
+			logging.error('Streamer: Resume of {} from {} failed {}.'.format(client.address, seq, e))
+			entries, complete = [], False
+
+		client.sequenced = True
+		client.resuming = False
+		chunks = []
+		if not complete:
+			chunks.append(STREAMER_GAP_FRAME.format(entries[0][0] if entries else self.journal.lastSeq + 1).encode())
+			self.stats['Gaps'] += 1
+
+		last = seq
+		replayed = 0
+		for entrySeq, evClass, evTopic, data in entries:
+			if entrySeq > last and client.wants(evClass, evTopic):
+				chunks.append(client.frame(entrySeq, data))
+				replayed += 1
+			last = max(last, entrySeq)
+
+		for heldSeq, data in client.held:
+			if heldSeq is None or heldSeq > last:
+				chunks.append(client.frame(heldSeq, data))
+				last = heldSeq if heldSeq is not None else last
+		client.held = []
+		client.lastSeq = last
+
+		self.stats['Resumed'] += 1
+		self.stats['Replayed'] += replayed
+		logging.info('Streamer: Resumed {} from {}, {} events replayed.'.format(client.address, seq, replayed))
+		if chunks and not client.evicted:
+			client.writer.write(b''.join(chunks))
+			self.stats['Sent'] += len(chunks)
+
+	def getStats(self):
+		''' @fn getStats
+			@brief : Client and message counters.
+		'''
+		stats = dict(self.stats)
+		stats['Clients'] = len(self.clients)
+		return stats
+
+	def run(self):
+		''' @fn run
+			@brief : Run the event loop until stopped.
+		'''
+		self.loop = asyncio.new_event_loop()
+		asyncio.set_event_loop(self.loop)
+		try:
+			self.server = self.loop.run_until_complete(asyncio.start_server(self.handleClient, self.host, self.port))
+			self.port = self.server.sockets[0].getsockname()[1]
+			logging.info('Streamer: Listening on port {}.'.format(self.port))
+		except OSError as e:
+			logging.error('Streamer: Unable to listen on port {} {}.'.format(self.port, e))
+			self.loop.close()
+			self.loop = None
+			self.ready.set()
+			return
+
+		self.ready.set()
+		self.loop.run_forever()
+
+		# shut down server, aborted clients finish their handlers on their own
+		self.server.close()
+		for client in list(self.clients):
+			client.writer.transport.abort()
+		tasks = [task for task in asyncio.all_tasks(self.loop) if not task.done()]
+		if tasks:
+			self.loop.run_until_complete(asyncio.wait(tasks, timeout=1))
+		self.loop.run_until_complete(self.server.wait_closed())
+		self.loop.close()
+
+	def start(self):
+		''' @fn start
+			@brief : Start the loop thread and wait until listening.
+		'''
+		self.ready.clear()
+		super(Streamer, self).start()
+		self.ready.wait()
+
+	def stop(self):
+		''' @fn stop
+			@brief : Stop the loop thread.
+		'''
+		self.stopThread = True
+		loop = self.loop
+		if loop is not None:
+			loop.call_soon_threadsafe(loop.stop)
+		super(Streamer, self).stop()
+		self.loop = None
+
+
+def benchmark(listeners=100, messages=2000, rate=1000):
+	''' @fn benchmark
+		@brief : Throughput and latency with many listeners on the loopback.
+		@param rate : Messages published per second.
+		@return : Delivered messages per second and average and worst latency in seconds.
+	'''
+	streamer = Streamer(host='127.0.0.1', port=0)
+	streamer.start()
+
+	latencies = []
+	received = [0]
+	loop = asyncio.new_event_loop()
+
+	async def listen(done):
+		reader, writer = await asyncio.open_connection('127.0.0.1', streamer.port)
+		done.set_result(None)
+		buffered = b''
+		count = 0
+		while count < messages:
+			chunk = await reader.read(65536)
+			if not chunk:
+				break
+			now = time.time()
+			buffered += chunk
+			parts = buffered.split(b'>')
+			buffered = parts.pop()
+			for part in parts:
+				latencies.append(now - float(part.rsplit(b':', 1)[1]))
+			count += len(parts)
+		received[0] += count
+		writer.close()
+
+	async def connect():
+		connected = [loop.create_future() for i in range(listeners)]
+		tasks = [loop.create_task(listen(done)) for done in connected]
+		await asyncio.gather(*connected)
+		return tasks
+
+	tasks = loop.run_until_complete(connect())
+	# wait for the streamer to register every client
+	while len(streamer.clients) < listeners:
+		time.sleep(0.01)
+
+	def produce():
+		for i in range(messages):
+			streamer.publish('TMP', '009', '<TMP:009:2:{!r}>'.format(time.time()).encode())
+			time.sleep(1.0 / rate)
+
+	start = time.time()
+	producer = threading.Thread(target=produce)
+	producer.start()
+	loop.run_until_complete(asyncio.wait(tasks, timeout=messages / float(rate) + 30))
+	elapsed = time.time() - start
+	producer.join()
+	loop.close()
+	streamer.stop()
+
+	if not latencies:
+		return 0, None, None
+	return received[0] / elapsed, sum(latencies) / len(latencies), max(latencies)
+
+
+if __name__ == '__main__':
+
+	# root logger
+	logger = logging.getLogger('')
+	logger.setLevel(logging.INFO)
+
+	# format for logging
+	format = logging.Formatter(fmt='%(asctime)s %(levelname)8s [%(module)10s.%(funcName)10s %(lineno)d] %(message)s', datefmt='%b %d %H:%M:%S')
+
+	# add stdout stream handler
+	stdouth = logging.StreamHandler(sys.stdout)
+	stdouth.setFormatter(format)
+	logger.addHandler(stdouth)
+
+	listeners = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+	throughput, average, worst = benchmark(listeners=listeners)
+	logging.info('Streamer: {} listeners, {:.0f} messages/s delivered, latency avg {:.4f} s max {:.4f} s.'.format(listeners,
+		throughput, average or 0, worst or 0))
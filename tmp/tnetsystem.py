@@ -10,6 +10,7 @@ import sys
 import signal
 import subprocess
 import os
+import collections
 from copy import copy
 
 from tggateway.tgModel import Model
@@ -38,17 +39,221 @@ SHUTDOWN_CAUSE_LOWBATTERY	= 1
 
 HumanReadblePowerInterface = ['Unknown', 'AC Mains', 'Battery', 'Usb']
 
+PROC_MEMINFO				= "/proc/meminfo"
+PROC_STAT					= "/proc/stat"
+PROC_UPTIME					= "/proc/uptime"
+METRICS_DISK_PATH			= "/"
+
+# seconds between samples and samples kept in the ring
+METRICS_INTERVAL			= 60
+METRICS_RING_SIZE			= 60
+
+MetricsSample = collections.namedtuple('MetricsSample', 'time cpu cores memory disk uptime')
+
+
+class ProcFile(object):
+	''' @class : ProcFile
+		@brief : Procfs file kept open and read again from the start.
+		@details : Procfs regenerates the content on every read from offset 0, so one handle
+				serves every sample. The file is opened again if a read fails.
+	'''
+	def __init__(self, path):
+		self.path = path
+		self.file = None
+		self.opens = 0
+
+	def read(self):
+		''' @fn read
+			@brief : Whole content of the file.
+		'''
+		for attempt in range(2):
+			try:
+				if self.file is None:
+					self.file = open(self.path, 'r')
+					self.opens += 1
+				self.file.seek(0)
+				return self.file.read()
+			except (IOError, OSError):
+				self.close()
+				if attempt:
+					raise
+
+	def close(self):
+		if self.file is not None:
+			try:
+				self.file.close()
+			except (IOError, OSError):
+				pass
+			self.file = None
+
+
+def cpuBusy(previous, current):
+	''' @fn cpuBusy
+		@brief : Percentage of non idle time between two /proc/stat cpu lines.
+		@details : Columns are user, nice, system, idle, iowait, irq, softirq, steal, guest and
+				guest_nice. Guest time is already counted in user and nice, iowait counts as idle.
+	'''
+	idle = (current[3] + current[4]) - (previous[3] + previous[4])
+	total = sum(current[:8]) - sum(previous[:8])
+	if total <= 0:
+		return 0.0
+	return 100.0 * (total - idle) / total
+
+
+class MetricsCollector(object):
+	''' @class : MetricsCollector
+		@brief : CPU, memory, disk and uptime read in process.
+		@details : Reads /proc/stat, /proc/meminfo and /proc/uptime through handles kept open and
+				the root filesystem with statvfs, nothing is forked. CPU usage is the busy share of
+				the time since the previous sample, in total and per core. The last METRICS_RING_SIZE
+				samples are kept for history.
+	'''
+	def __init__(self, interval=METRICS_INTERVAL, size=METRICS_RING_SIZE, diskPath=METRICS_DISK_PATH):
+		''' @fn __init__
+			@brief : Class initialisation.
+		'''
+		self.interval = interval
+		self.diskPath = diskPath
+		self.meminfo = ProcFile(PROC_MEMINFO)
+		self.stat = ProcFile(PROC_STAT)
+		self.uptime = ProcFile(PROC_UPTIME)
+		self.ring = collections.deque(maxlen=size)
+		# cpu line name to its counters at the previous sample
+		self.cpuTimes = {}
+		self.lastSample = 0
+		self.stats = {'Samples': 0, 'Errors': 0}
+
+	def setInterval(self, interval):
+		''' @fn setInterval
+			@brief : Seconds between samples.
+		'''
+		self.interval = interval
+
+	def due(self, now):
+		''' @fn due
+			@brief : A sample is due.
+		'''
+		return now - self.lastSample >= self.interval
+
+	def readCpu(self):
+		''' @fn readCpu
+			@brief : Busy percentage in total and per core since the last call.
+			@return : Tuple of total and list of per core percentages, None on the first call which
+					only primes the counters.
+		'''
+		times = {}
+		for line in self.stat.read().splitlines():
+			if not line.startswith('cpu'):
+				break
+			fields = line.split()
+			times[fields[0]] = [int(x) for x in fields[1:]] + [0] * (10 - len(fields[1:]))
+
+		primed = 'cpu' in self.cpuTimes
+		busy = {}
+		for name, current in times.items():
+			previous = self.cpuTimes.get(name)
+			busy[name] = cpuBusy(previous, current) if previous is not None else 0.0
+		self.cpuTimes = times
+		if not primed:
+			return None
+
+		cores = sorted((name for name in busy if name != 'cpu'), key=lambda name: int(name[3:]))
+		return busy.get('cpu', 0.0), [busy[name] for name in cores]
+
+	def readMemory(self):
+		''' @fn readMemory
+			@brief : Percentage of memory in use, buffers and cache count as free.
+		'''
+		values = {}
+		for line in self.meminfo.read().splitlines():
+			name, _, value = line.partition(':')
+			values[name] = int(value.split()[0]) if value.split() else 0
+
+		total = values.get('MemTotal', 0)
+		if not total:
+			return 0.0
+		available = values.get('MemAvailable', values.get('MemFree', 0) + values.get('Buffers', 0) + values.get('Cached', 0))
+		return 100.0 * (total - available) / total
+
+	def readDisk(self):
+		''' @fn readDisk
+			@brief : Percentage of the root filesystem in use, rounded up as df does.
+		'''
+		st = os.statvfs(self.diskPath)
+		used = st.f_blocks - st.f_bfree
+		if used + st.f_bavail == 0:
+			return 0
+		return -(-100 * used // (used + st.f_bavail))
+
+	def readUptime(self):
+		''' @fn readUptime
+			@brief : Seconds since boot.
+		'''
+		return float(self.uptime.read().split()[0])
+
+	def collect(self, now=None):
+		''' @fn collect
+			@brief : Take a sample and add it to the ring.
+			@return : MetricsSample or None if the files could not be read or this was the first
+					call, which has no cpu usage to report yet.
+		'''
+		now = time.time() if now is None else now
+		self.lastSample = now
+		try:
+			busy = self.readCpu()
+			if busy is None:
+				return None
+			cpu, cores = busy
+			sample = MetricsSample(now, cpu, cores, self.readMemory(), self.readDisk(), self.readUptime())
+		except (IOError, OSError, ValueError, IndexError) as e:
+			logging.warning('System: Unable to collect metrics {}.'.format(e))
+			self.stats['Errors'] += 1
+			return None
+
+		self.ring.append(sample)
+		self.stats['Samples'] += 1
+		return sample
+
+	def latest(self):
+		''' @fn latest
+			@brief : Most recent sample or None.
+		'''
+		return self.ring[-1] if self.ring else None
+
+	def history(self, since=0):
+		''' @fn history
+			@brief : Samples in the ring taken after a time, oldest first.
+		'''
+		return [sample for sample in self.ring if sample.time > since]
+
+	def getStats(self):
+		''' @fn getStats
+			@brief : Sample and error counts, ring use and file opens.
+		'''
+		stats = dict(self.stats)
+		stats['Ring'] = len(self.ring)
+		stats['Opens'] = self.meminfo.opens + self.stat.opens + self.uptime.opens
+		return stats
+
+	def close(self):
+		''' @fn close
+			@brief : Close the procfs handles.
+		'''
+		for procFile in (self.meminfo, self.stat, self.uptime):
+			procFile.close()
+
 
 class System(Model):
 	''' @class : System class
 		@brief : Power off, restart etc.
 	'''
-	def __init__(self, eventMgr=None):
+	def __init__(self, eventMgr=None, metrics=None):
 		''' @fn : __init__
 			@brief : Class initialisation.
 		'''
 		super(System, self).__init__('System')
 		self.eventMgr = eventMgr
+		self.metrics = metrics if metrics is not None else MetricsCollector()
 		# can report metrics at different configurable frequency
 		self.memory = 0
 		self.cpu = 0
@@ -139,83 +344,28 @@ class System(Model):
 		else:
 			return POWER_OFFLINE
 
-	def cpuCheck(self):
-		''' @fn : cpuCheck
-			@brief : Percentage CPU usage for each core and total.
-			@details : Read /proc/stat first 3 lines with columns 
-						user, nice, system, idle, iowait, irq, softirq, steal, guest, guest_nice
+	def metricsCheck(self, now):
+		''' @fn : metricsCheck
+			@brief : Sample cpu, memory, disk and uptime when the collector is due.
+			@details : Every sample is streamed as 'time,cpu,memory,disk,battery,power' for the metrics
+					history of the mqtt server.
 		'''
-		'''try:
-			with open('/proc/stat'.encode('utf-8'), 'r') as f:
-				value = f.decode().readline().strip()
-
-				PrevIdle = previdle + previowait
-				Idle = idle + iowait
-
-				PrevNonIdle = prevuser + prevnice + prevsystem + previrq + prevsoftirq + prevsteal
-				NonIdle = user + nice + system + irq + softirq + steal
-
-				PrevTotal = PrevIdle + PrevNonIdle
-				Total = Idle + NonIdle
-
-				# differentiate: actual value minus the previous one
-				totald = Total - PrevTotal
-				idled = Idle - PrevIdle
-
-				CPU_Percentage = (totald - idled)/totald
-		except Exception as e:
-			logging.error("System: Unexpected error {0}.".format(e))
-		'''
-		self.cpu = 0
+		if not self.metrics.due(now):
+			return
 
-	def memCheck(self):
-		''' @fn : memCheck
-			@brief : Check memory usage.
-		'''
-		# if disk full, raise event 
-		# self.eventMgr.raiseEvent(tgEvent.EVCLASS_SYSTEM, tgEvent.EVTOPIC_SYS_DISKFULL, '{}'.format(self.disk), 
-		# tgEvent.EVENT_PRIORITY_HIGH, [tgEvent.EVACTION_DATABASE, tgEvent.EVACTION_NOTIFICATIONS])
-		try:
-			totalMB = os.popen('free -m | grep Mem: | tr -s [:blank:] | cut -d" " -f2').read().strip()
-			usedMB = os.popen('free -m | grep Mem: | tr -s [:blank:] | cut -d" " -f3').read().strip()
-			self.memory = int((float(usedMB) / float(totalMB)) * 100)
-		except:
-			loggin.debug('System: Unable to process disk usage')
-			self.disk = 0
+		sample = self.metrics.collect(now)
+		if sample is None:
+			return
 
-	def diskCheck(self):
-		''' @fn : diskCheck
-			@brief : Check disk usage.
-		'''
-		# if disk full, raise event 
-		# self.eventMgr.raiseEvent(tgEvent.EVCLASS_SYSTEM, tgEvent.EVTOPIC_SYS_DISKFULL, '{}'.format(self.disk), 
-		# tgEvent.EVENT_PRIORITY_HIGH, [tgEvent.EVACTION_DATABASE, tgEvent.EVACTION_NOTIFICATIONS])
-		try:
-			outobj = os.popen('df -Bm | grep /dev/root | tr -s [:blank:] | cut -d" " -f5')
-			out = outobj.read()
-			if '%\n' in out:
-				self.disk = int(out[:-2])
-				if self.disk < 1 or self.disk > 100:
-					self.disk = 0
-			else:
-				self.disk = 0
-		except:
-			loggin.debug('System: Unable to process disk usage')
-			self.disk = 0
-		
-	def upTime(self):
-		'''
-			@brief : Uptime of os in seconds.
-		'''
-		try:
-			p = subprocess.Popen(['cat', '/proc/uptime'],stdout=subprocess.PIPE)
-			o,e = p.communicate()
-			# returns 2 numbers, first is uptime in seconds, second is idle time in seconds
-			self.uptime = o.split()[0]
-		except Exception as e:
-			logging.warning('System: Unable to probe uptime {}.'.format(e))
-			self.uptime = 0
+		self.cpu = int(round(sample.cpu))
+		self.memory = int(sample.memory)
+		self.disk = sample.disk
+		self.uptime = int(sample.uptime)
 
+		if self.eventMgr is not None:
+			self.eventMgr.raiseEvent(tgEvent.EVCLASS_SYSTEM, tgEvent.EVTOPIC_SYS_METRICS,
+									'{:.0f},{:.1f},{:.1f},{},{},{}'.format(now, sample.cpu, sample.memory, sample.disk, self.batLevel, self.currentPower),
+									tgEvent.EVENT_PRIORITY_LOW, [tgEvent.EVACTION_STREAM])
 
 	def powerChange(self):
 		''' @brief : Check power interface '''
@@ -265,17 +415,17 @@ class System(Model):
 			self.powerBat = self.powerCheck(SYS_CLASS_PS_BAT)
 			self.powerChange()
 
+			self.metricsCheck(time.time())
+
 			# check these every minute
 			if time.time() - lazycheck < 60:
 				continue
 				
 			self.batlevCheck()
-			self.cpuCheck()
-			self.memCheck()
-			self.diskCheck()
-			self.upTime()
 			lazycheck = time.time()
 
+		self.metrics.close()
+
 def cleanExit():
 	''' @fn cleanExit
 		@brief : Clean exit handler when signal terminates program.
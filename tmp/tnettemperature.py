@@ -4,6 +4,7 @@
 	@brief : Temperature sensor network management.
 '''
 
+import os
 import threading
 import signal
 import sys
@@ -24,6 +25,11 @@ TEMPERATURE_STATE_HALTED		= 2
 
 TEMPERATURE_CONFIG_FILE			= '/home/tgard/config/temperature.json'
 TEMPERATURE_CONFIG_FILE_BAK		= '/home/tgard/config/temperature.json.bak'
+TEMPERATURE_TRIGGER_FILE		= '/home/tgard/config/temperature.trig'
+
+# trigger journal flush interval (seconds) and records before compacting into the config
+TRIGGER_JOURNAL_FLUSH_INTERVAL	= 5
+TRIGGER_JOURNAL_MAX_RECORDS		= 500
 
 ALARM_STATE_UNSET	 			= -1
 ALARM_STATE_NONE 				= 0
@@ -43,8 +49,39 @@ ALARM_TYPE_HIGH_HIGH			= 1
 ALARM_TYPE_HIGH_LOW				= 2
 ALARM_TYPE_LOW_LOW				= 3
 
+# band the last processed temperature fell in
+ALARM_ZONE_A0					= 0
+ALARM_ZONE_A1					= 1
+ALARM_ZONE_A2					= 2
+
+# sample scheduling, periods in seconds
+SAMPLE_PERIOD_DEFAULT			= 1
+SAMPLE_PERIOD_SMALL_NETWORK		= 8
+SAMPLE_PERIOD_MIN				= 1
+SAMPLE_PERIOD_MAX				= 30
+SAMPLE_SLACK					= 0.05
+# degrees from A1/A2 that count as near threshold
+SAMPLE_THRESHOLD_MARGIN			= 2
+# sweeps without activity before the network drops to the slow period
+SAMPLE_STABLE_SWEEPS			= 10
+# seconds between the temperature stats streamed to the mqtt server
+TEMPERATURE_STATS_INTERVAL		= 60
+
+# live data, full keyframe period in seconds and degrees a sensor must move to be sent in a delta
+LIVE_KEYFRAME_INTERVAL			= 30
+LIVE_DEADBAND					= 0.5
+
 CONTROLLER_STTY 				= '/dev/ttyS2'
 CONTROLLER_RESET_PIN_FILE 		= '/sys/class/gpio/gpio26_ph20/value'
+# temperature returned for a failed read
+CONTROLLER_READ_FAIL			= 200.0
+# seconds between resets of a controller that failed to initialise
+CONTROLLER_RETRY_PERIOD			= 60
+
+# consecutive failed reads before a sensor is faulty, then retry backoff in seconds
+SENSOR_FAULT_READS				= 3
+SENSOR_BACKOFF_MIN				= 8
+SENSOR_BACKOFF_MAX				= 300
 
 HumanReadableAlarmTrigger = ['A1 rising', 'A1 falling', 'A2 rising','A2 falling']
 HumanReadableGlobalAlarmState = ['No alarms', 'Past A1 alarms', 'Past A2 alarms', 'Current A1 alarms', 'Current A2 alarms']
@@ -67,6 +104,15 @@ class Sensor(object):
 		self.triggerA1 = 0
 		self.triggerA2 = 0
 		self.triggerState = ALARM_CHANGE_NONE
+		self.zone = ALARM_ZONE_A0
+		self.alarmTemperature = 0
+		self.previousTemperature = 0
+		self.nextSample = 0
+		# seconds between the last two samples, set by the scheduler
+		self.period = 0
+		self.failedReads = 0
+		self.backoff = 0
+		self.faultReported = False
 		self.config = {}
 
 	def setConfig(self, addr, config):
@@ -125,6 +171,12 @@ class Sensor(object):
 		'''
 		return copy.copy(self.config['Serial'])
 
+	def getBus(self):
+		''' @fn getBus
+			@brief : Index of the bus controller the sensor is wired to.
+		'''
+		return self.config.get('Bus', 0)
+
 	def getName(self):
 		''' @fn getName
 			@brief : Get name of sensor.
@@ -152,7 +204,61 @@ class Sensor(object):
 			@brief : Get a new temperature reading.
 		'''
 		self.lastContact = time.time()
+		self.previousTemperature = self.temperature
 		self.temperature = temperature
+		self.failedReads = 0
+		self.backoff = 0
+
+	def readFailed(self):
+		''' @fn readFailed
+			@brief : Failed read, temperature keeps the last good value. Faulty sensors back off exponentially.
+		'''
+		self.failedReads += 1
+		if self.failedReads >= SENSOR_FAULT_READS:
+			self.backoff = min(max(self.backoff * 2, SENSOR_BACKOFF_MIN), SENSOR_BACKOFF_MAX)
+
+	def isFaulty(self):
+		''' @fn isFaulty
+			@brief : Sensor has failed SENSOR_FAULT_READS reads in a row.
+		'''
+		return self.failedReads >= SENSOR_FAULT_READS
+
+	def getFailedReads(self):
+		''' @fn getFailedReads
+			@brief : Consecutive failed reads.
+		'''
+		return copy.copy(self.failedReads)
+
+	def getBackoff(self):
+		''' @fn getBackoff
+			@brief : Seconds until a faulty sensor is read again, 0 if healthy.
+		'''
+		return copy.copy(self.backoff)
+
+	def getFaultChange(self):
+		''' @fn getFaultChange
+			@brief : Fault transition since last called.
+			@return : True if became faulty, False if recovered, None if unchanged.
+		'''
+		if self.isFaulty() == self.faultReported:
+			return None
+
+		self.faultReported = self.isFaulty()
+		return self.faultReported
+
+	def isStale(self):
+		''' @fn isStale
+			@brief : Temperature is not from the last read, it failed or the sensor was never read.
+		'''
+		return self.failedReads > 0 or self.lastContact == 0
+
+	def getStaleness(self, now):
+		''' @fn getStaleness
+			@brief : Age in seconds of the cached temperature, None if never read.
+		'''
+		if self.lastContact == 0:
+			return None
+		return now - self.lastContact
 
 	def getTemperature(self):
 		''' @fn getTemperature
@@ -189,9 +295,34 @@ class Sensor(object):
 		'''
 		return copy.copy(self.triggerState)
 
+	def isDebouncing(self):
+		''' @fn isDebouncing
+			@brief : Last temperature is in a different band to the alarm state, i.e. a trigger is pending.
+		'''
+		if self.zone == ALARM_ZONE_A2:
+			return self.alarmState != ALARM_STATE_CURRENT_A2
+		elif self.zone == ALARM_ZONE_A1:
+			return self.alarmState != ALARM_STATE_CURRENT_A1
+		else:
+			return self.alarmState >= ALARM_STATE_CURRENT_A1
+
+	def nearThreshold(self, margin):
+		''' @fn nearThreshold
+			@brief : Last processed temperature is within margin of A1 or A2.
+		'''
+		return abs(self.alarmTemperature - self.config['A1']) <= margin or \
+			abs(self.alarmTemperature - self.config['A2']) <= margin
+
+	def isSettled(self):
+		''' @fn isSettled
+			@brief : Temperature did not move between the last two readings.
+		'''
+		return abs(self.temperature - self.previousTemperature) < 1
+
 	def processAlarm(self, alarmInterpretation, alarmTriggerRate, refSensorTemperature=None):
 		''' @fn processAlarm
 			@brief : Process alarm with given thresholds.
+			@param alarmTriggerRate : Readings in a band before it triggers, may change between readings.
 		'''
 		self.triggerState = ALARM_CHANGE_NONE
 
@@ -200,15 +331,17 @@ class Sensor(object):
 		else:
 			temperature = self.temperature
 
+		self.alarmTemperature = temperature
 		#logging.debug('Sensor: Process alarm, temperature = {}.'.format(temperature))
 
 		if alarmInterpretation == ALARM_TYPE_HIGH_HIGH:
 
 			# past A2 
 			if temperature >= self.config['A2']:
+				self.zone = ALARM_ZONE_A2
 				self.triggerA2 += 1
 
-				if self.triggerA2 == alarmTriggerRate:
+				if self.triggerA2 >= alarmTriggerRate:
 					self.triggerA2 = 0
 					# a2 triggered
 
@@ -221,9 +354,10 @@ class Sensor(object):
 
 			# past A1
 			elif temperature >= self.config['A1']:
+				self.zone = ALARM_ZONE_A1
 				self.triggerA1 += 1
 
-				if self.triggerA1 == alarmTriggerRate:
+				if self.triggerA1 >= alarmTriggerRate:
 					self.triggerA1 = 0
 
 					# trigger occur i.e. change alarm state
@@ -242,9 +376,10 @@ class Sensor(object):
 
 			# 
 			else:
+				self.zone = ALARM_ZONE_A0
 				self.triggerA0 += 1
 
-				if self.triggerA0 == alarmTriggerRate:
+				if self.triggerA0 >= alarmTriggerRate:
 					self.triggerA0 = 0
 
 					if self.alarmState >= ALARM_STATE_CURRENT_A1:
@@ -264,9 +399,10 @@ class Sensor(object):
 		elif alarmInterpretation == ALARM_TYPE_HIGH_LOW:
 			# past A2 
 			if temperature >= self.config['A2']:
+				self.zone = ALARM_ZONE_A2
 				self.triggerA2 += 1
 
-				if self.trigger == alarmTriggerRate:
+				if self.triggerA2 >= alarmTriggerRate:
 					self.triggerA2 = 0
 					# a2 triggered
 
@@ -279,9 +415,10 @@ class Sensor(object):
 
 			# past A1
 			elif temperature <= self.config['A1']:
+				self.zone = ALARM_ZONE_A1
 				self.triggerA1 += 1
 
-				if self.triggerA1 == alarmTriggerRate:
+				if self.triggerA1 >= alarmTriggerRate:
 					self.triggerA1 = 0
 
 					# trigger occur i.e. change alarm state
@@ -294,9 +431,10 @@ class Sensor(object):
 
 			# 
 			else:
+				self.zone = ALARM_ZONE_A0
 				self.triggerA0 += 1
 
-				if self.triggerA0 == alarmTriggerRate:
+				if self.triggerA0 >= alarmTriggerRate:
 					self.triggerA0 = 0
 
 					if self.alarmState >= ALARM_STATE_CURRENT_A1:
@@ -320,9 +458,10 @@ class Sensor(object):
 		elif alarmInterpretation == ALARM_TYPE_LOW_LOW:
 			# past A2 
 			if temperature <= self.config['A2']:
+				self.zone = ALARM_ZONE_A2
 				self.triggerA2 += 1
 
-				if self.trigger == alarmTriggerRate:
+				if self.triggerA2 >= alarmTriggerRate:
 					self.triggerA2 = 0
 					# a2 triggered
 
@@ -335,9 +474,10 @@ class Sensor(object):
 
 			# past A1
 			elif temperature <= self.config['A1']:
+				self.zone = ALARM_ZONE_A1
 				self.triggerA1 += 1
 
-				if self.triggerA1 == alarmTriggerRate:
+				if self.triggerA1 >= alarmTriggerRate:
 					self.triggerA1 = 0
 
 					# trigger occur i.e. change alarm state
@@ -356,9 +496,10 @@ class Sensor(object):
 
 			# 
 			else:
+				self.zone = ALARM_ZONE_A0
 				self.triggerA0 += 1
 
-				if self.triggerA0 == alarmTriggerRate:
+				if self.triggerA0 >= alarmTriggerRate:
 					self.triggerA0 = 0
 
 					if self.alarmState >= ALARM_STATE_CURRENT_A1:
@@ -378,20 +519,380 @@ class Sensor(object):
 
 
 
-class Controller(object):
-	''' @class : Controller.py
-		@brief : Tempgard base object for all objects.
-	'''	
+class TriggerJournal(Model):
+	''' @class : TriggerJournal
+		@brief : Append-only store for the sensor A1trig/A2trig flags.
+		@details : Trigger changes are coalesced per sensor and appended to a small journal
+				from the journal thread, so the acquisition loop never rewrites the full
+				temperature config. Each record carries the config commit, records of an
+				older commit are ignored on replay.
+	'''
+	def __init__(self, path=TEMPERATURE_TRIGGER_FILE, flushInterval=TRIGGER_JOURNAL_FLUSH_INTERVAL):
+		''' @fn init
+			@brief : Class initialisation.
+		'''
+		super(TriggerJournal, self).__init__('TriggerJournal')
+		self.path = path
+		self.flushInterval = flushInterval
+		self.lock = threading.Lock()
+		self.wakeup = threading.Event()
+		self.pending = {}
+		self.commit = 0
+		self.records = 0
+
+	def update(self, pos, a1trig, a2trig):
+		''' @fn update
+			@brief : Record new trigger flags for sensor at pos, latest value wins until flushed.
+		'''
+		with self.lock:
+			self.pending['{}'.format(pos)] = (a1trig, a2trig)
+
+	def replay(self, commit):
+		''' @fn replay
+			@brief : Read back trigger flags journaled against the given config commit.
+			@return : Dictionary of sensor pos to (A1trig, A2trig).
+		'''
+		triggers = {}
+		records = 0
+		try:
+			with open(self.path, 'r') as f:
+				for line in f:
+					try:
+						record = json.loads(line)
+					except ValueError:
+						# torn write at the tail, nothing after it is valid
+						break
+
+					records += 1
+					if record['Commit'] == commit:
+						triggers[record['Pos']] = (record['A1trig'], record['A2trig'])
+
+		except IOError:
+			pass
+
+		with self.lock:
+			self.commit = commit
+			self.records = records
+
+		logging.debug('TriggerJournal: Replayed {} trigger changes for commit {}.'.format(len(triggers), commit))
+		return triggers
+
+	def reset(self, commit):
+		''' @fn reset
+			@brief : Config has been written with all trigger flags, start an empty journal.
+		'''
+		with self.lock:
+			self.pending.clear()
+			self.commit = commit
+			self.records = 0
+			try:
+				open(self.path, 'w').close()
+			except IOError as e:
+				logging.error('TriggerJournal: Reset error {}.'.format(e))
+
+	def needsCompaction(self):
+		''' @fn needsCompaction
+			@brief : Journal has grown enough that it should be folded back into the config.
+		'''
+		return self.records >= TRIGGER_JOURNAL_MAX_RECORDS
+
+	def flush(self):
+		''' @fn flush
+			@brief : Append pending trigger changes to the journal.
+		'''
+		with self.lock:
+			if not self.pending:
+				return
+
+			lines = ''
+			for pos in sorted(self.pending.keys()):
+				a1trig, a2trig = self.pending[pos]
+				lines += json.dumps({'Commit': self.commit, 'Pos': pos, 'A1trig': a1trig, 'A2trig': a2trig}) + '\n'
+
+			try:
+				with open(self.path, 'a') as f:
+					f.write(lines)
+					f.flush()
+					os.fsync(f.fileno())
+				self.records += len(self.pending)
+				self.pending.clear()
+			except (IOError, OSError) as e:
+				# keep pending, retry next flush
+				logging.error('TriggerJournal: Flush error {}.'.format(e))
+
+	def run(self):
+		''' @fn run
+			@brief : Flush coalesced trigger changes every flush interval.
+		'''
+		while True:
+			self.wakeup.wait(self.flushInterval)
+
+			if self.stopThread:
+				break
+
+			self.flush()
+
+		self.flush()
+
+	def stop(self):
+		''' @fn stop
+			@brief : Stop journal thread, pending changes are flushed on the way out.
+		'''
+		self.stopThread = True
+		self.wakeup.set()
+		super(TriggerJournal, self).stop()
+		self.wakeup.clear()
+
+
+
+
+class SampleScheduler(object):
+	''' @class : SampleScheduler
+		@brief : Deadline based sampling of the sensor network.
+		@details : Every sensor has its own sample deadline. Sensors near A1/A2 or with a pending
+				trigger are sampled at the fast period, the rest at the session period, or at the
+				slow period once the whole network has been quiet for SAMPLE_STABLE_SWEEPS sweeps.
+	'''
+	def __init__(self):
+		''' @fn init
+			@brief : Class initialisation.
+		'''
+		self.period = SAMPLE_PERIOD_DEFAULT
+		self.fastPeriod = SAMPLE_PERIOD_MIN
+		self.slowPeriod = SAMPLE_PERIOD_MAX
+		self.margin = SAMPLE_THRESHOLD_MARGIN
+		self.stableSweeps = 0
+		self.deadline = 0
+		self.lastSweep = 0
+		self.nextLog = 0
+		self.stats = {'Sweeps': 0, 'TargetPeriod': 0, 'AchievedPeriod': 0, 'Jitter': 0, 'MaxJitter': 0}
+
+	def configure(self, session):
+		''' @fn configure
+			@brief : Set periods from the session config, SamplePeriod and ThresholdMargin are optional.
+		'''
+		if session['TotalSensors'] < 10:
+			period = session.get('SamplePeriod', SAMPLE_PERIOD_SMALL_NETWORK)
+		else:
+			period = session.get('SamplePeriod', SAMPLE_PERIOD_DEFAULT)
+
+		self.period = min(max(period, SAMPLE_PERIOD_MIN), SAMPLE_PERIOD_MAX)
+		self.fastPeriod = max(self.period / 4.0, SAMPLE_PERIOD_MIN)
+		self.slowPeriod = min(self.period * 4, SAMPLE_PERIOD_MAX)
+		self.margin = session.get('ThresholdMargin', SAMPLE_THRESHOLD_MARGIN)
+		self.stableSweeps = 0
+		self.deadline = 0
+		self.lastSweep = 0
+		self.nextLog = 0
+		logging.debug('Scheduler: Sample period {}, fast {}, slow {}.'.format(self.period, self.fastPeriod, self.slowPeriod))
+
+	def delay(self, now):
+		''' @fn delay
+			@brief : Seconds until the next sensor or data log is due.
+		'''
+		return max(min(self.deadline, self.nextLog) - now, 0)
+
+	def logDue(self, now):
+		''' @fn logDue
+			@brief : Data is logged once per session period on its own deadline, partial and fast
+				sweeps in between are not logged.
+		'''
+		if now + SAMPLE_SLACK < self.nextLog:
+			return False
+
+		# keep to the log grid unless the loop overran it
+		if self.nextLog and now - self.nextLog < self.period:
+			self.nextLog += self.period
+		else:
+			self.nextLog = now + self.period
+		return True
+
+	def dueSensors(self, sensors, now):
+		''' @fn dueSensors
+			@brief : Sensors whose deadline has passed, also records sweep timing.
+		'''
+		due = [sensor for sensor in sensors if sensor.nextSample <= now + SAMPLE_SLACK]
+		if not due:
+			return due
+
+		# achieved vs target period and how late the sweep started
+		if self.lastSweep:
+			target = self.deadline - self.lastSweep
+			achieved = now - self.lastSweep
+			jitter = abs(now - self.deadline)
+			if self.stats['Sweeps'] > 1:
+				achieved = 0.9 * self.stats['AchievedPeriod'] + 0.1 * achieved
+				jitter = 0.9 * self.stats['Jitter'] + 0.1 * jitter
+			self.stats['TargetPeriod'] = round(target, 3)
+			self.stats['AchievedPeriod'] = round(achieved, 3)
+			self.stats['Jitter'] = round(jitter, 3)
+			self.stats['MaxJitter'] = round(max(self.stats['MaxJitter'], jitter), 3)
+
+		self.stats['Sweeps'] += 1
+		self.lastSweep = now
+		return due
+
+	def reschedule(self, sensors, sampled, now):
+		''' @fn reschedule
+			@brief : Set the next deadline of the sampled sensors.
+		'''
+		active = False
+		for sensor in sampled:
+			if sensor.isFaulty():
+				continue
+			if sensor.isDebouncing() or sensor.nearThreshold(self.margin) or not sensor.isSettled():
+				active = True
+				break
+
+		if active:
+			self.stableSweeps = 0
+		else:
+			self.stableSweeps += 1
+
+		for sensor in sampled:
+			if sensor.isFaulty():
+				period = sensor.getBackoff()
+			elif sensor.isDebouncing() or sensor.nearThreshold(self.margin):
+				period = self.fastPeriod
+			elif self.stableSweeps >= SAMPLE_STABLE_SWEEPS:
+				period = self.slowPeriod
+			else:
+				period = self.period
+
+			# keep to the deadline grid unless the sweep overran it
+			if sensor.nextSample and now - sensor.nextSample < period:
+				sensor.nextSample += period
+			else:
+				sensor.nextSample = now + period
+			sensor.period = period
+
+		if sensors:
+			self.deadline = min(sensor.nextSample for sensor in sensors)
+
+	def triggerRate(self, sensor, rate):
+		''' @fn triggerRate
+			@brief : Readings of a sensor that take as long as rate readings at the session period,
+				so the trigger debounce keeps its time whether the sensor is sampled fast or slow.
+		'''
+		period = sensor.period or self.period
+		return max(int(round(rate * self.period / float(period))), 1)
+
+	def getStats(self):
+		''' @fn getStats
+			@brief : Sweep period and jitter metrics.
+		'''
+		return copy.copy(self.stats)
+
+
+
+
+class LiveEncoder(object):
+	''' @class : LiveEncoder
+		@brief : Keyframe and delta encoding of the live data stream.
+		@details : A keyframe (EVTOPIC_TEMP_NEW_DATA) carries 'temp,a1,a2,state,stale' for every sensor and
+				is sent every keyframe interval, on request and whenever the network size changes. In
+				between, delta frames (EVTOPIC_TEMP_DELTA_DATA) carry 'pos,temp,a1,a2,state,stale' only for
+				sensors that moved by the deadband from the last value sent or whose alarms or stale flag
+				changed. stale is 1 while the temperature is the last good one of a sensor failing its reads.
+	'''
+	def __init__(self, deadband=LIVE_DEADBAND, keyframeInterval=LIVE_KEYFRAME_INTERVAL):
+		''' @fn init
+			@brief : Class initialisation.
+		'''
+		self.deadband = deadband
+		self.keyframeInterval = keyframeInterval
+		# last values sent, per sensor in network order
+		self.sent = []
+		self.lastKeyframe = 0
+		self.keyframeDue = True
+
+	def configure(self, session):
+		''' @fn configure
+			@brief : Deadband and keyframe interval from the optional session keys, next frame is a keyframe.
+		'''
+		self.deadband = session.get('LiveDeadband', LIVE_DEADBAND)
+		self.keyframeInterval = session.get('KeyframeInterval', LIVE_KEYFRAME_INTERVAL)
+		self.requestKeyframe()
+
+	def requestKeyframe(self):
+		''' @fn requestKeyframe
+			@brief : Send a keyframe with the next frame.
+		'''
+		self.keyframeDue = True
+
+	def encode(self, sensors, now):
+		''' @fn encode
+			@brief : Frame for the current state of the network.
+			@return : (event topic, data), None when no sensor changed.
+		'''
+		values = []
+		for sensor in sensors:
+			a1, a2 = sensor.getAlarms()
+			values.append((sensor.getTemperature(), a1, a2, sensor.getAlarmState(), int(sensor.isStale())))
+
+		if self.keyframeDue or len(values) != len(self.sent) or now - self.lastKeyframe >= self.keyframeInterval:
+			self.sent = values
+			self.lastKeyframe = now
+			self.keyframeDue = False
+			data = ''
+			for value in values:
+				data += ',{:3.1f},{},{},{},{}'.format(*value)
+			return tgEvent.EVTOPIC_TEMP_NEW_DATA, data[1:]
+
+		data = ''
+		for i, value in enumerate(values):
+			last = self.sent[i]
+			if value[1:] != last[1:] or abs(value[0] - last[0]) >= self.deadband:
+				self.sent[i] = value
+				data += ',{},{:3.1f},{},{},{},{}'.format(i+1, *value)
+
+		if data == '':
+			return None
+
+		return tgEvent.EVTOPIC_TEMP_DELTA_DATA, data[1:]
+
+
+
+
+class BusController(object):
+	''' @class : BusController
+		@brief : Handle state shared by the sensor bus controllers used by Temperature.
+		@details : A controller also provides acquire() and release(), which set ctlHandle, and
+				temperature(sensorSerial), which returns CONTROLLER_READ_FAIL when a sensor can't
+				be read. state() is negative while the controller is not acquired.
+	'''
 	def __init__(self):
 		''' @fn init
 			@brief : Class initialisation.
 		'''
 		self.ctlHandle = -1
-		self.cowlib = ctypes.cdll.LoadLibrary('/usr/lib/libtnetonewire.so')
 
 	def state(self):
 		return copy.copy(self.ctlHandle)
 
+	def reset(self):
+		''' @fn reset
+			@brief : Release and acquire the controller again.
+		'''
+		self.release()
+		self.acquire()
+
+
+class Controller(BusController):
+	''' @class : Controller.py
+		@brief : 1-wire bus controller through libtnetonewire.
+	'''	
+	def __init__(self, port=CONTROLLER_STTY, resetPinFile=CONTROLLER_RESET_PIN_FILE):
+		''' @fn init
+			@brief : Class initialisation.
+			@param port : Serial port of the bus master.
+			@param resetPinFile : Gpio value file that powers the bus master.
+		'''
+		super(Controller, self).__init__()
+		self.port = port
+		self.resetPinFile = resetPinFile
+		self.cowlib = ctypes.cdll.LoadLibrary('/usr/lib/libtnetonewire.so')
+
 	def acquire(self):
 		''' @fn acquire
 			@brief : Initialise the controller via ctypes.
@@ -402,13 +903,13 @@ class Controller(object):
 			self.ctlHandle = -1	
 			f = self.cowlib.OWAcquireBusController
 			f.argtypes = [ctypes.c_char_p]
-			self.ctlHandle = f(CONTROLLER_STTY.encode())
+			self.ctlHandle = f(self.port.encode())
 
 		except Exception as e:
 			logging.critical('Controller: Acquire failed {0}.'.format(e))
 
 		if self.ctlHandle >= 0:
-			logging.debug('Controller: Initialised.')			
+			logging.debug('Controller: Initialised on {0}.'.format(self.port))			
 			
 		else:
 			logging.critical('Controller: Failed to initialise.')	
@@ -436,7 +937,7 @@ class Controller(object):
 			@brief : Hw reset of the bus controller.
 		'''
 		# power cycle		
-		with open(CONTROLLER_RESET_PIN_FILE, 'w') as f:
+		with open(self.resetPinFile, 'w') as f:
 			f.write('0')
 			time.sleep(3)
 			f.write('1')	
@@ -454,7 +955,7 @@ class Controller(object):
 		''' @fn temperature
 			@brief : Read temperature from sensor.
 		'''
-		value = 200.0
+		value = CONTROLLER_READ_FAIL
 		try:
 			f = self.cowlib.OWReadTemperature
 			f.argtypes = [ctypes.c_int, ctypes.c_char_p]
@@ -470,26 +971,118 @@ class Controller(object):
 
 
 
+class BusWorker(Model):
+	''' @class : BusWorker
+		@brief : Acquisition thread of one bus controller.
+		@details : Temperature hands every worker the due sensors of its bus and waits for
+				all of them, so a sweep takes as long as the slowest bus instead of the sum
+				of all buses.
+	'''
+	def __init__(self, bus, manager):
+		''' @fn init
+			@brief : Class initialisation.
+			@param manager : Temperature manager owning the bus.
+		'''
+		super(BusWorker, self).__init__('BusWorker{}'.format(bus))
+		self.bus = bus
+		self.manager = manager
+		self.request = threading.Event()
+		self.done = threading.Event()
+		self.sensors = []
+		self.processed = []
+		self.now = 0
+
+	def read(self, sensors, now):
+		''' @fn read
+			@brief : Start reading sensors, returns immediately.
+		'''
+		self.sensors = sensors
+		self.now = now
+		self.processed = []
+		self.done.clear()
+		self.request.set()
+
+	def wait(self):
+		''' @fn wait
+			@brief : Wait for the sensors handed to read().
+			@return : Sensors with a fresh temperature.
+		'''
+		self.done.wait()
+		return self.processed
+
+	def run(self):
+		''' @fn run
+			@brief : Read requested sensors until stopped.
+		'''
+		while True:
+			self.request.wait()
+			self.request.clear()
+
+			if self.stopThread:
+				break
+
+			processed = []
+			for sensor in self.sensors:
+				if self.manager.sweepCancelled():
+					break
+
+				if self.manager.readSensor(sensor, self.now):
+					processed.append(sensor)
+
+			self.processed = processed
+			self.done.set()
+
+		self.done.set()
+
+	def stop(self):
+		''' @fn stop
+			@brief : Stop worker thread.
+		'''
+		self.stopThread = True
+		self.request.set()
+		super(BusWorker, self).stop()
+
+
+
+
 class Temperature(Model):
 	''' @class : Temperature
 		@brief : Temperature sensor manager.
 	'''
-	def __init__(self, eventMgr=None, tempLogger=None):
+	def __init__(self, eventMgr=None, tempLogger=None, controllers=None,
+				configFile=TEMPERATURE_CONFIG_FILE, triggerFile=TEMPERATURE_TRIGGER_FILE):
 		''' @fn : __init__
 			@brief : Class initialisation.
+			@param controllers : Bus controllers indexed by the sensor 'Bus' config, defaults
+						to one 1-wire Controller.
 		'''
 		super(Temperature, self).__init__('Temperature')
 		self.eventMgr = eventMgr
+		self.configFile = configFile
 		self.config = {}
 		self.globalAlarmStatus = 0
 		self.anySensorsReferenced = False
+		self.noSensors = False
 		self.configured = False
-		self.interval = 1
 		self.state = TEMPERATURE_STATE_OFFLINE
-		self.tempLogger = TnetDataLogger() 
-
-		self.controller = Controller()
+		if tempLogger is None:
+			tempLogger = TnetDataLogger()
+		self.tempLogger = tempLogger
+
+		if controllers is None:
+			controllers = [Controller()]
+		self.controllers = list(controllers)
+		# one acquisition thread per bus when there is more than one
+		self.workers = []
+		# next reset time of controllers that failed to initialise
+		self.controllerRetry = {}
 		self.sensors = []
+		self.triggerJournal = TriggerJournal(path=triggerFile)
+		self.scheduler = SampleScheduler()
+		self.liveEncoder = LiveEncoder()
+		self.nextStats = 0
+		# wakes the run loop early on stop, resume and config changes
+		self.wakeup = threading.Event()
 
 		logging.info('Temperature: Initialised.')
 
@@ -500,6 +1093,7 @@ class Temperature(Model):
 	def resume(self):
 		logging.info('Temperature: Resume processing.')
 		self.state = TEMPERATURE_STATE_ONLINE
+		self.wakeup.set()
 
 	def loadConfig(self):
 		''' @fn : loadConfig
@@ -508,9 +1102,15 @@ class Temperature(Model):
 
 		try:
 			
-			with open(TEMPERATURE_CONFIG_FILE, 'r') as f:
+			with open(self.configFile, 'r') as f:
 				self.config = json.load(f)
 
+			# trigger flags changed since the config was last written
+			triggers = self.triggerJournal.replay(self.config['Commit'])
+			for pos in triggers:
+				if pos in self.config['Sensors']:
+					self.config['Sensors'][pos]['A1trig'], self.config['Sensors'][pos]['A2trig'] = triggers[pos]
+
 			# pass the session name to the logger
 			self.tempLogger.newSession(self.config['Session']['Number'], removePrevious=False)
 			# set batchsize depending in the size of the network
@@ -536,6 +1136,8 @@ class Temperature(Model):
 
 			# set the global alarm status depending on past a1/a2 of the sensors
 			self.processAlarmStatus()
+			self.scheduler.configure(self.config['Session'])
+			self.liveEncoder.configure(self.config['Session'])
 			logging.info('Temperature: Config loaded from file.')
 			self.configured = True
 
@@ -551,9 +1153,11 @@ class Temperature(Model):
 			@brief : Dump config to file.
 		'''
 		try:
-			with open(TEMPERATURE_CONFIG_FILE, 'w') as f:
+			with open(self.configFile, 'w') as f:
 				json.dump(self.config, f)
-		
+
+			# config now holds every trigger flag
+			self.triggerJournal.reset(self.config['Commit'])
 			logging.info('Temperature: Config dumped to file.')
 		
 		except Exception as e:
@@ -609,11 +1213,14 @@ class Temperature(Model):
 						self.sensors[i].changeConfig(self.config['Sensors'][pos])
 
 			self.processAlarmStatus()
+			self.scheduler.configure(self.config['Session'])
+			self.liveEncoder.configure(self.config['Session'])
 			
 			# update the commit
 			self.config['Commit'] = backup['Commit'] + 1
 			self.dumpConfig()
 			self.configured = True
+			self.wakeup.set()
 			logging.debug('Temperature: Change config.')
 
 			# change sessio name for logger
@@ -648,12 +1255,15 @@ class Temperature(Model):
 
 			self.setSensorConfig()
 			self.processAlarmStatus()
+			self.scheduler.configure(self.config['Session'])
+			self.liveEncoder.configure(self.config['Session'])
 					
 			# update the commit
 			self.config['Commit'] = backup['Commit'] + 1
 			self.dumpConfig()
 			logging.debug('Temperature: Set config.')
 			self.configured = True
+			self.wakeup.set()
 
 			self.tempLogger.flushLogs()
 			self.tempLogger.newSession(self.config['Session']['Number'], removePrevious=True)
@@ -746,192 +1356,339 @@ class Temperature(Model):
 
 	def startController(self):
 		''' @fn : startController
-			@brief : Initialise controller.
+			@brief : Initialise controllers and start the per bus workers.
+		'''
+		for controller in self.controllers:
+			controller.acquire()
+
+		if len(self.controllers) > 1 and not self.workers:
+			for bus in range(len(self.controllers)):
+				worker = BusWorker(bus, self)
+				worker.start()
+				self.workers.append(worker)
+
+	def stopController(self):
+		''' @fn : stopController
+			@brief : Stop the per bus workers and release controllers.
 		'''
-		self.controller.acquire()
+		for worker in self.workers:
+			worker.stop()
+		self.workers = []
 
-	def streamData(self):
+		for controller in self.controllers:
+			controller.release()
+
+	def checkControllers(self, now):
+		''' @fn : checkControllers
+			@brief : Reset controllers that are not initialised, at most once per retry period each.
+			@return : True if at least one controller is usable.
 		'''
-			@brief : Stream live data.
+		usable = False
+		for bus, controller in enumerate(self.controllers):
+			if controller.state() < 0 and now >= self.controllerRetry.get(bus, 0):
+				logging.error('Temperature: Controller {} not initialised, resetting.'.format(bus))
+				self.controllerRetry[bus] = now + CONTROLLER_RETRY_PERIOD
+				controller.reset()
+
+			if controller.state() >= 0:
+				usable = True
+
+		return usable
+
+	def streamData(self, now=None):
+		'''
+			@brief : Stream live data, a keyframe or the sensors that changed.
 		'''	
-		data = ''
-		for sensor in self.sensors:
-			a1, a2 = sensor.getAlarms()
-			data += ',{:3.1f},{},{},{}'.format(sensor.getTemperature(), a1, a2, sensor.getAlarmState())	
-	
-		self.eventMgr.raiseEvent(tgEvent.EVCLASS_TEMP, tgEvent.EVTOPIC_TEMP_NEW_DATA, data[1:], tgEvent.EVENT_PRIORITY_HIGH, [tgEvent.EVACTION_STREAM])
+		if now is None:
+			now = time.time()
+
+		frame = self.liveEncoder.encode(self.sensors, now)
+		if frame is None:
+			return
+
+		topic, data = frame
+		self.eventMgr.raiseEvent(tgEvent.EVCLASS_TEMP, topic, data, tgEvent.EVENT_PRIORITY_HIGH, [tgEvent.EVACTION_STREAM])
 
 	def logData(self):
 		'''
-			@brief : Send minute data to logger.
+			@brief : Send minute data to logger, 'temp,a1,a2,state,stale' per sensor.
 		'''	
 		data = ''
 		for sensor in self.sensors:
 			a1, a2 = sensor.getAlarms()
-			data += ',{:3.1f},{},{},{}'.format(sensor.getTemperature(), a1, a2, sensor.getAlarmState())	
+			data += ',{:3.1f},{},{},{},{}'.format(sensor.getTemperature(), a1, a2, sensor.getAlarmState(), int(sensor.isStale()))
 	
 		self.tempLogger.log(int(time.time()), data[1:])
 
+	def readSensor(self, sensor, now):
+		''' @fn : readSensor
+			@brief : Read one sensor, tracking failed reads.
+			@return : True if the sensor has a fresh temperature.
+		'''
+		bus = sensor.getBus()
+		if bus < 0 or bus >= len(self.controllers):
+			temperature = CONTROLLER_READ_FAIL
+		else:
+			temperature = self.controllers[bus].temperature(sensor.getSerial())
+
+		if temperature >= CONTROLLER_READ_FAIL:
+			sensor.readFailed()
+			return False
+
+		sensor.setTemperature(temperature)
+		return True
+
+	def sweepCancelled(self):
+		''' @fn : sweepCancelled
+			@brief : Sweep in progress should be abandoned.
+		'''
+		return self.stopThread or self.state == TEMPERATURE_STATE_HALTED
+
+	def readSensors(self, sensors, now):
+		''' @fn : readSensors
+			@brief : Read sensors, buses in parallel when there is more than one.
+			@return : Sensors with a fresh temperature in network order, None if cancelled.
+		'''
+		processed = []
+		if not self.workers:
+			for sensor in sensors:
+				if self.sweepCancelled():
+					return None
+
+				if self.readSensor(sensor, now):
+					processed.append(sensor)
+
+			return processed
+
+		batches = [[] for worker in self.workers]
+		for sensor in sensors:
+			bus = sensor.getBus()
+			if bus < 0 or bus >= len(batches):
+				self.readSensor(sensor, now)
+			else:
+				batches[bus].append(sensor)
+
+		busy = []
+		for worker, batch in zip(self.workers, batches):
+			if batch:
+				worker.read(batch, now)
+				busy.append(worker)
+
+		for worker in busy:
+			processed += worker.wait()
+
+		if self.sweepCancelled():
+			return None
+
+		# merge the buses back into one session view
+		processed.sort(key=lambda sensor: sensor.getPos())
+		return processed
+
+	def processSensorAlarm(self, sensor, refSensorTemperature=None):
+		''' @fn : processSensorAlarm
+			@brief : Process alarm of one sensor and journal its trigger flags if they changed.
+			@return : True if A1trig or A2trig changed.
+		'''
+		a1trigBefore, a2trigBefore = sensor.getTriggeredAlarms()
+		# TriggerRate counts readings at the session period
+		triggerRate = self.scheduler.triggerRate(sensor, self.config['Session']['TriggerRate'])
+		sensor.processAlarm(self.config['Session']['AlarmType'], triggerRate, refSensorTemperature=refSensorTemperature)
+		a1trigNow, a2trigNow = sensor.getTriggeredAlarms()
+		if a1trigBefore != a1trigNow or a2trigBefore != a2trigNow:
+			logging.debug("Sensor {} trig changed, a1trig before = {} a1trig now = {} a2trig before {} a2trig now {}".format(sensor.getPos(),
+				a1trigBefore, a1trigNow, a2trigBefore, a2trigNow))
+			self.triggerJournal.update(sensor.getPos(), a1trigNow, a2trigNow)
+			return True
+
+		return False
+
+	def processSensorHealth(self):
+		''' @fn : processSensorHealth
+			@brief : Raise fault events once per sensor fault/recovery and when the whole network is lost.
+		'''
+		for sensor in self.sensors:
+			change = sensor.getFaultChange()
+			if change is None:
+				continue
+
+			data = '{},{},{}'.format(sensor.getPos(), sensor.getName(), sensor.getSerial())
+			if change:
+				logging.warning('Temperature: Sensor {} faulty, backing off {} seconds.'.format(sensor.getPos(), sensor.getBackoff()))
+				self.eventMgr.raiseEvent(tgEvent.EVCLASS_TEMP, tgEvent.EVTOPIC_TEMP_SENSOR_FAULT, data, tgEvent.EVENT_PRIORITY_HIGH, [tgEvent.EVACTION_STREAM, tgEvent.EVACTION_DATABASE])
+			else:
+				logging.info('Temperature: Sensor {} recovered.'.format(sensor.getPos()))
+				self.eventMgr.raiseEvent(tgEvent.EVCLASS_TEMP, tgEvent.EVTOPIC_TEMP_SENSOR_OK, data, tgEvent.EVENT_PRIORITY_MEDIUM, [tgEvent.EVACTION_STREAM, tgEvent.EVACTION_DATABASE])
+
+		noSensors = len(self.sensors) > 0 and all(sensor.isFaulty() for sensor in self.sensors)
+		if noSensors and not self.noSensors:
+			logging.error('Temperature: No sensors responding.')
+			self.eventMgr.raiseEvent(tgEvent.EVCLASS_TEMP, tgEvent.EVTOPIC_TEMP_NO_SENSORS, '', tgEvent.EVENT_PRIORITY_HIGH, [tgEvent.EVACTION_STREAM, tgEvent.EVACTION_DATABASE])
+		self.noSensors = noSensors
+
+	def getSensorHealth(self):
+		''' @fn : getSensorHealth
+			@brief : Fault state and staleness of the last good reading of every sensor.
+		'''
+		now = time.time()
+		health = []
+		for sensor in self.sensors:
+			health.append({'Pos': sensor.getPos(),
+						'Faulty': sensor.isFaulty(),
+						'FailedReads': sensor.getFailedReads(),
+						'Backoff': sensor.getBackoff(),
+						'LastContact': sensor.getLastContact(),
+						'Staleness': sensor.getStaleness(now)})
+		return health
+
 	def updateSensors(self):
 		''' @fn : updateSensors
 			@brief : Update temperature and alarm status for network.
 		'''
-		sensorAlarmTriggerChanged =False
+		# only the sensors whose sample deadline has passed
+		now = time.time()
+		sampled = self.scheduler.dueSensors(self.sensors, now)
+		if not sampled:
+			return
+
+		# read first, faulty sensors keep their last good temperature and are not processed
+		processed = self.readSensors(sampled, now)
+		if processed is None:
+			return
+
+		self.processSensorHealth()
+
+		sensorAlarmTriggerChanged = False
+		for sensor in processed:
+			if sensor.getSensorRef() == 0:
+				if self.processSensorAlarm(sensor):
+					sensorAlarmTriggerChanged = True
+
 		# some sensors reference other sensors for differential temperature read
 		if self.anySensorsReferenced:
-			for sensor in self.sensors:
-				if self.stopThread:
-					return
-
-				if self.state == TEMPERATURE_STATE_HALTED:
-					return
-
-				temperature = self.controller.temperature(sensor.getSerial())
-				sensor.setTemperature(temperature)
-				refSensor = sensor.getSensorRef()
-				if refSensor == 0:
-					a1trigBefore, a2trigBefore = sensor.getTriggeredAlarms()
-					sensor.processAlarm(self.config['Session']['AlarmType'], self.config['Session']['TriggerRate'])
-					a1trigNow, a2trigNow = sensor.getTriggeredAlarms()
-					if a1trigBefore != a1trigNow or a2trigBefore != a2trigNow:
-						logging.debug("Sensor {} trig changed, a1trig before = {} a1trig now = {} a2trig before {} a2trig now {}".format(sensor.getPos(),
-							a1trigBefore, a1trigNow, a2trigBefore, a2trigNow))
-						sensorAlarmTriggerChanged = True
-
-			for sensor in self.sensors:
+			for sensor in processed:
 				refSensor = sensor.getSensorRef() 
 				addrRefSensor = self.sensors[refSensor-1].getAddr()
 				myAddr = sensor.getAddr()
 				if refSensor != 0 and addrRefSensor != myAddr:
 					tempOfRefSensor = self.sensors[refSensor-1].getTemperature()
 					#logging.debug('Temperature: Sensor {} references sensor {}.'.format(myAddr, addrRefSensor))
-					a1trigBefore, a2trigBefore = sensor.getTriggeredAlarms()
-					sensor.processAlarm(self.config['Session']['AlarmType'], self.config['Session']['TriggerRate'], refSensorTemperature=tempOfRefSensor)
-					a1trigNow, a2trigNow = sensor.getTriggeredAlarms()
-					if a1trigBefore != a1trigNow or a2trigBefore != a2trigNow:
-						logging.debug("Sensor {} trig changed, a1trig before = {} a1trig now = {} a2trig before {} a2trig now {}".format(sensor.getPos(),
-							a1trigBefore, a1trigNow, a2trigBefore, a2trigNow))
+					if self.processSensorAlarm(sensor, tempOfRefSensor):
 						sensorAlarmTriggerChanged = True
 
-		# no referencing, read and process in same loop
-		else:
-			for sensor in self.sensors:
-				if self.stopThread:
-					return
-
-				if self.state == TEMPERATURE_STATE_HALTED:
-					return
+		self.scheduler.reschedule(self.sensors, sampled, now)
 
-				temperature = self.controller.temperature(sensor.getSerial())
-				sensor.setTemperature(temperature)
-
-				a1trigBefore, a2trigBefore = sensor.getTriggeredAlarms()
-				sensor.processAlarm(self.config['Session']['AlarmType'], self.config['Session']['TriggerRate'])
-				a1trigNow, a2trigNow = sensor.getTriggeredAlarms()
-				if a1trigBefore != a1trigNow or a2trigBefore != a2trigNow:
-					logging.debug("Sensor {} trig changed, a1trig before = {} a1trig now = {} a2trig before {} a2trig now {}".format(sensor.getPos(),
-						a1trigBefore, a1trigNow, a2trigBefore, a2trigNow))
-					sensorAlarmTriggerChanged = True
-
-		# process triggers and save to file
-		if sensorAlarmTriggerChanged:
-			logging.debug("Alarm triggers changed, saving config")
+		# triggers are journaled, config only rewritten once the journal grows large
+		if sensorAlarmTriggerChanged and self.triggerJournal.needsCompaction():
+			logging.debug("Alarm trigger journal full, saving config")
 			self.dumpConfig()
 
 		# update global alarm status
 		self.processAlarmStatus()
 
 		# stream the data
-		self.streamData()
+		self.streamData(now)
 
 		# any sensors in triggered state then send alarm event
 		sensorStrA1 = ''
 		sensorStrA2 = ''
-		for sensor in self.sensors:
+		# sensor addresses and trigger, repeats of the same change are deduplicated by the event manager
+		sourceA1 = ''
+		sourceA2 = ''
+		for sensor in processed:
 			triggerState = sensor.getTriggerState() 
 			if triggerState != ALARM_CHANGE_NONE:
 				a1,a2 = sensor.getAlarms() 
-				# format is addr,name,temp,a1,a2,state,trigger
-				sensorStr = ',{},{},{},{},{},{},{}'.format(sensor.getAddr(),
-															sensor.getName(),
-															sensor.getTemperature(),
-															a1,
-															a2,
-															HumanReadableSensorAlarmState[sensor.getAlarmState()],
-															HumanReadableAlarmTrigger[triggerState])
+				entry = tgEvent.AlarmEntry(sensor.getAddr(),
+											sensor.getName(),
+											sensor.getTemperature(),
+											a1,
+											a2,
+											HumanReadableSensorAlarmState[sensor.getAlarmState()],
+											HumanReadableAlarmTrigger[triggerState])
+				sensorStr = ',' + entry.serialize()
 
 				logging.debug('Temperature: Sensor alarm trigger {}.'.format(sensorStr))
 
 				# add 
 				if triggerState == ALARM_CHANGE_RISING_A1 or triggerState == ALARM_CHANGE_FALLING_A1:
 					sensorStrA1 += sensorStr
+					sourceA1 += ',{}:{}'.format(sensor.getAddr(), triggerState)
 				elif triggerState == ALARM_CHANGE_FALLING_A2 or triggerState == ALARM_CHANGE_RISING_A2:
 					sensorStrA2 += sensorStr
+					sourceA2 += ',{}:{}'.format(sensor.getAddr(), triggerState)
 
 		if sensorStrA2 != '':
 			# add global alarm status to front
 			sensorStrA2 = '{}{}'.format(HumanReadableGlobalAlarmState[self.globalAlarmStatus], sensorStrA2)
-			self.eventMgr.raiseEvent(tgEvent.EVCLASS_TEMP, tgEvent.EVTOPIC_TEMP_ALRM_A2, sensorStrA2, tgEvent.EVENT_PRIORITY_HIGH, [tgEvent.EVACTION_STREAM, tgEvent.EVACTION_DATABASE, tgEvent.EVACTION_NOTIFICATIONS])
+			self.eventMgr.raiseEvent(tgEvent.EVCLASS_TEMP, tgEvent.EVTOPIC_TEMP_ALRM_A2, sensorStrA2, tgEvent.EVENT_PRIORITY_HIGH, [tgEvent.EVACTION_STREAM, tgEvent.EVACTION_DATABASE, tgEvent.EVACTION_NOTIFICATIONS], source=sourceA2[1:])
 
 		if sensorStrA1 != '':
 			# add global alarm status to front
 			sensorStrA1 = '{}{}'.format(HumanReadableGlobalAlarmState[self.globalAlarmStatus], sensorStrA1)
-			self.eventMgr.raiseEvent(tgEvent.EVCLASS_TEMP, tgEvent.EVTOPIC_TEMP_ALRM_A1, sensorStrA1, tgEvent.EVENT_PRIORITY_HIGH, [tgEvent.EVACTION_STREAM, tgEvent.EVACTION_DATABASE, tgEvent.EVACTION_NOTIFICATIONS])
+			self.eventMgr.raiseEvent(tgEvent.EVCLASS_TEMP, tgEvent.EVTOPIC_TEMP_ALRM_A1, sensorStrA1, tgEvent.EVENT_PRIORITY_HIGH, [tgEvent.EVACTION_STREAM, tgEvent.EVACTION_DATABASE, tgEvent.EVACTION_NOTIFICATIONS], source=sourceA1[1:])
 
 
 
 	def run(self):
 		''' @fn : threadTask
 			@brief : Run main task.
+			@details : Sleeps until the next sensor sample deadline given by the scheduler.
 		'''
 
-		minutetime = time.time()
-		lasttime = 0
-		updatesensortime = 0
+		delay = 0
 		while True:
 			
-			time.sleep(1)
+			self.wakeup.wait(delay)
+			self.wakeup.clear()
 
 			if self.stopThread:
 				break
 
-			if time.time() - lasttime < self.interval:
-				continue
-
+			# sleep until resumed
 			if self.state == TEMPERATURE_STATE_HALTED:
+				delay = None
 				continue
 
 			if not self.configured:
 				logging.error('Temperature: Unable to load configuration. Check in 60 seconds.')
-				self.interval = 60
+				delay = 60
 				self.loadConfig()
-				lasttime = time.time()
 				continue
 
-			if self.controller.state() < 0:
-				logging.error('Temperature: Controller not initialised. Check in 60 seconds.')
-				self.interval = 60
-				self.controller.reset()
-				lasttime = time.time()
+			# sensors on a faulty bus fail their reads until its controller is back
+			if not self.checkControllers(time.time()):
+				logging.error('Temperature: No controller initialised. Check in {} seconds.'.format(CONTROLLER_RETRY_PERIOD))
+				delay = CONTROLLER_RETRY_PERIOD
 				continue
 
-			self.interval = 1
-			
-			# if total sensors is less than 10, only update every 8 seconds otherwise update every time
-			if self.config["Session"]["TotalSensors"] < 10:
-				if time.time() - updatesensortime < 8:
-					continue
+			if self.scheduler.delay(time.time()) <= SAMPLE_SLACK:
+				self.updateSensors()
 
-			self.updateSensors()
-			updatesensortime = time.time()
-			
+			if self.scheduler.logDue(time.time()):
+				self.logData()
+
+			self.streamStats(time.time())
 
-			# log data every minute
-			#if time.time() - minutetime >= 60:
-			#	minutetime = time.time()
-			self.logData()
+			delay = self.scheduler.delay(time.time())
+
+	def getStats(self):
+		''' @fn : getStats
+			@brief : Target vs achieved sweep period and jitter of the scheduler and the health of every sensor.
+		'''
+		stats = {}
+		stats['Scheduler'] = self.scheduler.getStats()
+		stats['Sensors'] = self.getSensorHealth()
+		return stats
+
+	def streamStats(self, now):
+		''' @fn : streamStats
+			@brief : Stream the stats as json every TEMPERATURE_STATS_INTERVAL for the temperature stats api.
+		'''
+		if now < self.nextStats:
+			return
 
-			lasttime = time.time()
+		self.nextStats = now + TEMPERATURE_STATS_INTERVAL
+		self.eventMgr.raiseEvent(tgEvent.EVCLASS_TEMP, tgEvent.EVTOPIC_TEMP_STATS, json.dumps(self.getStats()), tgEvent.EVENT_PRIORITY_LOW, [tgEvent.EVACTION_STREAM])
 
 
 	def start(self):
@@ -939,9 +1696,9 @@ class Temperature(Model):
 			@brief : Start manager.
 		'''	
 		self.startController()
-		self.interval = 1
 		logging.info('Temperature: Going online.')
 		self.state = TEMPERATURE_STATE_ONLINE
+		self.triggerJournal.start()
 		super(Temperature,self).start()		
 			
 	def stop(self):
@@ -951,8 +1708,11 @@ class Temperature(Model):
 		
 		logging.info('Temperature: Going offline.')
 		self.state = TEMPERATURE_STATE_OFFLINE
+		self.stopThread = True
+		self.wakeup.set()
 		super(Temperature,self).stop()
-		self.controller.release()
+		self.triggerJournal.stop()
+		self.stopController()
 		
 	def getState(self):
 		''' @fn : getState
@@ -970,6 +1730,7 @@ class Temperature(Model):
 			# move temperature config to backup
 			p = subprocess.Popen(['mv', TEMPERATURE_CONFIG_FILE, TEMPERATURE_CONFIG_FILE_BAK], stdout=subprocess.PIPE)
 			p.communicate()
+			self.triggerJournal.reset(0)
 			
 			return True
 		except Exception as e:
@@ -1,7 +1,40 @@
 import logging
 import os
+import sys
+import time
+import threading
+import collections
 import dbus
 
+# errors after which the proxies of a service are looked up again and the call repeated, a call
+# without a reply (NoReply) may have run so it is never repeated
+DBUS_STALE_ERRORS = ('org.freedesktop.DBus.Error.ServiceUnknown',
+					'org.freedesktop.DBus.Error.UnknownObject',
+					'org.freedesktop.DBus.Error.Disconnected',
+					'org.freedesktop.DBus.Error.NameHasNoOwner')
+# proxies kept, least recently used go first, object paths like systemd units are open ended
+DBUS_CACHE_SIZE = 64
+
+mainLoopLock = threading.Lock()
+mainLoopInstalled = False
+
+def install_main_loop():
+	''' make the GLib main loop the default of new connections, once, so signals on the shared
+		connection are dispatched when a main loop runs. Done on the first connection rather than
+		on import so importing this module leaves dbus alone. '''
+
+	global mainLoopInstalled
+	with mainLoopLock:
+		if mainLoopInstalled:
+			return
+		mainLoopInstalled = True
+		try:
+			from dbus.mainloop.glib import DBusGMainLoop
+		except ImportError:
+			logging.warning('DBus cache: no GLib main loop, signals are not dispatched')
+			return
+		DBusGMainLoop(set_as_default=True)
+
 def gpio_enable(pin, pinLong):
 
 	if os.path.exists('/sys/class/gpio/' + pinLong + '/direction'):
@@ -28,6 +61,96 @@ def gpio_get_value(pinLong):
 		return the_file.read().strip()
 
 
+class DBusCache():
+	''' Shared bus connection and interface proxies by (service, path, interface).
+
+		get_object introspects the object on the first call through a new proxy, so keeping the
+		proxies saves that round trip as well as the lookups. The proxies of a service are dropped
+		when its owner changes, signalled by NameOwnerChanged when a main loop dispatches signals
+		or found out by a call failing with one of DBUS_STALE_ERRORS. At most size proxies are
+		kept, the least recently used is dropped first. '''
+
+	def __init__(self, bus_factory=dbus.SystemBus, size=DBUS_CACHE_SIZE):
+		self._bus_factory = bus_factory
+		self._bus = None
+		self._size = size
+		self._interfaces = collections.OrderedDict()
+		self._lock = threading.Lock()
+		self._stats = {'connects': 0, 'hits': 0, 'misses': 0, 'invalidations': 0, 'evictions': 0, 'retries': 0}
+
+	def bus(self):
+		''' connection, made on first use '''
+
+		with self._lock:
+			if self._bus is None:
+				install_main_loop()
+				self._bus = self._bus_factory()
+				self._stats['connects'] += 1
+				try:
+					self._bus.add_signal_receiver(self._name_owner_changed, signal_name='NameOwnerChanged',
+						dbus_interface='org.freedesktop.DBus', bus_name='org.freedesktop.DBus', path='/org/freedesktop/DBus')
+				except dbus.exceptions.DBusException as e:
+					logging.warning('DBus cache: no owner change signals {}'.format(e))
+			return self._bus
+
+	def _name_owner_changed(self, name, old_owner, new_owner):
+		''' service restarted or went away '''
+
+		self.invalidate(name)
+
+	def interface(self, service, path, interface):
+		''' cached dbus.Interface of an object '''
+
+		key = (service, path, interface)
+		with self._lock:
+			proxy = self._interfaces.get(key)
+			if proxy is not None:
+				self._interfaces.move_to_end(key)
+				self._stats['hits'] += 1
+				return proxy
+
+		proxy = dbus.Interface(self.bus().get_object(service, path), interface)
+		with self._lock:
+			self._interfaces[key] = proxy
+			self._stats['misses'] += 1
+			while len(self._interfaces) > self._size:
+				self._interfaces.popitem(last=False)
+				self._stats['evictions'] += 1
+		return proxy
+
+	def call(self, service, path, interface, method, *args, **kwargs):
+		''' call a method through the cached proxy, looked up again once if the service has changed '''
+
+		try:
+			return getattr(self.interface(service, path, interface), method)(*args, **kwargs)
+		except dbus.exceptions.DBusException as e:
+			if e.get_dbus_name() not in DBUS_STALE_ERRORS:
+				raise
+			self._stats['retries'] += 1
+			self.invalidate(service)
+			return getattr(self.interface(service, path, interface), method)(*args, **kwargs)
+
+	def invalidate(self, service=None):
+		''' drop the proxies of a service, or all of them '''
+
+		with self._lock:
+			for key in list(self._interfaces):
+				if service is None or key[0] == service:
+					del self._interfaces[key]
+					self._stats['invalidations'] += 1
+
+	def get_stats(self):
+		''' connection, hit, miss, invalidation and eviction counts '''
+
+		stats = dict(self._stats)
+		stats['proxies'] = len(self._interfaces)
+		return stats
+
+
+# shared by every helper talking to the system bus
+dbus_cache = DBusCache()
+
+
 class Systemd():
 
 	UNIT_INTERFACE = "org.freedesktop.systemd1.Unit"
@@ -37,9 +160,8 @@ class Systemd():
 		self._bus = None
 		self._interface = None
 		try:
-			self._bus = dbus.SystemBus()
-			proxy = self._bus.get_object("org.freedesktop.systemd1", "/org/freedesktop/systemd1")
-			self._interface = dbus.Interface(proxy, "org.freedesktop.systemd1.Manager")
+			self._bus = dbus_cache.bus()
+			self._interface = dbus_cache.interface("org.freedesktop.systemd1", "/org/freedesktop/systemd1", "org.freedesktop.systemd1.Manager")
 		except dbus.exceptions.DBusException as e:
 			logging.error(e)
 
@@ -51,11 +173,7 @@ class Systemd():
 		try:
 			unit_path = self._interface.LoadUnit(unit_name)
 
-			proxy = self._bus.get_object("org.freedesktop.systemd1", unit_path)
-
-			properties_interface = dbus.Interface(proxy, "org.freedesktop.DBus.Properties")
-
-			return properties_interface.GetAll(unit_interface)
+			return dbus_cache.call("org.freedesktop.systemd1", unit_path, "org.freedesktop.DBus.Properties", "GetAll", unit_interface)
 
 		except dbus.exceptions.DBusException as e:
 			logging.error(e)
@@ -100,3 +218,47 @@ class Systemd():
 				return False
 		except KeyError:
 			return False
+
+
+def benchmark(count=1000):
+	''' D-Bus call overhead with a new connection and proxy per call against the cache, calls to
+		the bus daemon itself on the session bus stand in for connman and ofono. dbus.SessionBus()
+		hands back the shared connection, the uncached calls open a private one each time. '''
+
+	def uncached():
+		bus = dbus.SessionBus(private=True)
+		try:
+			manager = dbus.Interface(bus.get_object('org.freedesktop.DBus', '/org/freedesktop/DBus'), 'org.freedesktop.DBus')
+			return manager.GetId()
+		finally:
+			bus.close()
+
+	cache = DBusCache(dbus.SessionBus)
+	def cached():
+		return cache.call('org.freedesktop.DBus', '/org/freedesktop/DBus', 'org.freedesktop.DBus', 'GetId')
+
+	results = {}
+	for name, call in (('uncached', uncached), ('cached', cached)):
+		start = time.time()
+		for i in range(count):
+			call()
+		results[name] = (time.time() - start) / count
+	return results
+
+
+if __name__ == "__main__":
+
+	# root logger
+	logger = logging.getLogger('')
+	logger.setLevel(logging.INFO)
+
+	# format for logging
+	format = logging.Formatter(fmt='%(asctime)s %(levelname)8s [%(module)10s.%(funcName)10s %(lineno)d] %(message)s', datefmt='%b %d %H:%M:%S')
+
+	handler = logging.StreamHandler(sys.stdout)
+	handler.setFormatter(format)
+	logger.addHandler(handler)
+
+	count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+	for name, seconds in sorted(benchmark(count).items()):
+		logging.info('{} {:.1f} us per call'.format(name, seconds * 1e6))
@@ -1,4 +1,4 @@
 
-from tnetserver import tnetapi, tnetconfig, tnetuser, tnetdatabase, tnetdevice, tnetutil,
-	tnetnetman #, tnetemail, tnetevent, tnethamachi, tnetmodel, tnetnetwork, tnetnotify,
+from tnetserver import (tnetapi, tnetconfig, tnetuser, tnetdatabase, tnetdevice, tnetutil, tnetlive,
+	tnetnetman, tnetmetrics, tnetstream) #, tnetemail, tnetevent, tnethamachi, tnetmodel, tnetnetwork, tnetnotify,
 	#tnetofono, tnetsms, tnetsystem, tnettemperature, tnetutils
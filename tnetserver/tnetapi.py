@@ -14,13 +14,19 @@ import collections
 from functools import wraps
 import paho.mqtt.client as mqtt
 
-from tnetserver import tnetconfig, tnetuser, tnetnetman
+from tnetserver import tnetconfig, tnetuser, tnetnetman, tnetlive, tnetmetrics, tnetstream
 
 
 TNET_UNIT_ID = 'TNET-123456789'
 tnet_mqtt = None
 tnet_apis = None
 tnet_reqq = None
+tnet_live = None
+tnet_stream = None
+
+# live temperature topic tree, retained so new subscribers get the last value
+LIVE_SENSOR_TOPIC = 'LIVE/{}/temperature/sensor/{}'
+LIVE_NETWORK_TOPIC = 'LIVE/{}/temperature/network'
 
 TnetRequest = collections.namedtuple('TnetRequest', 'client_id, topic, payload')
 
@@ -115,6 +121,22 @@ class NetworkWifiDisableApi():
 	def handler(self, client_id, topic, payload):
 		return tnetnetman.wifi_radio_off()
 
+class SystemMetricsApi():
+	''' handler for the system metrics history, payload may give start, end and step in seconds '''
+
+	@check_policy(rsp_topic='APIRSP/{}/{}/system/metrics')
+	@send_message(rsp_topic='APIRSP/{}/{}/system/metrics')
+	def handler(self, client_id, topic, payload):
+		return tnetmetrics.get_metrics(payload)
+
+class TemperatureStatsApi():
+	''' handler for the latest sampling stats of the temperature manager '''
+
+	@check_policy(rsp_topic='APIRSP/{}/{}/temperature/stats')
+	@send_message(rsp_topic='APIRSP/{}/{}/temperature/stats')
+	def handler(self, client_id, topic, payload):
+		return tnetlive.get_stats(payload)
+
 """class TemperatureNewApi():
 	''' handler for new temperature session request'''
 
@@ -222,14 +244,6 @@ class UserGetApi():
 		rsp = {'success': True, 'data':{}, 'error':''}
 		mqtt_client.publish_message(topic='{}/{}/user/get/RSP'.format(client_id, TNET_UNIT_ID), message=rsp)
 
-class SystemMetricsApi():
-	''' handler for getting all system metrics on a device '''
-
-	def handler(self, client_id, topic, payload):
-		global mqtt_client
-		rsp = {'success': True, 'data':{}, 'error':''}
-		mqtt_client.publish_message(topic='{}/{}/system/metrics/RSP'.format(client_id, TNET_UNIT_ID), message=rsp)
-
 class SystemShutdownApi():
 	''' handler for reboot or shutdown a device '''
 
@@ -412,11 +426,11 @@ class TgMqtt(object):
 	def stop(self):
 		self._mqtt.loop_stop()
 
-	def publish_message(self, topic, message):
+	def publish_message(self, topic, message, retain=False):
 		''' Function callback so board can publish data '''
 
 		logging.debug("Publish msg topic={} payload={}".format(topic, message))
-		self._mqtt.publish(topic=topic, payload=json.dumps(message))
+		self._mqtt.publish(topic=topic, payload=json.dumps(message), retain=retain)
 
 	def connected(self, client, userdata, flags, rc):
 		''' Mqtt client connected to broker '''
@@ -459,6 +473,115 @@ class TgMqtt(object):
 
 		logging.debug("Published MQTT msg: Mid = {}".format(mid))
 
+class LiveDataBridge(object):
+	''' publishes live temperature keyframes and delta frames on the LIVE topic tree, a sensor
+		is only published when it moved by the deadband or its alarms or stale flag changed '''
+
+	def __init__(self, publish, unit_id=TNET_UNIT_ID, deadband=0.5, network_interval=10):
+		self._publish = publish
+		self._decoder = tnetlive.LiveDecoder()
+		self._unit_id = unit_id
+		self._deadband = deadband
+		self._network_interval = network_interval
+		self._published = {}
+		self._network_size = 0
+		self._network_changed = False
+		self._network_time = 0
+		self._lock = threading.Lock()
+		self._stats = {'frames': 0, 'sensor_messages': 0, 'suppressed': 0, 'network_messages': 0, 'bad_frames': 0}
+
+	def changed(self, last, sensor):
+		''' sensor moved outside the deadband of the last published value, its alarms changed or
+			it went stale or recovered '''
+
+		if last is None:
+			return True
+		if last['a1'] != sensor['a1'] or last['a2'] != sensor['a2'] or last['alarm'] != sensor['alarm'] or \
+			last['stale'] != sensor['stale']:
+			return True
+		return abs(sensor['temp'] - last['temp']) >= self._deadband
+
+	def publish_frame(self, topic, data, now=None):
+		''' publish the sensors of a frame that changed and, at most once per network interval,
+			a snapshot of the whole network '''
+
+		if now is None:
+			now = time.time()
+
+		with self._lock:
+			try:
+				updated = self._decoder.decode(topic, data)
+			except ValueError as e:
+				logging.warning('Live bridge: bad frame {}'.format(e))
+				self._stats['bad_frames'] += 1
+				return
+
+			# delta before the first keyframe
+			if updated is None:
+				return
+
+			self._stats['frames'] += 1
+			sensors = self._decoder.get_sensors()
+			# network resized, forget what was published
+			if len(sensors) != self._network_size:
+				self._published = {}
+				self._network_size = len(sensors)
+
+			for pos in updated:
+				sensor = sensors[pos-1]
+				if not self.changed(self._published.get(pos), sensor):
+					self._stats['suppressed'] += 1
+					continue
+
+				self._published[pos] = sensor
+				self._network_changed = True
+				self._stats['sensor_messages'] += 1
+				self._publish(LIVE_SENSOR_TOPIC.format(self._unit_id, pos), sensor, retain=True)
+
+			if self._network_changed and now - self._network_time >= self._network_interval:
+				self._network_changed = False
+				self._network_time = now
+				self._stats['network_messages'] += 1
+				self._publish(LIVE_NETWORK_TOPIC.format(self._unit_id), {'time': now, 'sensors': sensors}, retain=True)
+
+	def reset(self):
+		''' frames were lost, wait for the next keyframe '''
+
+		with self._lock:
+			self._decoder.reset()
+
+	def get_stats(self):
+		''' frames received and messages published or suppressed '''
+
+		with self._lock:
+			return copy.copy(self._stats)
+
+def publish_live(topic, data):
+	''' Public method to publish a live temperature keyframe or delta frame from the gateway stream '''
+
+	global tnet_live
+	if tnet_live is not None:
+		tnet_live.publish_frame(topic, data)
+
+def stream_frame(ev_class, ev_topic, data):
+	''' Gateway stream handler, routes frames to the live bridge and the metrics history '''
+
+	global tnet_live
+	if ev_class == tnetstream.GAP_CLASS and ev_topic == tnetstream.GAP_TOPIC:
+		# deltas can't be applied across lost frames
+		if tnet_live is not None:
+			tnet_live.reset()
+
+	elif ev_class == tnetlive.LIVE_CLASS and ev_topic in (tnetlive.KEYFRAME_TOPIC, tnetlive.DELTA_TOPIC):
+		publish_live(ev_topic, data)
+
+	elif ev_class == tnetmetrics.METRICS_CLASS and ev_topic == tnetmetrics.METRICS_TOPIC:
+		now, metrics = tnetmetrics.parse_metrics(data)
+		tnetmetrics.record(metrics, now)
+
+	elif ev_class == tnetlive.LIVE_CLASS and ev_topic == tnetlive.STATS_TOPIC:
+		tnetlive.record_stats(tnetlive.parse_stats(data))
+
 def raise_alert(topic, payload):
 	''' Public method to publish message from event manager '''
 
@@ -471,18 +594,35 @@ def start_mqtt():
 	global tnet_mqtt
 	global tnet_apis
 	global tnet_reqq
+	global tnet_live
+	global tnet_stream
 
 	tnet_apis = (
 		('APIREQ/{}/devinfo/get'.format(TNET_UNIT_ID), DeviceGetInfoApi()),
 		('APIREQ/{}/devinfo/set'.format(TNET_UNIT_ID), DeviceSetInfoApi()),
-		('APIREQ/{}/user/register'.format(TNET_UNIT_ID), UserRegisterApi()),)
+		('APIREQ/{}/user/register'.format(TNET_UNIT_ID), UserRegisterApi()),
 		('APIREQ/{}/net/wifi/modemon'.format(TNET_UNIT_ID), NetworkWifiEnableApi()),
-		('APIREQ/{}/net/wifi/modemoff'.format(TNET_UNIT_ID), NetworkWifiDisableApi())
+		('APIREQ/{}/net/wifi/modemoff'.format(TNET_UNIT_ID), NetworkWifiDisableApi()),
+		('APIREQ/{}/system/metrics'.format(TNET_UNIT_ID), SystemMetricsApi()),
+		('APIREQ/{}/temperature/stats'.format(TNET_UNIT_ID), TemperatureStatsApi()),)
 
 	tnet_reqq = queue.Queue(maxsize=50)
 	tnet_mqtt = TgMqtt()
 	tnet_mqtt.start()
 
+	config = tnetconfig.get_config()
+	if config['live']['enable']:
+		tnet_live = LiveDataBridge(tnet_mqtt.publish_message,
+			deadband=config['live']['deadband'],
+			network_interval=config['live']['network_interval'])
+
+	topics = ['{}:{}'.format(tnetmetrics.METRICS_CLASS, tnetmetrics.METRICS_TOPIC),
+		'{}:{}'.format(tnetlive.LIVE_CLASS, tnetlive.STATS_TOPIC)]
+	if tnet_live is not None:
+		topics += ['{}:{}'.format(tnetlive.LIVE_CLASS, topic) for topic in (tnetlive.KEYFRAME_TOPIC, tnetlive.DELTA_TOPIC)]
+	tnet_stream = tnetstream.GatewayStream(stream_frame, topics, host=config['stream']['host'], port=config['stream']['port'])
+	tnet_stream.start()
+
 	logging.debug('Starting queue handler')
 	# dequeue messages and execute handlers
 	while True:
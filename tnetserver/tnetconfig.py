@@ -18,6 +18,19 @@ tnet_config = {
 		'type': 'file',
 		'path': '/home/tgard/'
 	},
+	# event stream of the gateway, live data comes from it
+	'stream': {
+		'host': '127.0.0.1',
+		'port': 54113
+	},
+	# live temperature data bridged onto mqtt
+	'live': {
+		'enable': True,
+		# degrees a sensor must move before it is published again
+		'deadband': 0.5,
+		# minimum seconds between whole network snapshots
+		'network_interval': 10
+	},
 	# interfaces where user CAN'T request the following APIs
 	'policies': {
 		# all requests can be carried out over USB interface
@@ -58,6 +71,23 @@ def load_config():
 		if 'path' in config['database']:
 			tnet_config['database']['path'] = config['database']['path']
 
+	if 'stream' in config:
+		if 'host' in config['stream']:
+			tnet_config['stream']['host'] = config['stream']['host']
+
+		if 'port' in config['stream']:
+			tnet_config['stream']['port'] = config['stream']['port']
+
+	if 'live' in config:
+		if 'enable' in config['live']:
+			tnet_config['live']['enable'] = bool(config['live']['enable'])
+
+		if 'deadband' in config['live'] and config['live']['deadband'] >= 0:
+			tnet_config['live']['deadband'] = config['live']['deadband']
+
+		if 'network_interval' in config['live'] and config['live']['network_interval'] >= 0:
+			tnet_config['live']['network_interval'] = config['live']['network_interval']
+
 def test_setup(path):
 	''' called by test framework to as part of the setup/teardown '''
 	global tnet_config
@@ -0,0 +1,163 @@
+''' Decoder for the live temperature frames streamed by the temperature manager
+
+	Keyframes (topic 009) carry 'temp,a1,a2,state,stale' for every sensor in position order.
+	Delta frames (topic 012) carry 'pos,temp,a1,a2,state,stale' for the sensors that changed
+	since the previous frame only. stale is 1 while the sensor is failing its reads and the
+	temperature is its last good one. The stats of the temperature manager (topic 013) are
+	streamed as json every minute. '''
+
+import copy
+import json
+import time
+import logging
+import threading
+
+# event class of the live frames on the gateway stream
+LIVE_CLASS = 'TMP'
+KEYFRAME_TOPIC = '009'
+DELTA_TOPIC = '012'
+STATS_TOPIC = '013'
+
+KEYFRAME_FIELDS = 5
+DELTA_FIELDS = 6
+
+
+def parse_sensor(fields):
+	''' temp, a1, a2, state, stale fields to a sensor dictionary, alarm thresholds may be decimal '''
+
+	return {'temp': float(fields[0]), 'a1': float(fields[1]), 'a2': float(fields[2]), 'alarm': int(fields[3]),
+		'stale': bool(int(fields[4]))}
+
+def parse_keyframe(data):
+	''' keyframe to a list of sensor dictionaries, position is the index + 1 '''
+
+	fields = data.split(',')
+	if len(fields) % KEYFRAME_FIELDS != 0:
+		raise ValueError('Keyframe has {} fields'.format(len(fields)))
+
+	return [parse_sensor(fields[i:i+KEYFRAME_FIELDS]) for i in range(0, len(fields), KEYFRAME_FIELDS)]
+
+def parse_delta(data):
+	''' delta frame to a list of (pos, sensor dictionary) '''
+
+	fields = data.split(',')
+	if len(fields) % DELTA_FIELDS != 0:
+		raise ValueError('Delta frame has {} fields'.format(len(fields)))
+
+	return [(int(fields[i]), parse_sensor(fields[i+1:i+DELTA_FIELDS])) for i in range(0, len(fields), DELTA_FIELDS)]
+
+
+class LiveDecoder(object):
+	''' rebuilds the state of the whole network from keyframes and delta frames '''
+
+	def __init__(self):
+		self._sensors = None
+		self._stats = {'keyframes': 0, 'deltas': 0, 'unsynced': 0, 'resets': 0}
+
+	def synced(self):
+		''' a keyframe has been received '''
+
+		return self._sensors is not None
+
+	def reset(self):
+		''' frames were lost, drop deltas until the next keyframe '''
+
+		if self._sensors is not None:
+			self._sensors = None
+			self._stats['resets'] += 1
+
+	def decode(self, topic, data):
+		''' apply a frame, returns the positions it updated or None while waiting for a keyframe,
+			raises ValueError on a malformed frame '''
+
+		if topic == KEYFRAME_TOPIC:
+			self._sensors = parse_keyframe(data)
+			self._stats['keyframes'] += 1
+			return list(range(1, len(self._sensors) + 1))
+
+		if topic != DELTA_TOPIC:
+			raise ValueError('Not a live frame topic {}'.format(topic))
+
+		updates = parse_delta(data)
+		if self._sensors is None:
+			self._stats['unsynced'] += 1
+			return None
+
+		updated = []
+		for pos, sensor in updates:
+			if pos < 1 or pos > len(self._sensors):
+				# network changed under us, wait for the next keyframe
+				logging.warning('Live decoder: sensor {} not in keyframe of {}'.format(pos, len(self._sensors)))
+				self._sensors = None
+				self._stats['unsynced'] += 1
+				return None
+
+			self._sensors[pos-1] = sensor
+			updated.append(pos)
+
+		self._stats['deltas'] += 1
+		return updated
+
+	def get_sensors(self):
+		''' current state of every sensor, position is the index + 1 '''
+
+		return copy.deepcopy(self._sensors) if self._sensors is not None else []
+
+	def get_stats(self):
+		''' keyframes and deltas applied, frames dropped while unsynced and resets '''
+
+		return copy.copy(self._stats)
+
+
+class TemperatureStats(object):
+	''' last stats streamed by the temperature manager and when they arrived '''
+
+	def __init__(self):
+		self._stats = None
+		self._time = None
+		self._lock = threading.Lock()
+
+	def record(self, stats, now):
+		''' keep the stats, they replace the previous ones '''
+
+		with self._lock:
+			self._stats = copy.deepcopy(stats)
+			self._time = now
+
+	def latest(self):
+		''' time and stats last recorded, None before any arrived '''
+
+		with self._lock:
+			if self._stats is None:
+				return None
+			return {'time': self._time, 'stats': copy.deepcopy(self._stats)}
+
+
+temperature_stats = TemperatureStats()
+
+def parse_stats(data):
+	''' stream data of the temperature stats to a dictionary, raises ValueError when malformed '''
+
+	stats = json.loads(data)
+	if not isinstance(stats, dict):
+		raise ValueError('Temperature stats are not an object')
+	return stats
+
+def record_stats(stats, now=None):
+	''' keep the latest temperature stats '''
+
+	temperature_stats.record(stats, time.time() if now is None else now)
+
+def get_stats(payload):
+	''' latest temperature stats with the time they arrived '''
+
+	reply = {'success': False, 'data':{}, 'error':''}
+
+	latest = temperature_stats.latest()
+	if latest is None:
+		reply['error'] = 'No temperature stats received'
+	else:
+		reply['data'] = latest
+		reply['success'] = True
+
+	return reply
@@ -0,0 +1,191 @@
+''' Rolling history of the system metrics reported by the gateway
+
+	Every tier is a ring of fixed size arrays with one slot per step, a sample goes into the slot
+	of its step in every tier. The first tier keeps 24 hours at 1 minute, the coarser tiers keep
+	the mean of their step for longer. The power source is not averaged, a slot keeps the last
+	source reported in it. '''
+
+import array
+import copy
+import math
+import time
+import logging
+import threading
+
+METRICS_FIELDS = ('cpu', 'memory', 'disk', 'battery', 'power')
+# samples arrive on the gateway stream as 'time,cpu,memory,disk,battery,power'
+METRICS_CLASS = 'SYS'
+METRICS_TOPIC = '108'
+# fields keeping the last value of a step rather than the mean
+METRICS_LAST_FIELDS = ('power',)
+
+# (seconds per slot, slots): 24 hours at 1 minute, 7 days at 15 minutes, 30 days at 1 hour
+METRICS_TIERS = ((60, 1440), (900, 672), (3600, 720))
+
+# most samples returned by one query
+METRICS_MAX_SAMPLES = 1500
+# range returned when a query gives no start
+METRICS_DEFAULT_RANGE = 3600
+
+
+class MetricsTier(object):
+	''' ring of slots of one step, each field is a column of doubles '''
+
+	def __init__(self, step, slots, fields=METRICS_FIELDS):
+		self.step = step
+		self.slots = slots
+		self.fields = fields
+		# start time of the step held in a slot, 0 while it is empty
+		self._starts = array.array('d', [0.0]) * slots
+		self._counts = array.array('L', [0]) * slots
+		self._columns = [array.array('d', [0.0]) * slots for field in fields]
+		self._last = [field in METRICS_LAST_FIELDS for field in fields]
+
+	def span(self):
+		''' seconds of history the tier holds '''
+
+		return self.step * self.slots
+
+	def add(self, now, values):
+		''' add a sample to the slot of its step, a slot left from an earlier lap is reset '''
+
+		start = math.floor(now / self.step) * self.step
+		index = int(start / self.step) % self.slots
+
+		if self._starts[index] != start:
+			self._starts[index] = start
+			self._counts[index] = 0
+
+		count = self._counts[index]
+		for column, last, value in zip(self._columns, self._last, values):
+			if value is None:
+				continue
+			if last or count == 0:
+				column[index] = value
+			else:
+				# running mean of the step
+				column[index] += (value - column[index]) / (count + 1)
+
+		self._counts[index] = count + 1
+
+	def query(self, start, end):
+		''' rows of start time and field values for the steps between start and end, oldest first '''
+
+		first = max(math.floor(start / self.step), math.floor(end / self.step) - self.slots + 1)
+		last = math.floor(end / self.step)
+
+		rows = []
+		for slot in range(int(first), int(last) + 1):
+			index = slot % self.slots
+			if self._starts[index] != slot * self.step or not self._counts[index]:
+				continue
+			rows.append([self._starts[index]] + [round(column[index], 2) for column in self._columns])
+
+		return rows
+
+
+class MetricsHistory(object):
+	''' metrics history in tiers of increasing step '''
+
+	def __init__(self, tiers=METRICS_TIERS, fields=METRICS_FIELDS):
+		self._fields = fields
+		self._tiers = [MetricsTier(step, slots, fields) for step, slots in sorted(tiers)]
+		self._latest = None
+		self._lock = threading.Lock()
+		self._stats = {'samples': 0, 'queries': 0}
+
+	def record(self, metrics, now):
+		''' add a sample, metrics is a dictionary of field to value, missing fields are left out of the mean '''
+
+		values = [metrics.get(field) for field in self._fields]
+		with self._lock:
+			for tier in self._tiers:
+				tier.add(now, values)
+			self._latest = dict(metrics, time=now)
+			self._stats['samples'] += 1
+
+	def tier(self, start, now, step=None):
+		''' finest tier at least as coarse as the step asked for that still reaches back to start '''
+
+		candidates = [tier for tier in self._tiers if step is None or tier.step >= step]
+		if not candidates:
+			candidates = self._tiers[-1:]
+
+		for tier in candidates:
+			if now - tier.span() <= start:
+				return tier
+
+		return candidates[-1]
+
+	def query(self, start, end, step=None):
+		''' samples between start and end as {'step', 'fields', 'samples'}, each sample is the step
+			start time followed by the fields, raises ValueError on a bad range '''
+
+		if start >= end:
+			raise ValueError('Start {} is not before end {}'.format(start, end))
+		if step is not None and step <= 0:
+			raise ValueError('Step {} is not positive'.format(step))
+
+		with self._lock:
+			# the rings end at the newest sample, not at the end asked for
+			now = max(end, self._latest['time']) if self._latest is not None else end
+			tier = self.tier(start, now, step)
+			rows = tier.query(start, end)
+			self._stats['queries'] += 1
+
+		return {'step': tier.step, 'fields': ['time'] + list(self._fields), 'samples': rows[-METRICS_MAX_SAMPLES:]}
+
+	def latest(self):
+		''' last sample recorded or None '''
+
+		with self._lock:
+			return copy.copy(self._latest)
+
+	def get_stats(self):
+		''' samples recorded, queries answered and the tiers as (step, slots) '''
+
+		with self._lock:
+			stats = copy.copy(self._stats)
+		stats['tiers'] = [(tier.step, tier.slots) for tier in self._tiers]
+		return stats
+
+
+metrics_history = MetricsHistory()
+
+def record(metrics, now=None):
+	''' add a sample of the gateway metrics to the history '''
+
+	metrics_history.record(metrics, time.time() if now is None else now)
+
+def parse_metrics(data):
+	''' stream data of a sample to the time and a dictionary of field to value, raises ValueError
+		when malformed '''
+
+	fields = data.split(',')
+	if len(fields) != len(METRICS_FIELDS) + 1:
+		raise ValueError('Metrics sample has {} fields'.format(len(fields)))
+
+	return float(fields[0]), dict(zip(METRICS_FIELDS, [float(field) for field in fields[1:]]))
+
+def get_metrics(payload):
+	''' metrics between the optional start and end of the payload, the last hour by default,
+		an optional step picks a coarser tier '''
+
+	reply = {'success': False, 'data':{}, 'error':''}
+
+	try:
+		if not isinstance(payload, dict):
+			raise TypeError('payload is not an object')
+		end = float(payload.get('end', time.time()))
+		start = float(payload.get('start', end - METRICS_DEFAULT_RANGE))
+		step = float(payload['step']) if payload.get('step') is not None else None
+		if not all(math.isfinite(value) for value in (start, end, step or 0)):
+			raise ValueError('range is not finite')
+		reply['data'] = metrics_history.query(start, end, step)
+		reply['data']['latest'] = metrics_history.latest()
+		reply['success'] = True
+	except (TypeError, ValueError) as e:
+		reply['error'] = 'Bad metrics range {}'.format(e)
+		logging.warning(reply['error'])
+
+	return reply
@@ -0,0 +1,144 @@
+''' Client of the event stream of the gateway
+
+	The gateway streams its events on a TCP port as '<class:topic:priority:data>' frames. The
+	client subscribes to the topics it wants and asks for sequenced frames, a sequenced frame has
+	the journal sequence of the event in front of it. After a reconnect it resumes after the last
+	sequence it was sent so nothing is missed while the gateway keeps it in its journal. '''
+
+import re
+import copy
+import socket
+import logging
+import threading
+
+STREAM_HOST = '127.0.0.1'
+STREAM_PORT = 54113
+
+# frame sent by the gateway when events were lost, also handed to the handler after connecting
+# without a sequence to resume from
+GAP_CLASS = 'STR'
+GAP_TOPIC = '001'
+
+# optional sequence then '<class:topic:priority:data>', only the data may hold a colon
+FRAME_PATTERN = re.compile(rb'(\d*)<([^:<>]*):([^:<>]*):([^:<>]*):([^<>]*)>')
+# bytes of an incomplete frame kept, anything longer is not a frame
+STREAM_MAX_FRAME = 64 * 1024
+# seconds between connection attempts and between checks for stop while idle
+STREAM_RETRY = 5
+STREAM_POLL = 1
+
+
+def parse_frames(buffer):
+	''' complete frames in the buffer as (seq, class, topic, priority, data) and the bytes after
+		the last of them, seq is None for an unsequenced frame '''
+
+	frames = []
+	end = 0
+	for match in FRAME_PATTERN.finditer(buffer):
+		seq, ev_class, ev_topic, priority, data = match.groups()
+		frames.append((int(seq) if seq else None, ev_class.decode(), ev_topic.decode(), priority.decode(),
+			data.decode('utf-8', errors='replace')))
+		end = match.end()
+
+	rest = buffer[end:]
+	if len(rest) > STREAM_MAX_FRAME:
+		logging.warning('Gateway stream: dropping {} bytes without a frame'.format(len(rest)))
+		rest = b''
+
+	return frames, rest
+
+
+class GatewayStream(object):
+	''' subscribes to topics of the gateway stream and hands every frame to the handler as
+		(class, topic, data) from its own thread, topics are 'CLASS' or 'CLASS:TOPIC' '''
+
+	def __init__(self, handler, topics, host=STREAM_HOST, port=STREAM_PORT, retry=STREAM_RETRY):
+		self._handler = handler
+		self._topics = list(topics)
+		self._host = host
+		self._port = port
+		self._retry = retry
+		self._last_seq = None
+		self._stop = threading.Event()
+		self._thread = None
+		self._stats = {'connects': 0, 'frames': 0, 'gaps': 0, 'errors': 0}
+
+	def start(self):
+		''' connect and read frames in a thread '''
+
+		self._stop.clear()
+		self._thread = threading.Thread(target=self.run, name='GatewayStream')
+		self._thread.daemon = True
+		self._thread.start()
+
+	def stop(self):
+		''' stop reading, the connection is closed within the poll interval '''
+
+		self._stop.set()
+		if self._thread is not None:
+			self._thread.join()
+			self._thread = None
+
+	def run(self):
+		''' connect, read until the connection drops and connect again '''
+
+		while not self._stop.is_set():
+			try:
+				with socket.create_connection((self._host, self._port), timeout=self._retry) as sock:
+					self._stats['connects'] += 1
+					logging.info('Gateway stream: connected to {}:{}'.format(self._host, self._port))
+					self.serve(sock)
+			except (OSError, ValueError) as e:
+				self._stats['errors'] += 1
+				logging.warning('Gateway stream: {}'.format(e))
+
+			self._stop.wait(self._retry)
+
+	def serve(self, sock):
+		''' subscribe and resume, then hand frames to the handler until the connection closes '''
+
+		commands = ''.join('SUB {}\n'.format(topic) for topic in self._topics)
+		if self._last_seq is not None:
+			commands += 'RESUME {}\n'.format(self._last_seq)
+		else:
+			commands += 'RESUME\n'
+			# whatever was streamed before now is unknown
+			self.dispatch(GAP_CLASS, GAP_TOPIC, '')
+		sock.sendall(commands.encode())
+
+		sock.settimeout(STREAM_POLL)
+		buffer = b''
+		while not self._stop.is_set():
+			try:
+				chunk = sock.recv(4096)
+			except socket.timeout:
+				continue
+			if not chunk:
+				logging.info('Gateway stream: connection closed')
+				return
+
+			frames, buffer = parse_frames(buffer + chunk)
+			for seq, ev_class, ev_topic, priority, data in frames:
+				if seq is not None:
+					self._last_seq = seq
+				self.dispatch(ev_class, ev_topic, data)
+
+	def dispatch(self, ev_class, ev_topic, data):
+		''' hand a frame to the handler, a failing handler doesn't stop the stream '''
+
+		if ev_class == GAP_CLASS and ev_topic == GAP_TOPIC:
+			self._stats['gaps'] += 1
+		else:
+			self._stats['frames'] += 1
+
+		try:
+			self._handler(ev_class, ev_topic, data)
+		except Exception as e:
+			logging.error('Gateway stream: handler failed on {}:{} {}'.format(ev_class, ev_topic, e))
+
+	def get_stats(self):
+		''' connections made, frames and gaps handled, last sequence received '''
+
+		stats = copy.copy(self._stats)
+		stats['last_seq'] = self._last_seq
+		return stats